@@ -1,6 +1,11 @@
 import sys
 import argparse
 import gzip
+from operator import itemgetter
+
+# Buffer of the maf output, and rows joined into one write
+OUT_BUFFER = 16 * 1024 * 1024
+WRITE_ROWS = 10000
 
 
 def populate_id_map(map_fn):
@@ -20,18 +25,20 @@ def populate_id_map(map_fn):
     return id_dict
 
 
-def process_maf_entry(data, maf_exc, v_idx, h_idx, tid_idx, eid_idx, map_dict):
-    datum = data.rstrip('\n').split('\t')
-    if datum[tid_idx] in map_dict:
+def process_maf_entry(data, maf_exc, v_idx, h_idx, tid_idx, project, map_dict):
+    """
+    Filter a maf line as bytes, splitting only the fields up to those checked unless it is kept.
+    maf_exc and map_dict are bytes, project gets the output fields of a split line, dropping entrez ID
+    """
+    data = data.rstrip(b'\r\n')
+    head = data.split(b'\t', max(v_idx, h_idx, tid_idx) + 1)
+    if head[tid_idx] in map_dict:
         # Want to allow TERT promoter as exception to exlcusion rules
-        if datum[v_idx] not in maf_exc or (datum[h_idx] == "TERT" and datum[v_idx] == "5'Flank"):
-            samp_id = map_dict[datum[tid_idx]]
-            datum[tid_idx] = samp_id
-            if eid_idx != None:
-                datum.pop(eid_idx)
-            return datum
-    else:
-        return None
+        if head[v_idx] not in maf_exc or (head[h_idx] == b"TERT" and head[v_idx] == b"5'Flank"):
+            datum = data.split(b'\t')
+            datum[tid_idx] = map_dict[head[tid_idx]]
+            return b'\t'.join(project(datum))
+    return None
 
 
 if __name__ == '__main__':
@@ -50,30 +57,41 @@ if __name__ == '__main__':
     map_dict = populate_id_map(args.mapping_file)
 
     maf_exc = {"Silent": 0, "Intron": 0, "IGR": 0, "3'UTR": 0, "5'UTR": 0, "3'Flank": 0, "5'Flank": 0, "RNA": 0}
+    byte_exc = frozenset(term.encode() for term in maf_exc)
+    byte_map = {bs_id.encode(): cbio_id.encode() for bs_id, cbio_id in map_dict.items()}
 
     # process header, track key indices and drop entrez ID
     maf_file = gzip.open(args.maf_file)
-    maf_out = open(args.type + ".maf", "w")
+    maf_out = open(args.type + ".maf", "wb", buffering=OUT_BUFFER)
     if args.skip:
-        head = next(maf_file).decode()
+        head = next(maf_file)
         maf_out.write(head)
     else:
         sys.stderr.write('Skip flag not given. Adding typical #version header for best compatibility\n')
-        print('#version 2.4', file=maf_out)
+        maf_out.write(b'#version 2.4\n')
     head = next(maf_file).decode()
     header = head.rstrip("\n").split("\t")
     tid_idx = header.index('Tumor_Sample_Barcode')
     v_idx = header.index('Variant_Classification')
     h_idx = header.index('Hugo_Symbol')
     eid_idx = header.index('Entrez_Gene_Id')
+    project = itemgetter(*(i for i in range(len(header)) if i != eid_idx))
     header.pop(eid_idx)
-    print("\t".join(header), file=maf_out)
+    maf_out.write(("\t".join(header) + "\n").encode())
 
     sys.stderr.write("Filtering entries and renaming samples\n")
 
+    rows = []
     for line in maf_file:
-        to_print = process_maf_entry(line.decode(), maf_exc, v_idx, h_idx, tid_idx, eid_idx, map_dict)
-        if to_print:
-            print("\t".join(to_print), file=maf_out)
+        to_print = process_maf_entry(line, byte_exc, v_idx, h_idx, tid_idx, project, byte_map)
+        if to_print is not None:
+            rows.append(to_print)
+            if len(rows) == WRITE_ROWS:
+                rows.append(b'')
+                maf_out.write(b'\n'.join(rows))
+                rows = []
+    if rows:
+        rows.append(b'')
+        maf_out.write(b'\n'.join(rows))
     sys.stderr.write("Fin.\n")
     maf_out.close()
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""Run the import workflow for several studies under one job scheduler.
+
+Each study runs in its own ./<study> dir:
+1. Steps 1-2 and the step 4 manifest subset, for all studies concurrently
+2. One step 4 download of the union of all manifest subsets into shared_downloads/, so that files
+   several studies share are fetched once, then hard linked into each study's file type dirs, with
+   their download_state.db records copied into the study's, so step 5 verifies their digests
+3. Steps 5-6 for all studies concurrently, splitting the --max-workers and --max-memory budget
+
+Validator scripts every study uses are fetched once. Study phases run in a process pool whose
+workers are forked from a forkserver, never from the batch process and its scheduler threads.
+"""
+
+import argparse
+import copy
+import csv
+import os
+import shutil
+import sys
+
+from cbioportal_etl.scripts import etl_trace
+from cbioportal_etl.scripts.download_state import STATE_FILE, DownloadState
+from cbioportal_etl.scripts.job_scheduler import JobScheduler, PyEntry
+from cbioportal_etl.scripts.resource_budget import (
+    MEMORY_ENV,
+    JobResources,
+    ResourceBudget,
+    parse_memory,
+    worker_count,
+)
+from cbioportal_etl.scripts.run_report import RunReport
+from cbioportal_etl.steps import fetch_validator_scripts, run_etl
+
+SHARED_DOWNLOAD_DIR: str = "shared_downloads"
+# Path args given relative to the batch dir, made absolute since each study runs in its own dir
+PATH_ARGS: list[str] = ["db_ini", "config_tsv", "ref_dir", "aws_tbl", "token"]
+
+
+def link_downloads(study: str, shared_state: DownloadState) -> int:
+    """Hard link the shared downloads listed in a study's manifest subset into the study dir.
+
+    Falls back to a copy if the study dir is on another filesystem. Files that failed to download
+    are left for step 5 of the study to report. The download records of the files are copied into
+    the study's download state, for step 5 to verify the files against.
+
+    Args:
+        study: Study ID, also its dir
+        shared_state: Download state of the shared downloads
+
+    Returns:
+        Number of files linked
+
+    """
+    linked: int = 0
+    shared: list[str] = []
+    with open(os.path.join(study, "manifest_subset.tsv")) as f:
+        for row in csv.DictReader(f, delimiter="\t"):
+            rel_path: str = os.path.join(row["file_type"], row["file_name"])
+            src: str = os.path.join(SHARED_DOWNLOAD_DIR, rel_path)
+            dest: str = os.path.join(study, rel_path)
+            if not os.path.isfile(src):
+                continue
+            shared.append(rel_path)
+            if os.path.exists(dest) and os.path.samefile(src, dest):
+                continue
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if os.path.lexists(dest):
+                os.remove(dest)
+            try:
+                os.link(src, dest)
+            except OSError:
+                shutil.copy2(src, dest)
+            linked += 1
+    # links share the size and mtime recorded, and copy2 keeps them
+    study_state = DownloadState(os.path.join(study, STATE_FILE))
+    study_state.copy_records(shared_state, shared)
+    study_state.save()
+    return linked
+
+
+def run_py(args: argparse.Namespace) -> None:
+    """Run one batch phase. Entry point of the jobs run_batch schedules.
+
+    Args:
+        args: Command line args, with batch_phase prepare, download or build, and the study to run it
+            for, or batch_studies for the download
+
+    """
+    if args.batch_phase == "download":
+        studies: list[str] = [
+            study for study in args.batch_studies if os.path.isfile(os.path.join(study, "manifest_subset.tsv"))
+        ]
+        if not studies:
+            print("No study has a manifest subset to download", file=sys.stderr)
+            sys.exit(1)
+        download_args = copy.copy(args)
+        download_args.manifest = ",".join(
+            os.path.abspath(os.path.join(study, "manifest_subset.tsv")) for study in studies
+        )
+        download_args.cbio = None
+        os.makedirs(SHARED_DOWNLOAD_DIR, exist_ok=True)
+        batch_dir: str = os.getcwd()
+        os.chdir(SHARED_DOWNLOAD_DIR)
+        run_etl(download_args, ["4"])
+        os.chdir(batch_dir)
+        shared_state = DownloadState(os.path.join(SHARED_DOWNLOAD_DIR, STATE_FILE))
+        for study in studies:
+            print(f"Linked {link_downloads(study, shared_state)} shared downloads into {study}", file=sys.stderr)
+        return
+
+    os.chdir(args.study)
+    if args.batch_phase == "prepare":
+        # a stale subset would otherwise be downloaded if this study fails before writing a new one
+        if os.path.exists("manifest_subset.tsv"):
+            os.remove("manifest_subset.tsv")
+        run_etl(args, ["1", "2"])
+        subset_args = copy.copy(args)
+        subset_args.debug = True
+        run_etl(subset_args, ["4"])
+    elif args.batch_phase == "build":
+        # merge jobs of this study share what the batch granted it
+        args.max_workers = worker_count()
+        args.max_memory = os.environ.get(MEMORY_ENV)
+        run_etl(args, ["5", "6"])
+
+
+def phase_args(args: argparse.Namespace, phase: str, study: str | None = None) -> argparse.Namespace:
+    """Copy the batch args for one phase of a study, leaving paths that default per study unset."""
+    p_args = copy.copy(args)
+    p_args.batch_phase = phase
+    if study is not None:
+        p_args.study = study
+        p_args.study_config = None
+    return p_args
+
+
+def run_batch(args: argparse.Namespace, studies: list[str]) -> None:
+    """Run steps 1, 2, 4, 5 and 6 for each study, sharing references, downloads and the resource budget.
+
+    A study that fails does not stop the others. Exits with status 1 if any study failed.
+
+    Args:
+        args: Command line args shared by all studies
+        studies: Study IDs, each run in a dir of the same name
+
+    """
+    tool_dir: str = os.path.dirname(os.path.abspath(__file__))
+    for path_arg in PATH_ARGS:
+        arg_val = getattr(args, path_arg, None)
+        if arg_val and not os.path.isabs(arg_val):
+            setattr(args, path_arg, os.path.abspath(arg_val))
+    fetch_validator_scripts(tool_dir)
+
+    budget = ResourceBudget(args.max_workers, parse_memory(args.max_memory))
+    # studies are granted memory in proportion to their workers
+    worker_memory: int = budget.max_memory // budget.max_workers if budget.max_memory else 0
+    # every job has an entry point, so the commands only describe them in logs
+    # each study also writes a report of its own steps and merge jobs in its dir
+    report = RunReport()
+    scheduler = JobScheduler(in_process=True, budget=budget, keep_going=True, report=report)
+
+    for study in studies:
+        os.makedirs(study, exist_ok=True)
+        scheduler.add_job(
+            f"{study}_prepare",
+            f"steps 1, 2 and the manifest subset of {study}",
+            entry=PyEntry(
+                "cbioportal_etl.batch", phase_args(args, "prepare", study), os.path.join(study, "batch_prepare.log")
+            ),
+        )
+    download_args: argparse.Namespace = phase_args(args, "download")
+    download_args.batch_studies = studies
+    scheduler.add_job(
+        "shared_download",
+        "step 4 downloads of all study manifest subsets",
+        entry=PyEntry("cbioportal_etl.batch", download_args, "shared_download.log"),
+        # runs once every study is prepared, whether it succeeded or not
+        after=tuple(scheduler.jobs),
+    )
+    for study in studies:
+        scheduler.add_job(
+            f"{study}_build",
+            f"steps 5 and 6 of {study}",
+            entry=PyEntry(
+                "cbioportal_etl.batch", phase_args(args, "build", study), os.path.join(study, "batch_build.log")
+            ),
+            deps=(f"{study}_prepare", "shared_download"),
+            resources=JobResources(budget.max_workers, 0, worker_memory),
+        )
+    try:
+        with etl_trace.tracing(args.trace, "cbio-etl batch"):
+            scheduler.run()
+    finally:
+        report.write()
@@ -4,6 +4,8 @@ import argparse
 import os
 import sys
 
+from cbioportal_etl.batch import run_batch
+from cbioportal_etl.scripts.stage_profiler import parse_profile_stages
 from cbioportal_etl.steps import run_etl
 
 
@@ -25,7 +27,9 @@ def main():
         required=False,
         help="Path to the input TSV file containing completed values for json generation",
     )
-    common_args.add_argument("-s", "--study", required=True, help="Cancer study ID")
+    common_args.add_argument(
+        "-s", "--study", required=True, help="Cancer study ID, or csv string of study IDs for batch"
+    )
     # Step 2 - get_study_metadata.py
     common_args.add_argument("-db", "--db-ini", required=True, help="Database config file")
     common_args.add_argument(
@@ -56,9 +60,22 @@ def main():
         "-f", "--file-types", required=False, help="Comma-separated file types to download"
     )
     common_args.add_argument(
-        "-at", "--aws-tbl", required=False, help="AWS table with bucket name and keys"
+        "-at",
+        "--aws-tbl",
+        required=False,
+        help="AWS table with bucket name and keys. Entries with an s3_path in these buckets download from S3",
+    )
+    common_args.add_argument(
+        "--s3-endpoint-url",
+        dest="s3_endpoint_url",
+        help="S3 endpoint to download from other than AWS, like a MinIO server",
+    )
+    common_args.add_argument(
+        "-sp",
+        "--sbg-profile",
+        required=False,
+        help="SBG profile name. Only needed if the manifest has files outside the S3 buckets of the --aws-tbl",
     )
-    common_args.add_argument("-sp", "--sbg-profile", required=True, help="SBG profile name")
     common_args.add_argument(
         "-c", "--cbio", required=False, help="cBio manifest to limit downloads"
     )
@@ -86,6 +103,43 @@ def main():
         action="store_true",
         help="Overwrite files if they already exist",
     )
+    common_args.add_argument(
+        "--prune-removed",
+        action="store_true",
+        dest="prune_removed",
+        help="Delete downloaded files of the file types downloaded that are no longer in the manifest",
+    )
+    common_args.add_argument(
+        "--download-workers",
+        type=int,
+        dest="download_workers",
+        help="Most downloads, or ranges of large files, in flight at once across all file types. Default is 16",
+    )
+    common_args.add_argument(
+        "--download-per-host",
+        type=int,
+        dest="download_per_host",
+        help="Most downloads in flight to any one host. Default is no limit beyond --download-workers",
+    )
+    common_args.add_argument(
+        "--download-engine",
+        choices=["threads", "async"],
+        default="threads",
+        dest="download_engine",
+        help="Run downloads on a thread each, or as coroutines of one event loop thread, which keeps hundreds in "
+        "flight cheaply with a high --download-workers. async needs aiohttp. Default is threads",
+    )
+    common_args.add_argument(
+        "--download-cache",
+        dest="download_cache",
+        help="Dir of a download cache shared across studies and runs. Files in it are linked instead of downloaded",
+    )
+    common_args.add_argument(
+        "--download-cache-size",
+        type=float,
+        dest="download_cache_size",
+        help="Size in GB the download cache is kept under, evicting least recently used files. Default is no limit",
+    )
     # Step 5 - check_downloads.py
     common_args.add_argument(
         "-ms",
@@ -94,6 +148,12 @@ def main():
         required=False,
         help="Check that files were downloaded (automatically set when applicable)",
     )
+    common_args.add_argument(
+        "--size-only",
+        action="store_true",
+        dest="size_only",
+        help="Only check downloaded file sizes, skipping md5s",
+    )
     # Step 6 - genomics_file_cbio_package_build.py
     common_args.add_argument(
         "-dgd", "--dgd-status", default="kf", choices=["both", "kf", "dgd"], help="Load options"
@@ -123,6 +183,54 @@ def main():
         default="none", 
         help="Default match type for samples with unknown RNA library type for z-score calculations. Use 'polyA' or 'totalRNA' to override fallback to intra-cohort z-score."
     ) 
+    common_args.add_argument(
+        "-em",
+        "--exec-mode",
+        action="store",
+        dest="exec_mode",
+        choices=["inprocess", "subprocess"],
+        default="subprocess",
+        help="Run step 6 merge jobs as separate python3 commands (subprocess), or as calls of each script's entry point in a forkserver process pool, handed the parsed config and manifest (inprocess)",
+    )
+    common_args.add_argument(
+        "--max-workers",
+        action="store",
+        dest="max_workers",
+        type=int,
+        help="Total worker processes shared by all step 6 merge jobs. Default is the number of cpus",
+    )
+    common_args.add_argument(
+        "--max-memory",
+        action="store",
+        dest="max_memory",
+        help="Total memory shared by all step 6 merge jobs, like 48G. Jobs wait for memory to free up if their estimate does not fit. Default is unlimited",
+    )
+    common_args.add_argument(
+        "--pipeline",
+        action="store_true",
+        dest="pipeline",
+        help="Run step 4 downloads in the background and start each step 6 merge as soon as the file types it reads are downloaded. Step 5 runs last",
+    )
+    common_args.add_argument(
+        "--force",
+        action="store",
+        dest="force",
+        help="csv string of stages to rerun even if their checkpoint shows them complete: step numbers, step 6 job names (rsem, mafs, fusion, cnvs, dgd_fusion, dgd_maf, load_package), or all. Forcing dgd_fusion or dgd_maf also reruns the merge it appends to",
+    )
+    common_args.add_argument(
+        "--profile-stage",
+        action="store",
+        dest="profile_stage",
+        help="csv string of stages to run under cProfile, writing a .prof file next to each stage log (collate_mafs.prof, cnv_processing.prof...): maf, cnv, rsem, fusion, diff",
+    )
+    common_args.add_argument(
+        "--trace",
+        action="store",
+        dest="trace",
+        nargs="?",
+        const="etl_trace.json",
+        help="Write a Chrome trace of the run, with every step, download batch, merge job and worker task, to this file (default: etl_trace.json). Open it in https://ui.perfetto.dev",
+    )
     common_args.add_argument(
         "--schema",
         action="store",
@@ -175,10 +283,27 @@ def main():
         help="Advanced run mode to start from a different point. Enter steps as csv string 1-6.",
     )
 
+    # Batch command (whole study import of several studies at once)
+    subparsers.add_parser(
+        "batch",
+        parents=[common_args],
+        help="Run import workflow (Steps 1, 2, 4, 5, 6) for a csv string of studies given to --study, each in a dir of the same name, sharing references and downloads",
+    )
+
     args: argparse.Namespace = parser.parse_args()
+    try:
+        parse_profile_stages(args.profile_stage)
+    except ValueError as e:
+        parser.error(str(e))
 
     if args.command == "import":
         run_etl(args, steps=["1", "2", "4", "5", "6"])
+    elif args.command == "batch":
+        studies: list[str] = [study.strip() for study in args.study.split(",") if study.strip()]
+        if len(studies) > 1 and (args.study_config or args.study_tsv):
+            print("Error: --study-config and --study-tsv apply to a single study, not a batch.")
+            sys.exit(1)
+        run_batch(args, studies)
     elif args.command == "partial":
         p_steps = args.steps.split(",")
         run_etl(args, steps=p_steps)
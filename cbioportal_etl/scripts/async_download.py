@@ -0,0 +1,312 @@
+"""Asyncio download engine, selected with --download-engine async, running every transfer from one thread.
+
+The threaded engine runs a thread per download in flight, which caps how many it can keep going
+before thread overhead matters. This engine takes work off the same priority queue with a coroutine
+per worker on one event loop, so hundreds of range requests can be in flight at once. Queueing,
+range splitting, tuning, URL resolution, resume journals, digests and the download cache are those
+of the threaded DownloadScheduler, only the transfers differ. They keep its retry and backoff, its
+refusal of expired URLs, and its check that each range came back as the 206 Partial Content of
+exactly the bytes requested. Writes to disk, and hashing what was written, run on worker threads
+so the event loop only ever waits on the network. Transfers are traced as async events, as many
+overlap on the loop thread.
+
+Needs aiohttp, installed with the async extra: pip install "cbio-etl[async]"
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections.abc import Callable
+from urllib.parse import urlparse
+
+import aiohttp
+
+from cbioportal_etl.scripts import etl_trace
+from cbioportal_etl.scripts.download_scheduler import URL_REFRESHES, DownloadScheduler, FileDownload, RangeWork
+from cbioportal_etl.scripts.url_download_helper import (
+    EXPIRED_STATUSES,
+    STREAM_CHUNK,
+    THROTTLE_STATUSES,
+    ExpiredURLError,
+    PartHasher,
+    check_range_response,
+    check_range_size,
+    journal_range,
+    pwrite_all,
+)
+
+# Seconds to connect, and between bytes read, before a request counts as timed out, like the threaded engine
+TIMEOUT: int = 30
+
+
+def write_chunk(fd: int, chunk: bytes, offset: int, hasher: PartHasher) -> None:
+    """Write a chunk at its offset of a file and hash it, blocking, so run off the event loop."""
+    pwrite_all(fd, chunk, offset)
+    hasher.update(chunk)
+
+
+def open_partial(path: str, offset: int, hasher: PartHasher) -> int:
+    """Open a download for writing from offset on, hashing the bytes before it, blocking, so run off the event loop.
+
+    Returns:
+        Descriptor of the file, to close once written
+
+    """
+    fd: int = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        # a resumed download hashes the part it keeps, read back only this once
+        while hasher.written < offset:
+            chunk: bytes = os.pread(fd, min(STREAM_CHUNK, offset - hasher.written), hasher.written)
+            if not chunk:
+                break
+            hasher.update(chunk)
+        os.ftruncate(fd, offset)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+async def request_with_retries(
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: dict[str, str] | None = None,
+    retries: int = 5,
+    delay: int = 3,
+    on_throttle: Callable[[], None] | None = None,
+) -> aiohttp.ClientResponse:
+    """Perform a GET request with retries and exponential backoff, the async twin of _request_with_retries.
+
+    Args:
+        session: Session to request with
+        url: URL to request
+        headers: Headers to include in the request
+        retries: Number of attempts before giving up
+        delay: Initial delay between retries in seconds
+        on_throttle: Called when the server throttles or times out a request
+
+    Returns:
+        Response, with its body still to be read, to release once done
+
+    """
+    logger = logging.getLogger(__name__)
+    for attempt in range(retries):
+        try:
+            response: aiohttp.ClientResponse = await session.get(url, headers=headers)
+            if response.status in EXPIRED_STATUSES:
+                response.release()
+                msg = f"Download URL refused with status {response.status}, it may have expired"
+                raise ExpiredURLError(msg)
+            if response.status in THROTTLE_STATUSES and on_throttle is not None:
+                on_throttle()
+            if response.status >= 400:
+                response.release()
+            response.raise_for_status()
+            if attempt > 0:
+                logger.info("Successfully downloaded %s on attempt %d", url, attempt + 1)
+            return response
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:  # noqa: PERF203
+            logger.warning("Error downloading %s", url)
+            if not isinstance(e, aiohttp.ClientResponseError) and on_throttle is not None:
+                on_throttle()
+            if attempt < retries - 1:
+                logger.warning("Retrying in %d seconds...", delay)
+                await asyncio.sleep(delay + random.uniform(0, 1))
+                delay *= 2
+            else:
+                msg = f"Failed to download {url} after {retries} attempts because of error: {e}"
+                raise Exception(msg) from e
+    msg = f"Failed to download {url}, no attempts made"
+    raise Exception(msg)
+
+
+async def download_range(
+    session: aiohttp.ClientSession,
+    url: str,
+    start: int,
+    end: int,
+    fd: int,
+    part_size: int | None = None,
+    on_throttle: Callable[[], None] | None = None,
+) -> list[str]:
+    """Download a byte range straight into place in a file, the async twin of url_download_helper.download_range.
+
+    Args:
+        session: Session to request with
+        url: URL to download from
+        start: First byte of the range
+        end: Last byte of the range
+        fd: Descriptor of the output file, opened for writing and preallocated
+        part_size: Size of the parts hashed on their own, the whole range is one part if not given
+        on_throttle: Called when the server throttles or times out a request
+
+    Returns:
+        md5 hex digests of the consecutive parts of the range
+
+    """
+    headers: dict[str, str] = {"Range": f"bytes={start}-{end}"}
+    response = await request_with_retries(session, url, headers, on_throttle=on_throttle)
+    async with response:
+        check_range_response(response.status, response.headers.get("Content-Range"), start, end)
+        hasher = PartHasher(part_size)
+        async for chunk in response.content.iter_chunked(STREAM_CHUNK):
+            await asyncio.to_thread(write_chunk, fd, chunk, start + hasher.written, hasher)
+    check_range_size(start, end, hasher.written)
+    return hasher.hexdigests()
+
+
+async def small_download(
+    session: aiohttp.ClientSession,
+    url: str,
+    output_path: str,
+    offset: int = 0,
+    on_throttle: Callable[[], None] | None = None,
+) -> str:
+    """Download a whole file, or the rest of it from offset, the async twin of url_download_helper.small_download.
+
+    Args:
+        session: Session to request with
+        url: URL to download from
+        output_path: Path to save the file to
+        offset: Bytes of the file already at output_path, only the rest is downloaded
+        on_throttle: Called when the server throttles or times out a request
+
+    Returns:
+        md5 hex digest of the file
+
+    """
+    headers: dict[str, str] | None = {"Range": f"bytes={offset}-"} if offset else None
+    response = await request_with_retries(session, url, headers, on_throttle=on_throttle)
+    async with response:
+        content_range: str = response.headers.get("Content-Range", "")
+        if not (offset and response.status == 206 and content_range.startswith(f"bytes {offset}-")):
+            # no range support, start over
+            offset = 0
+        hasher = PartHasher()
+        fd: int = await asyncio.to_thread(open_partial, output_path, offset, hasher)
+        try:
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK):
+                await asyncio.to_thread(write_chunk, fd, chunk, hasher.written, hasher)
+        finally:
+            os.close(fd)
+    return hasher.hexdigests()[0]
+
+
+class AsyncDownloadScheduler(DownloadScheduler):
+    """DownloadScheduler whose workers are coroutines on one event loop thread instead of threads."""
+
+    def _start_workers(self) -> list[threading.Thread]:
+        """Start the event loop thread running a coroutine per worker."""
+        self.loop = asyncio.new_event_loop()
+        self.async_queue: asyncio.PriorityQueue[tuple[int, int, RangeWork | None]] = asyncio.PriorityQueue()
+        self.async_host_slots: dict[str, asyncio.Semaphore] = {}
+        worker = threading.Thread(target=self._run_loop, name="download-loop", daemon=True)
+        worker.start()
+        return [worker]
+
+    def _run_loop(self) -> None:
+        """Run the workers until each got a stop."""
+        try:
+            self.loop.run_until_complete(self._serve())
+        finally:
+            self.loop.close()
+
+    async def _serve(self) -> None:
+        """Run a coroutine per worker sharing one session, its connections kept alive across downloads."""
+        connector = aiohttp.TCPConnector(limit=self.max_workers)
+        timeout = aiohttp.ClientTimeout(sock_connect=TIMEOUT, sock_read=TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False) as session:
+            self.async_session: aiohttp.ClientSession = session
+            await asyncio.gather(*(self._work_async() for _worker in range(self.max_workers)))
+
+    def _put(self, priority: int, work: RangeWork | None) -> None:
+        """Queue work on the event loop, first in first out among equal priorities, from any thread."""
+        with self.lock:
+            self._seq += 1
+            seq: int = self._seq
+        self.loop.call_soon_threadsafe(self.async_queue.put_nowait, (priority, seq, work))
+
+    async def _work_async(self) -> None:
+        """Download queued work until told to stop."""
+        while True:
+            priority, _seq, work = await self.async_queue.get()
+            if work is None:
+                return
+            await self._fetch_async(self._split(priority, work))
+            # moving files into place, and into the cache, is disk work to keep off the event loop
+            await asyncio.to_thread(self._work_done, work.file)
+
+    def _async_host_slot(self, url: str) -> asyncio.Semaphore:
+        """Get the semaphore limiting concurrent requests to the host of a URL, only used on the event loop."""
+        host: str = urlparse(url).netloc
+        if host not in self.async_host_slots:
+            self.async_host_slots[host] = asyncio.Semaphore(self.per_host)
+        return self.async_host_slots[host]
+
+    async def _fetch_async(self, work: RangeWork) -> None:
+        """Download one range of a file, or all of it, failing the file on error, like _fetch."""
+        file: FileDownload = work.file
+        logger = logging.getLogger(__name__)
+        with file.lock:
+            if not file.started:
+                file.started = True
+                if file.resolved_ahead:
+                    self.lookahead.release()
+        if file.failed:
+            return
+        if self.tracker.cancelled.is_set():
+            self._fail(file, None)
+            return
+        try:
+            if file.url is None:
+                # resolver threads hold the file's url_lock while rate limited, never the loop
+                await asyncio.to_thread(self._resolve_url, file, None)
+            if work.start is not None:
+                await asyncio.to_thread(self._open_part, file)
+            for refresh in range(URL_REFRESHES + 1):
+                url: str = file.url
+                try:
+                    await self._download_async(work, url)
+                    break
+                except ExpiredURLError:
+                    if refresh == URL_REFRESHES:
+                        raise
+                    logger.info("Download URL of %s expired, requesting a new one", file.path)
+                    await asyncio.to_thread(self._resolve_url, file, url)
+        except Exception as e:
+            logger.exception("Failed to download %s", file.path)
+            self._fail(file, e)
+
+    async def _download_async(self, work: RangeWork, url: str) -> None:
+        """Download one range of a file, or all of it resuming its partial download, from url, like _download."""
+        file: FileDownload = work.file
+        name: str = os.path.basename(file.path)
+        async with self.tuner.async_slot(), self._async_host_slot(url):
+            start: float = time.monotonic()
+            if work.start is None:
+                offset: int = await asyncio.to_thread(self._resume_offset, file)
+                async with etl_trace.async_span(name, "download", size=file.size, offset=offset):
+                    file.md5 = await small_download(
+                        self.async_session, url, file.part, offset, on_throttle=self.tuner.throttled
+                    )
+                self.tuner.record(file.size - offset, time.monotonic() - start, ranged=False)
+            else:
+                async with etl_trace.async_span(f"{name} {work.start}-{work.end}", "download", size=file.size):
+                    md5s: list[str] = await download_range(
+                        self.async_session,
+                        url,
+                        work.start,
+                        work.end,
+                        file.fd,
+                        part_size=self.part_size,
+                        on_throttle=self.tuner.throttled,
+                    )
+                self.tuner.record(work.end - work.start + 1, time.monotonic() - start, ranged=True)
+                with file.lock:
+                    file.part_md5s.update(zip(range(work.start, work.end + 1, self.part_size), md5s))
+                await asyncio.to_thread(journal_range, file.part, work.start, work.end, md5s)
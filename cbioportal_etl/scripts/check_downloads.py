@@ -3,32 +3,233 @@
 """helper script to ensure intended files were downloaded.
 
 uses manifest subset generated by get_files_from_manifest.py
+checks sizes and md5s against the manifest, if it lists them, and the download_state.db records of step 4,
+read without writing to it
+
+Each file_type dir is read once with os.scandir into an index of file name to size and mtime, so
+missing and size mismatched files are set differences against the manifest, whatever its length.
+Only files left with a digest to verify are read, side by side. Problems are written to
+missing_files.txt sorted by path, and counted per file type.
 """
 from __future__ import annotations
 
 import argparse
 import concurrent.futures
+import hashlib
+import os
 import sys
-from pathlib import Path
+from typing import NamedTuple
+
+from cbioportal_etl.scripts.download_state import DownloadState, file_md5, multipart_etag
+
+
+# Optional manifest columns with the size and md5, or S3 ETag, each file should have
+SIZE_COLUMNS: tuple[str, ...] = ("file_size", "size")
+MD5_COLUMNS: tuple[str, ...] = ("md5sum", "md5", "etag")
+MIB: int = 1024 * 1024
+# Part sizes of common S3 uploaders, tried for multipart ETags
+COMMON_PART_SIZES: tuple[int, ...] = (8 * MIB, 16 * MIB, 64 * MIB)
+
+
+class ExpectedFile(NamedTuple):
+    """Named tuple with a manifest file, the path it is downloaded to, and the size and md5 listed for it, if any."""
+
+    file_type: str
+    file_name: str
+    path: str
+    size: int | None
+    md5: str | None
+
+
+def etag_part_sizes(size: int, parts: int, recorded: int | None = None) -> list[int]:
+    """List the part sizes a multipart ETag of size bytes in parts parts may have been computed with.
+
+    Uploaders pick their own part size, so the common ones, the part size the file was downloaded
+    with, and the smallest whole MiB splitting size into its parts, are tried. Only those giving
+    that many parts are kept.
+    """
+    minimum: int = -(-size // parts // MIB) * MIB if size > parts * MIB else MIB
+    candidates: set[int] = {minimum, *COMMON_PART_SIZES}
+    if recorded:
+        candidates.add(recorded)
+    return sorted(part_size for part_size in candidates if -(-size // part_size) == parts)
 
 
-def check_exists(entry: str, t_idx: int, n_idx: int) -> str | bool:
-    """Check manifest entry to see if file exists.
+def file_etags(path: str, part_sizes: list[int]) -> dict[int, str]:
+    """Compute the multipart ETags of a file for each part size, all in one read. Part sizes are whole MiB."""
+    part_md5s: dict[int, list[str]] = {part_size: [] for part_size in part_sizes}
+    digests: dict[int, hashlib._Hash] = {part_size: hashlib.md5() for part_size in part_sizes}  # noqa: S324
+    read: int = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(MIB):
+            read += len(chunk)
+            for part_size, digest in digests.items():
+                digest.update(chunk)
+                if read % part_size == 0:
+                    part_md5s[part_size].append(digest.hexdigest())
+                    digests[part_size] = hashlib.md5()  # noqa: S324
+    for part_size, md5s in part_md5s.items():
+        if read % part_size or not md5s:
+            md5s.append(digests[part_size].hexdigest())
+    return {part_size: multipart_etag(md5s) for part_size, md5s in part_md5s.items()}
+
+
+def read_manifest(manifest_subset: str) -> dict[str, dict[str, ExpectedFile]]:
+    """Read the files a manifest subset lists by file type and name, with their sizes and md5s if it has those columns."""
+    with open(manifest_subset) as m:
+        header: list[str] = next(m).rstrip("\n").split("\t")
+        t_idx: int = header.index("file_type")
+        n_idx: int = header.index("file_name")
+        size_idx: int | None = next((header.index(col) for col in SIZE_COLUMNS if col in header), None)
+        md5_idx: int | None = next((header.index(col) for col in MD5_COLUMNS if col in header), None)
+        expected: dict[str, dict[str, ExpectedFile]] = {}
+        for line in m:
+            info: list[str] = line.rstrip("\n").split("\t")
+            file_type, file_name = info[t_idx], info[n_idx]
+            type_files: dict[str, ExpectedFile] = expected.setdefault(file_type, {})
+            # files listed more than once are checked once
+            if file_name in type_files:
+                continue
+            size: str | None = info[size_idx] if size_idx is not None else None
+            md5: str | None = info[md5_idx] if md5_idx is not None else None
+            type_files[file_name] = ExpectedFile(
+                file_type,
+                file_name,
+                f"{file_type}/{file_name}",
+                int(float(size)) if size and size != "NA" else None,
+                md5 if md5 and md5 != "NA" else None,
+            )
+    return expected
+
+
+def scan_dir(file_type: str) -> dict[str, os.stat_result]:
+    """Index the files of a file_type dir by name, empty if it does not exist."""
+    try:
+        with os.scandir(file_type) as entries:
+            return {entry.name: entry.stat() for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return {}
+
+
+def check_size(entry: ExpectedFile, st: os.stat_result, record: dict | None) -> str | None:
+    """Check a downloaded file's size against the manifest's, else the one the source reported on download.
+
+    Returns:
+        Why the file failed, None if it passed
+
+    """
+    expected_size: int | None = entry.size
+    if expected_size is None and record is not None:
+        expected_size = record.get("expected_size")
+    if expected_size is not None and st.st_size != expected_size:
+        return f"size {st.st_size}, expected {expected_size}"
+    if expected_size is None and not st.st_size:
+        return "empty file"
+    return None
+
+
+def is_current(record: dict | None, st: os.stat_result) -> bool:
+    """Tell if a file is unchanged since its download record, by size and mtime."""
+    return record is not None and record.get("size") == st.st_size and record.get("mtime_ns") == st.st_mtime_ns
+
+
+def verify_digest(fpath: str, st: os.stat_result, record: dict | None, expected_md5: str | None) -> str | None:
+    """Verify a downloaded file against its expected md5, and the digest recorded as it downloaded.
+
+    Files unchanged since their download are verified with the digest recorded then. Files without
+    one, or changed since, are hashed.
 
     Args:
-        entry: Line from manifest file
-        t_idx: file_type position in entry as list
-        n_idx: file_name position in entry as list
+        fpath: Path of the file
+        st: Stat of the file
+        record: Download state record of the file, if any
+        expected_md5: md5, or multipart ETag, listed by the manifest, else the one the source reported
 
     Returns:
-        fpath: If file not found, return file path, else return boolean False
+        Why the file failed, None if it passed
 
     """
-    info: list[str] = entry.rstrip("\n").split("\t")
-    fpath: str = f"{info[t_idx]}/{info[n_idx]}"
-    if not Path(fpath).is_file():
-        return fpath
-    return False
+    if expected_md5 is None and record is not None:
+        expected_md5 = record.get("expected_md5")
+    if record is None and not expected_md5:
+        return None
+    current: bool = is_current(record, st)
+    if expected_md5:
+        expected_md5 = expected_md5.lower()
+        parts: str = expected_md5.partition("-")[2]
+        recorded: str | None = (record.get("etag") if parts else record.get("md5")) if current else None
+        if recorded == expected_md5:
+            return None
+        if not parts:
+            recorded = file_md5(fpath)
+            return f"md5 {recorded}, expected {expected_md5}" if recorded != expected_md5 else None
+        part_sizes: list[int] = etag_part_sizes(st.st_size, int(parts), record.get("part_size") if record else None)
+        if expected_md5 not in file_etags(fpath, part_sizes).values():
+            # an upload part size none of those tried, which the digest cannot be checked without
+            print(
+                f"WARN: {fpath} matches no multipart ETag {expected_md5} of part sizes tried, skipping its digest check",
+                file=sys.stderr,
+            )
+    elif not current and (record.get("md5") or record.get("etag")):
+        recorded = record.get("md5") or record.get("etag")
+        if file_md5(fpath, record.get("part_size")) != recorded:
+            return f"changed since its download, md5 no longer {recorded}"
+    return None
+
+
+def check_files(
+    expected: dict[str, dict[str, ExpectedFile]], state: DownloadState, size_only: bool
+) -> tuple[dict[str, str | None], dict[str, dict[str, int]]]:
+    """Check manifest files exist and are complete.
+
+    Args:
+        expected: Files the manifest lists, by file type and name
+        state: Sizes and digests of downloaded files
+        size_only: Only check file sizes, skipping digests
+
+    Returns:
+        Why each failed file failed by path, None if it is missing, and per file type counts of
+        files expected, missing, of the wrong size and failing digests
+
+    """
+    records: dict[str, dict] = state.all_records()
+    counts: dict[str, dict[str, int]] = {}
+    failed: dict[str, str | None] = {}
+    current: list[tuple[ExpectedFile, os.stat_result]] = []
+    to_hash: list[tuple[ExpectedFile, os.stat_result]] = []
+    for file_type in sorted(expected):
+        type_files: dict[str, ExpectedFile] = expected[file_type]
+        present: dict[str, os.stat_result] = scan_dir(file_type)
+        missing: set[str] = type_files.keys() - present.keys()
+        counts[file_type] = {"expected": len(type_files), "missing": len(missing), "size": 0, "digest": 0}
+        failed.update((type_files[name].path, None) for name in missing)
+        for name in type_files.keys() & present.keys():
+            entry: ExpectedFile = type_files[name]
+            st: os.stat_result = present[name]
+            record: dict | None = records.get(entry.path)
+            if reason := check_size(entry, st, record):
+                failed[entry.path] = reason
+                counts[file_type]["size"] += 1
+            elif size_only or (record is None and not entry.md5):
+                continue
+            elif is_current(record, st):
+                # verified with the digest recorded on download, without reading the file
+                current.append((entry, st))
+            else:
+                to_hash.append((entry, st))
+
+    def digest_failure(item: tuple[ExpectedFile, os.stat_result]) -> str | None:
+        entry, st = item
+        return verify_digest(entry.path, st, records.get(entry.path), entry.md5)
+
+    # only files without a current recorded digest are read, which is io bound
+    with concurrent.futures.ThreadPoolExecutor(16) as executor:
+        hashed = executor.map(digest_failure, to_hash)
+        for (entry, _st), reason in zip(current + to_hash, [*map(digest_failure, current), *hashed]):
+            if reason is not None:
+                failed[entry.path] = reason
+                counts[entry.file_type]["digest"] += 1
+    return failed, counts
 
 
 def run_py(args: argparse.Namespace) -> None:
@@ -41,24 +242,21 @@ def run_py(args: argparse.Namespace) -> None:
         None
 
     """
-    with open("missing_files.txt", "w") as missed, open(args.manifest_subset) as m:
-        head: str = next(m)
-        header: list[str] = head.rstrip("\n").split("\t")
-        t_idx: int = header.index("file_type")
-        n_idx: int = header.index("file_name")
-        missed_ct: int = 0
-        with concurrent.futures.ThreadPoolExecutor(16) as executor:
-            results = {
-                executor.submit(check_exists, file_info, t_idx, n_idx): file_info
-                for file_info in m
-            }
-            for result in concurrent.futures.as_completed(results):
-                if result.result():
-                    print(result.result(), file=missed)
-                    missed_ct += 1
-
-    if missed_ct:
-        print(f"Missed {missed_ct} files", file=sys.stderr)
+    state = DownloadState(read_only=True)
+    size_only: bool = getattr(args, "size_only", False)
+    failed, counts = check_files(read_manifest(args.manifest_subset), state, size_only)
+    with open("missing_files.txt", "w") as missed:
+        for fpath in sorted(failed):
+            print(fpath if failed[fpath] is None else f"{fpath}\t{failed[fpath]}", file=missed)
+    for file_type, type_counts in counts.items():
+        print(
+            f"{file_type}: {type_counts['expected']} expected, {type_counts['missing']} missing, "
+            f"{type_counts['size']} wrong size, {type_counts['digest']} failed md5",
+            file=sys.stderr,
+        )
+
+    if failed:
+        print(f"Missed {len(failed)} files, missing or incomplete", file=sys.stderr)
         sys.exit(1)
     else:
         print("Got em all! Good job Ash!", file=sys.stderr)
@@ -73,6 +271,12 @@ def main() -> None:
         action="store",
         help="tsv list of desired genomic files",
     )
+    parser.add_argument(
+        "--size-only",
+        action="store_true",
+        dest="size_only",
+        help="Only check file sizes, skipping md5s",
+    )
 
     args = parser.parse_args()
     run_py(args)
@@ -0,0 +1,154 @@
+"""Checkpoint records that let reruns skip ETL stages whose inputs and outputs are unchanged.
+
+Each successful stage writes a record to etl_checkpoints.json in the working dir holding a hash of
+its inputs (manifest rows, input file sizes/mtimes, config sections, CLI flags) and a hash of its
+outputs. A stage is skipped on rerun only if both hashes still match.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sys
+import time
+from threading import Lock
+from typing import Any, NamedTuple
+
+CHECKPOINT_FILE: str = "etl_checkpoints.json"
+
+
+class StageFingerprint(NamedTuple):
+    """Named tuple with the input hash of a stage and the paths it writes."""
+
+    inputs: str
+    outputs: tuple[str, ...]
+
+
+def hash_obj(obj: Any) -> str:
+    """Hash a json-serializable object, independent of dict key order."""
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def stat_paths(paths: list[str] | tuple[str, ...]) -> list[list]:
+    """Collect path, size and mtime of each file, walking dirs. Missing paths are listed as such."""
+    stats: list[list] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _dirs, files in os.walk(path):
+                for fname in sorted(files):
+                    fpath: str = os.path.join(root, fname)
+                    try:
+                        st = os.stat(fpath)
+                    except FileNotFoundError:
+                        continue
+                    stats.append([fpath, st.st_size, st.st_mtime_ns])
+        elif os.path.exists(path):
+            st = os.stat(path)
+            stats.append([path, st.st_size, st.st_mtime_ns])
+        else:
+            stats.append([path, None, None])
+    return stats
+
+
+def hash_paths(paths: list[str] | tuple[str, ...]) -> str:
+    """Hash the sizes and mtimes of files, walking dirs."""
+    return hash_obj(stat_paths(paths))
+
+
+def hash_file_content(path: str) -> str | None:
+    """Hash the content of a small file, like a manifest or config. None if it does not exist."""
+    if not path or not os.path.isfile(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_force(force: str | None) -> set[str]:
+    """Parse the csv string of stages given to --force."""
+    return {stage.strip() for stage in force.split(",") if stage.strip()} if force else set()
+
+
+class CheckpointStore:
+    """Read and write stage checkpoint records, safe to share across threads."""
+
+    def __init__(self, force: set[str] | None = None, path: str = CHECKPOINT_FILE) -> None:
+        """Initialize the store.
+
+        Args:
+            force: Stage names that must rerun regardless of their checkpoint, "all" to rerun everything
+            path: Checkpoint file location
+
+        """
+        self.force: set[str] = force or set()
+        self.path: str = path
+        self.lock = Lock()
+
+    def _load(self) -> dict[str, dict]:
+        """Read all records from the checkpoint file."""
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"WARN: {e} reading {self.path}, ignoring existing checkpoints", file=sys.stderr)
+            return {}
+
+    def _save(self, records: dict[str, dict]) -> None:
+        """Atomically replace the checkpoint file."""
+        tmp_path: str = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(records, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def is_forced(self, stage: str, group: str | None = None) -> bool:
+        """Check if a stage, or the group (step) it belongs to, was forced to rerun."""
+        return "all" in self.force or stage in self.force or (group is not None and group in self.force)
+
+    def is_current(self, stage: str, fingerprint: StageFingerprint, group: str | None = None) -> bool:
+        """Check if a stage completed before with the same inputs and its outputs are untouched since.
+
+        Args:
+            stage: Stage name
+            fingerprint: Current inputs hash and output paths of the stage
+            group: Step the stage belongs to, so that forcing a step forces all of its stages
+
+        """
+        if self.is_forced(stage, group):
+            return False
+        with self.lock:
+            record: dict | None = self._load().get(stage)
+        if record is None or record["inputs"] != fingerprint.inputs:
+            return False
+        if not all(os.path.exists(path) for path in fingerprint.outputs):
+            return False
+        return record["outputs"] == hash_paths(fingerprint.outputs)
+
+    def invalidate(self, stage: str) -> None:
+        """Drop the record of a stage that is about to rerun."""
+        with self.lock:
+            records: dict[str, dict] = self._load()
+            if records.pop(stage, None) is not None:
+                self._save(records)
+
+    def record(self, stage: str, fingerprint: StageFingerprint) -> None:
+        """Write the checkpoint of a stage that completed successfully.
+
+        Stages that write to the same paths, like a DGD append to a merged file, refresh the output
+        hash of every other record sharing those paths so that earlier stages stay current.
+        """
+        with self.lock:
+            records: dict[str, dict] = self._load()
+            records[stage] = {
+                "inputs": fingerprint.inputs,
+                "output_paths": list(fingerprint.outputs),
+                "completed": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            for other in records.values():
+                if set(other["output_paths"]) & set(fingerprint.outputs):
+                    other["outputs"] = hash_paths(other["output_paths"])
+            self._save(records)
@@ -216,52 +216,14 @@ def init_cbio_master(
         return collapse_and_format(fusion_data), desired
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Convert openPBTA fusion table OR list of annofuse files to cbio format."
-    )
-    parser.add_argument(
-        "-t",
-        "--table",
-        action="store",
-        dest="table",
-        help="Table with cbio project, kf bs ids, cbio IDs, and file names",
-        required=True,
-    )
-    parser.add_argument(
-        "-f",
-        "--fusion-results",
-        action="store",
-        dest="fusion_results",
-        help="annoFuse results dir OR openX merged fusion file",
-        required=True,
-    )
-    parser.add_argument(
-        "-o",
-        "--out-dir",
-        action="store",
-        dest="out_dir",
-        default="merged_fusion/",
-        help="Result output dir. Default is merged_fusion",
-    )
-    parser.add_argument(
-        "-m",
-        "--mode",
-        action="store",
-        dest="mode",
-        help="describe source, openX or kfprod or dgd",
-        required=True,
-    )
-    parser.add_argument(
-        "-a",
-        "--append",
-        action="store_true",
-        dest="append",
-        help="Flag to append, meaning print to STDOUT and skip header",
-        required=False,
-    )
+def run_py(args: argparse.Namespace, all_file_meta: pd.DataFrame | None = None) -> None:
+    """Run the script, likely a wrapper function call.
 
-    args = parser.parse_args()
+    Args:
+        args: Command line arguments
+        all_file_meta: Pre-parsed ETL table, read from args.table if not given
+
+    """
     if args.mode != "openX" and args.mode != "kfprod" and args.mode != "dgd":
         print(
             f"-m mode argument must be one of openX, kfprod, or dgd. It is case sensitive. You put {args.mode}",
@@ -278,7 +240,8 @@ def main():
     elif args.mode == "dgd":
         r_ext = "DGD_FUSION"
     # ensure sample name is imported as str
-    all_file_meta: pd.DataFrame = pd.read_csv(args.table, sep="\t", dtype={"cbio_sample_name": str})
+    if all_file_meta is None:
+        all_file_meta = pd.read_csv(args.table, sep="\t", dtype={"cbio_sample_name": str})
     # ext used in pbta vs openpedcan varies
     rna_subset: pd.DataFrame = all_file_meta.loc[all_file_meta["etl_file_type"] == r_ext]
     if rna_subset is None:
@@ -397,5 +360,56 @@ def main():
             )
 
 
+
+def main():
+    """Parse args and run script."""
+    parser = argparse.ArgumentParser(
+        description="Convert openPBTA fusion table OR list of annofuse files to cbio format."
+    )
+    parser.add_argument(
+        "-t",
+        "--table",
+        action="store",
+        dest="table",
+        help="Table with cbio project, kf bs ids, cbio IDs, and file names",
+        required=True,
+    )
+    parser.add_argument(
+        "-f",
+        "--fusion-results",
+        action="store",
+        dest="fusion_results",
+        help="annoFuse results dir OR openX merged fusion file",
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--out-dir",
+        action="store",
+        dest="out_dir",
+        default="merged_fusion/",
+        help="Result output dir. Default is merged_fusion",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        action="store",
+        dest="mode",
+        help="describe source, openX or kfprod or dgd",
+        required=True,
+    )
+    parser.add_argument(
+        "-a",
+        "--append",
+        action="store_true",
+        dest="append",
+        help="Flag to append, meaning print to STDOUT and skip header",
+        required=False,
+    )
+
+    args = parser.parse_args()
+    run_py(args)
+
+
 if __name__ == "__main__":
     main()
@@ -4,18 +4,19 @@
 Outputs files that are the foundation for incremental updates and clinical data QC
 """
 
+from __future__ import annotations
+
 import argparse
 import csv
 import glob
 import json
 import os
 import sys
-from typing import TypedDict
+from typing import TYPE_CHECKING, TypedDict
 from urllib.parse import urlparse
 
-import pandas as pd
-import requests
-import truststore
+if TYPE_CHECKING:
+    import requests
 
 
 class Config(TypedDict):
@@ -424,6 +425,8 @@ def compare_timeline_data(
         header_info: dict of headers by event type for output
 
     """
+    import pandas as pd
+
     event_type = current_timeline.keys()
     all_diff_ids: set[str] = set()
 
@@ -501,6 +504,9 @@ def generate_meta_files(config_file: str, data_dir: str) -> None:
 
 
 def run_py(args):
+    import requests
+    import truststore
+
     # Set Up URL pulling
     print("Processing data clinical info", file=sys.stderr)
     with open(args.token, "r") as token_file:
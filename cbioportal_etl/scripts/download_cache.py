@@ -0,0 +1,223 @@
+"""Download cache shared by the studies and runs pointed at the same dir, keyed by file ID and content hash.
+
+The same SBG file is often listed by several study manifests, like pbta_all and the per histology
+studies. Downloaded files are added to the cache as <cache dir>/<file_id>/<digest>, and later
+downloads of a file ID of the same size are linked from it into their file_type dir instead of
+fetched again. Links are reflinks where the filesystem supports them, else copies, never hardlinks,
+so a file written in place, in a study or the cache, never changes the other.
+The digest is the md5 of a file downloaded whole, or the multipart ETag and part size of one
+downloaded in ranges, so entries can be verified like any download. Entry names also hold the md5,
+or ETag, and version the source reported when the file was downloaded, and a file ID is only linked
+from an entry matching those the source reports now, so a file changed at the source since is
+downloaded again instead of linked stale.
+
+Least recently used file IDs are evicted once the cache grows over its size limit. Entries are
+added with an atomic rename, so runs of several studies can share a cache at once.
+"""
+
+from __future__ import annotations
+
+import fcntl
+import logging
+import os
+import shutil
+import threading
+from typing import NamedTuple
+from urllib.parse import quote, unquote
+
+# ioctl cloning a file into another sharing its blocks copy-on-write, on btrfs and xfs
+FICLONE: int = 0x40049409
+
+
+class CachedFile(NamedTuple):
+    """Named tuple with the path of a cached file and its digests."""
+
+    path: str
+    md5: str | None
+    etag: str | None
+    part_size: int | None
+    source_digest: str | None = None
+    version: str | None = None
+
+
+def digest_key(md5: str | None, etag: str | None, part_size: int | None) -> str:
+    """Name a cache entry by its md5, or by its multipart ETag and the part size it was computed with."""
+    return md5 if md5 else f"{etag}-{part_size}"
+
+
+def parse_digest_key(key: str) -> tuple[str | None, str | None, int | None]:
+    """Get the md5, or the multipart ETag and part size, a cache entry is named by."""
+    etag, sep, part_size = key.rpartition("-")
+    if sep and "-" in etag:
+        return None, etag, int(part_size)
+    return key, None, None
+
+
+def entry_name(
+    md5: str | None, etag: str | None, part_size: int | None, source_digest: str | None, version: str | None
+) -> str:
+    """Name a cache entry by its digest, and the digest and version the source reported for it."""
+    return "@".join(
+        [digest_key(md5, etag, part_size), quote(source_digest or "", safe=""), quote(version or "", safe="")]
+    )
+
+
+def parse_entry_name(name: str) -> CachedFile:
+    """Get the digests and version a cache entry is named by, with an empty path."""
+    key, _sep, source = name.partition("@")
+    source_digest, _sep, version = source.partition("@")
+    return CachedFile("", *parse_digest_key(key), unquote(source_digest) or None, unquote(version) or None)
+
+
+def link_file(src: str, dest: str) -> None:
+    """Link src to dest, replacing dest atomically, as a reflink, or a copy where the filesystem has none."""
+    # hidden, so it is never taken for a cache entry
+    tmp_path: str = os.path.join(
+        os.path.dirname(dest), f".{os.path.basename(dest)}.{os.getpid()}.{threading.get_ident()}.link"
+    )
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        with open(src, "rb") as fsrc, open(tmp_path, "wb") as fdest:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dest)
+
+
+class DownloadCache:
+    """Cache of downloaded files in a dir, safe to share across threads and processes."""
+
+    def __init__(self, root: str, max_bytes: int | None = None) -> None:
+        """Initialize the cache, creating its dir.
+
+        Args:
+            root: Cache dir
+            max_bytes: Size the cache is evicted down to, no limit if not given
+
+        """
+        self.root: str = os.path.abspath(root)
+        self.max_bytes: int | None = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def _file_dir(self, file_id: str) -> str:
+        """Get the dir of the cached files of a file ID, quoted as IDs like s3 paths hold slashes."""
+        return os.path.join(self.root, quote(file_id, safe=""))
+
+    def _entries(self, file_id: str) -> list[os.DirEntry]:
+        """List the cached files of a file ID, most recently added first."""
+        try:
+            entries: list[os.DirEntry] = [
+                entry for entry in os.scandir(self._file_dir(file_id)) if not entry.name.startswith(".")
+            ]
+        except FileNotFoundError:
+            return []
+        return sorted(entries, key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+
+    def fetch(
+        self,
+        file_id: str,
+        size: int,
+        dest: str,
+        expected_md5: str | None = None,
+        version: str | None = None,
+    ) -> CachedFile | None:
+        """Link a cached file of a file ID into dest, if one of the given size, digest and version is cached.
+
+        Args:
+            file_id: ID of the file at the source
+            size: Size the source reports for it
+            dest: Path to link it to
+            expected_md5: md5, or ETag, the source reports for it, an entry must match if given
+            version: Version the source reports for it, an entry must match if given
+
+        Returns:
+            The cached file linked, None on a miss
+
+        """
+        for entry in self._entries(file_id):
+            try:
+                cached: CachedFile = parse_entry_name(entry.name)
+                if version and cached.version != version:
+                    continue
+                if expected_md5 and expected_md5 not in (cached.md5, cached.etag, cached.source_digest):
+                    continue
+                if entry.stat().st_size != size:
+                    continue
+                link_file(entry.path, dest)
+                # the file ID dir mtime orders eviction, its files keep theirs
+                os.utime(os.path.dirname(entry.path))
+            except FileNotFoundError:
+                # evicted by another run meanwhile
+                continue
+            return cached._replace(path=entry.path)
+        return None
+
+    def store(
+        self,
+        file_id: str,
+        path: str,
+        md5: str | None,
+        etag: str | None,
+        part_size: int | None,
+        source_digest: str | None = None,
+        version: str | None = None,
+    ) -> None:
+        """Add a downloaded file to the cache, a failure only costs a later download.
+
+        Args:
+            file_id: ID of the file at the source
+            path: Path of the downloaded file
+            md5: md5 of a file downloaded whole
+            etag: Multipart ETag of a file downloaded in ranges
+            part_size: Range size the ETag was computed with
+            source_digest: md5, or ETag, the source reported for the file, if any
+            version: Version the source reported for the file, if any
+
+        """
+        if md5 and source_digest and "-" not in source_digest and md5 != source_digest:
+            # left for step 5 to fail, never linked into another study
+            logging.getLogger(__name__).warning("Not caching %s, its md5 differs from the source's", path)
+            return
+        try:
+            file_dir: str = self._file_dir(file_id)
+            os.makedirs(file_dir, exist_ok=True)
+            link_file(path, os.path.join(file_dir, entry_name(md5, etag, part_size, source_digest, version)))
+        except OSError as e:
+            logging.getLogger(__name__).warning("Could not cache %s: %s", path, e)
+
+    def evict(self) -> int:
+        """Remove the least recently used file IDs until the cache is under its size limit.
+
+        Returns:
+            Number of file IDs removed
+
+        """
+        if self.max_bytes is None:
+            return 0
+        file_dirs: list[tuple[int, int, str]] = []
+        total: int = 0
+        for file_dir in os.scandir(self.root):
+            if not file_dir.is_dir():
+                continue
+            try:
+                # entries hardlinked by earlier versions free nothing while a study still links them
+                size: int = sum(
+                    st.st_size for st in (entry.stat() for entry in os.scandir(file_dir.path)) if st.st_nlink == 1
+                )
+                file_dirs.append((file_dir.stat().st_mtime_ns, size, file_dir.path))
+            except FileNotFoundError:
+                continue
+            total += size
+        removed: int = 0
+        for _mtime, size, path in sorted(file_dirs):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        if removed:
+            logging.getLogger(__name__).info("Evicted %d file(s) from download cache %s", removed, self.root)
+        return removed
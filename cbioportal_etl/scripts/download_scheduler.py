@@ -0,0 +1,547 @@
+"""Run-wide download scheduler shared by every file type of a step 4 run.
+
+Files of all types go into one bounded priority queue, served by a fixed pool of worker threads.
+Small files come first so that many short downloads keep the workers busy early, while files
+larger than a range are split into byte ranges that are queued on their own, so a large file is
+spread over every idle worker instead of holding one. A per-host limit caps concurrent requests to
+any one server.
+
+Range size and the downloads in flight are tuned as transfers complete by a TransferTuner, which
+grows them while aggregate throughput keeps up and backs off when it drops or servers throttle. A
+file is queued as the byte spans left to fetch and split into ranges of the current size as workers
+take them. The parameters it settled on and its adjustments are added to the run report.
+
+Download URLs are resolved ahead of the workers by a few resolver threads, taking files in the order
+the workers will, so the API round trip of signing a URL is off the download path. At most a couple
+of files per worker are resolved ahead, so URLs are fresh when used. Sources with an API rate limit
+throttle their get_url with a RateLimiter.
+
+Files are downloaded to <name>.part and renamed into place once complete. The ranges of a large file
+done so far are journaled next to it, so a rerun after a failure only fetches the missing ones, and
+a small file picks up where its partial download ended. The journal names the size and version of
+the source, and a partial download of any other is discarded. Signed URLs refused as expired are
+signed anew with the file's get_url.
+
+Files are hashed as they are written, and with a DownloadState, their size and digest are recorded
+for step 5 to verify. With a DownloadCache, files already in it are linked into place instead of
+queued, and downloaded ones are added to it.
+
+Each file type completes, for consumers waiting on it, once all of its files were queued and
+every one of them is done.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable
+from typing import TYPE_CHECKING, NamedTuple
+from urllib.parse import urlparse
+
+import requests
+
+from cbioportal_etl.scripts import etl_trace
+from cbioportal_etl.scripts.download_state import multipart_etag
+from cbioportal_etl.scripts.download_tuner import TransferTuner
+from cbioportal_etl.scripts.url_download_helper import (
+    PART_SUFFIX,
+    ExpiredURLError,
+    download_range,
+    finish_part,
+    journal_range,
+    pooled_session,
+    read_journal,
+    small_download,
+)
+
+if TYPE_CHECKING:
+    from cbioportal_etl.scripts.download_cache import DownloadCache
+    from cbioportal_etl.scripts.download_state import DownloadState
+    from cbioportal_etl.scripts.get_files_from_manifest import DownloadTracker
+    from cbioportal_etl.scripts.run_report import RunReport
+
+DEFAULT_WORKERS: int = 16
+# Range size to start with, tuned from there in whole parts, the unit of multipart ETags, between
+# one and MAX_PARTS of them
+CHUNK_SIZE: int = 32 * 1024 * 1024
+PART_SIZE: int = 8 * 1024 * 1024
+MAX_PARTS: int = 16
+# Times a range is retried with a newly signed URL after its URL was refused
+URL_REFRESHES: int = 3
+# Threads resolving download URLs ahead of the workers, and files resolved ahead per worker
+RESOLVERS: int = 4
+LOOKAHEAD_PER_WORKER: int = 2
+
+
+class RateLimiter:
+    """Token bucket spacing out calls to an API with a rate limit, safe to share across threads."""
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        """Initialize the bucket full.
+
+        Args:
+            rate: Calls allowed per second
+            burst: Calls allowed at once after idling
+
+        """
+        self.rate: float = rate
+        self.burst: int = burst
+        self.tokens: float = burst
+        self.updated: float = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Wait until a call is allowed."""
+        with self.lock:
+            now: float = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait: float = -self.tokens / self.rate if self.tokens < 0 else 0
+        # the token is taken, later callers queue behind it
+        time.sleep(wait)
+
+
+class FileDownload:
+    """A file being downloaded, shared by the workers fetching its ranges."""
+
+    def __init__(
+        self,
+        file_id: str,
+        file_type: str,
+        path: str,
+        size: int,
+        get_url: Callable[[], str],
+        ranges: int,
+        expected_md5: str | None = None,
+        version: str | None = None,
+    ) -> None:
+        """Initialize a file with none of its ranges done.
+
+        Args:
+            file_id: ID of the file at the source
+            file_type: Type of the file, also the dir it is downloaded to
+            path: Output path
+            size: Size in bytes
+            get_url: Gets a download URL for the file, called once its first range starts and again if it expires
+            ranges: Number of byte spans left to fetch
+            expected_md5: md5, or ETag, the source reports for the file, if any
+            version: Version the source reports for the file, if any
+
+        """
+        self.file_id: str = file_id
+        self.file_type: str = file_type
+        self.path: str = path
+        self.part: str = path + PART_SUFFIX
+        self.size: int = size
+        self.expected_md5: str | None = expected_md5
+        self.version: str | None = version
+        self.get_url: Callable[[], str] = get_url
+        self.url: str | None = None
+        self.fd: int | None = None
+        self.pending: int = ranges
+        # resolved by a resolver thread, and taken by a worker
+        self.resolved_ahead: bool = False
+        self.started: bool = False
+        # md5 of a file downloaded whole, or of each part of one downloaded in ranges, by part start
+        self.md5: str | None = None
+        self.part_md5s: dict[int, str] = {}
+        self.failed: bool = False
+        # held only briefly, coroutines of the async engine take it too
+        self.lock = threading.Lock()
+        # held while resolving a URL, so a file is resolved once at a time without blocking on self.lock
+        self.url_lock = threading.Lock()
+
+
+class RangeWork(NamedTuple):
+    """Named tuple with a file and the inclusive byte range of it to fetch, the whole file if None."""
+
+    file: FileDownload
+    start: int | None = None
+    end: int | None = None
+
+
+class DownloadScheduler:
+    """Bounded pool of download workers taking the smallest queued work first."""
+
+    def __init__(
+        self,
+        tracker: DownloadTracker,
+        max_workers: int | None = None,
+        per_host: int | None = None,
+        chunk_size: int = CHUNK_SIZE,
+        state: DownloadState | None = None,
+        cache: DownloadCache | None = None,
+        report: RunReport | None = None,
+        part_size: int = PART_SIZE,
+    ) -> None:
+        """Start the workers, idle until files are submitted.
+
+        Args:
+            tracker: Tracker to record download outcomes and per file type completion on
+            max_workers: Most downloads, or ranges of a file, in flight at once, the tuner keeps fewer
+            per_host: Most downloads in flight to any one host, no limit beyond max_workers if not given
+            chunk_size: Range size to start with, files larger than the current one are fetched in ranges
+            state: State to record the size and digest of each downloaded file on
+            cache: Cache to link files from instead of downloading them, and to add downloads to
+            report: Run report to add the tuned transfer parameters to
+            part_size: Size of the parts ranges are made of and hashed in
+
+        """
+        self.tracker: DownloadTracker = tracker
+        self.max_workers: int = max_workers or DEFAULT_WORKERS
+        self.per_host: int = min(per_host or self.max_workers, self.max_workers)
+        self.part_size: int = part_size
+        self.tuner = TransferTuner(self.max_workers, part_size, max(1, chunk_size // part_size), MAX_PARTS)
+        self.state: DownloadState | None = state
+        self.cache: DownloadCache | None = cache
+        self.report: RunReport | None = report
+        self.started: float = time.time()
+        self.queue: queue.PriorityQueue[tuple[int, int, RangeWork | None]] = queue.PriorityQueue()
+        self.resolve_queue: queue.PriorityQueue[tuple[int, int, FileDownload | None]] = queue.PriorityQueue()
+        self.lookahead = threading.Semaphore(self.max_workers * LOOKAHEAD_PER_WORKER)
+        self.lock = threading.Lock()
+        self.host_slots: dict[str, threading.Semaphore] = {}
+        self.type_pending: defaultdict[str, int] = defaultdict(int)
+        self.finished_types: set[str] = set()
+        self._seq: int = 0
+        # one pool of keep-alive connections for every worker, sized to their number
+        self.session: requests.Session = pooled_session(self.max_workers)
+        self.workers: list[threading.Thread] = self._start_workers()
+        self.resolvers: list[threading.Thread] = [
+            threading.Thread(target=self._resolve_ahead, name=f"resolve-{i}", daemon=True) for i in range(RESOLVERS)
+        ]
+        for thread in self.resolvers:
+            thread.start()
+
+    def _start_workers(self) -> list[threading.Thread]:
+        """Start a thread per worker, each taking queued work until it gets a stop."""
+        workers: list[threading.Thread] = [
+            threading.Thread(target=self._work, name=f"download-{i}", daemon=True) for i in range(self.max_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def _put(self, priority: int, work: RangeWork | None) -> None:
+        """Queue work, first in first out among equal priorities."""
+        with self.lock:
+            self._seq += 1
+            seq: int = self._seq
+        self.queue.put((priority, seq, work))
+
+    def submit(
+        self,
+        file_id: str,
+        file_type: str,
+        path: str,
+        size: int,
+        get_url: Callable[[], str],
+        expected_md5: str | None = None,
+        version: str | None = None,
+    ) -> None:
+        """Queue a file to download.
+
+        Args:
+            file_id: ID of the file at the source
+            file_type: Type of the file, also the dir it is downloaded to
+            path: Output path
+            size: Size in bytes, used to order and split downloads
+            get_url: Gets a download URL for the file, like a freshly signed one
+            expected_md5: md5, or ETag, the source reports for the file, recorded for step 5 to verify
+            version: Version the source reports for the file, recorded for reruns to tell if it changed
+
+        """
+        if self.cache is not None and self._from_cache(file_id, path, size, expected_md5, version):
+            return
+        spans: list[tuple[int | None, int | None]] = [(None, None)]
+        # a partial download of another version of the file is discarded, whole or ranged
+        part_md5s: dict[int, str] = self._journaled_parts(path + PART_SUFFIX, size, version)
+        if size > self.tuner.range_size:
+            spans = self._missing_spans(part_md5s, size)
+            if part_md5s:
+                logging.getLogger(__name__).info(
+                    "Resuming %s, %d of %d bytes done", path, size - sum(end - start + 1 for start, end in spans), size
+                )
+        file = FileDownload(file_id, file_type, path, size, get_url, len(spans), expected_md5, version)
+        file.part_md5s = part_md5s
+        with self.lock:
+            self.type_pending[file_type] += 1
+        if not spans:
+            # every range was done by an earlier run
+            self._file_done(file)
+            return
+        with self.lock:
+            self._seq += 1
+            seq: int = self._seq
+        self.resolve_queue.put((size, seq, file))
+        for start, end in spans:
+            self._put(size, RangeWork(file, start, end))
+
+    def _journaled_parts(self, part_path: str, size: int, version: str | None = None) -> dict[int, str]:
+        """Get the md5 of each part of a partial download of the same version journaled as done, by part start."""
+        part_md5s: dict[int, str] = {}
+        for (start, end), md5s in read_journal(part_path, size, version).items():
+            part_starts: range = range(start, end + 1, self.part_size)
+            # ranges of another part size, like a run with other settings, are fetched again
+            whole_parts: bool = not start % self.part_size and (end + 1 == size or not (end + 1) % self.part_size)
+            if not whole_parts or len(md5s) != len(part_starts):
+                continue
+            part_md5s.update(zip(part_starts, md5s))
+        return part_md5s
+
+    def _missing_spans(self, part_md5s: dict[int, str], size: int) -> list[tuple[int, int]]:
+        """Get the inclusive byte spans of a file not covered by parts done, each a run of missing parts."""
+        spans: list[tuple[int, int]] = []
+        for start in range(0, size, self.part_size):
+            if start in part_md5s:
+                continue
+            end: int = min(start + self.part_size, size) - 1
+            if spans and spans[-1][1] + 1 == start:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+        return spans
+
+    def _from_cache(
+        self, file_id: str, path: str, size: int, expected_md5: str | None, version: str | None
+    ) -> bool:
+        """Link a file from the cache into place, if cached with the digest and version given. Return True if it was."""
+        try:
+            cached = self.cache.fetch(file_id, size, path, expected_md5, version)
+        except OSError as e:
+            logging.getLogger(__name__).warning("Could not link %s from the download cache: %s", path, e)
+            return False
+        if cached is None:
+            return False
+        logging.getLogger(__name__).info("Linked %s from the download cache", path)
+        if self.state is not None:
+            self.state.record(path, file_id, size, cached.md5, cached.etag, cached.part_size, expected_md5, version)
+        self.tracker.add_success(file_id, path)
+        return True
+
+    def finish_type(self, file_type: str) -> None:
+        """Note that every file of a type was submitted, completing the type once they are all done."""
+        with self.lock:
+            self.finished_types.add(file_type)
+            complete: bool = not self.type_pending[file_type]
+        if complete:
+            self.tracker.complete_type(file_type)
+
+    def wait(self) -> None:
+        """Block until every submitted file is done, then stop the workers."""
+        for _worker in range(self.max_workers):
+            # one stop per worker, queued behind every file as none is this large
+            self._put(2**63, None)
+        for worker in self.workers:
+            worker.join()
+        for _resolver in self.resolvers:
+            self.resolve_queue.put((2**63, 0, None))
+        for resolver in self.resolvers:
+            resolver.join()
+        self.session.close()
+        if self.report is not None:
+            self.report.add(
+                "step_4_transfers",
+                {"kind": "download", "status": "success", "started": self.started, **self.tuner.summary()},
+            )
+
+    def _resolve_ahead(self) -> None:
+        """Resolve download URLs of queued files before the workers get to them, until told to stop."""
+        logger = logging.getLogger(__name__)
+        while True:
+            _priority, _seq, file = self.resolve_queue.get()
+            if file is None:
+                return
+            # released once a worker takes the file
+            self.lookahead.acquire()
+            with file.url_lock:
+                with file.lock:
+                    skip: bool = file.started or file.failed or file.url is not None
+                if skip or self.tracker.cancelled.is_set():
+                    self.lookahead.release()
+                    continue
+                try:
+                    with etl_trace.span(f"{os.path.basename(file.path)} url", "download"):
+                        file.url = file.get_url()
+                except Exception as e:
+                    # the worker tries again, failing the file if it cannot
+                    logger.warning("Could not resolve a download URL for %s ahead: %s", file.path, e)
+                    self.lookahead.release()
+                    continue
+            with file.lock:
+                if file.started:
+                    # taken by a worker while resolving, which had nothing to release yet
+                    self.lookahead.release()
+                else:
+                    file.resolved_ahead = True
+
+    def _resolve_url(self, file: FileDownload, stale: str | None) -> None:
+        """Get a download URL for a file in place of stale, unless another range replaced it already."""
+        with file.url_lock:
+            if file.url == stale:
+                file.url = file.get_url()
+
+    def _host_slot(self, url: str) -> threading.Semaphore:
+        """Get the semaphore limiting concurrent requests to the host of a URL."""
+        host: str = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.Semaphore(self.per_host)
+            return self.host_slots[host]
+
+    def _work(self) -> None:
+        """Download queued work until told to stop."""
+        while True:
+            priority, _seq, work = self.queue.get()
+            if work is None:
+                return
+            self._fetch(self._split(priority, work))
+            self._work_done(work.file)
+
+    def _split(self, priority: int, work: RangeWork) -> RangeWork:
+        """Take a range of the current range size off the start of a span, queueing the rest back."""
+        range_size: int = self.tuner.range_size
+        if work.start is None or work.end - work.start < range_size:
+            return work
+        with work.file.lock:
+            work.file.pending += 1
+        self._put(priority, RangeWork(work.file, work.start + range_size, work.end))
+        return RangeWork(work.file, work.start, work.start + range_size - 1)
+
+    def _fetch(self, work: RangeWork) -> None:
+        """Download one range of a file, or all of it, failing the file on error."""
+        file: FileDownload = work.file
+        logger = logging.getLogger(__name__)
+        with file.lock:
+            if not file.started:
+                file.started = True
+                if file.resolved_ahead:
+                    self.lookahead.release()
+        if file.failed:
+            return
+        if self.tracker.cancelled.is_set():
+            self._fail(file, None)
+            return
+        try:
+            if file.url is None:
+                self._resolve_url(file, None)
+            if work.start is not None:
+                self._open_part(file)
+            for refresh in range(URL_REFRESHES + 1):
+                url: str = file.url
+                try:
+                    self._download(work, url)
+                    break
+                except ExpiredURLError:
+                    if refresh == URL_REFRESHES:
+                        raise
+                    logger.info("Download URL of %s expired, requesting a new one", file.path)
+                    # other ranges of the file may have signed a new one already
+                    self._resolve_url(file, url)
+        except Exception as e:
+            logger.exception("Failed to download %s", file.path)
+            self._fail(file, e)
+
+    def _open_part(self, file: FileDownload) -> None:
+        """Open the partial download of a file fetched in ranges, preallocated, unless a range did already."""
+        with file.lock:
+            if file.fd is None:
+                # kept as is, any ranges journaled in it are done
+                file.fd = os.open(file.part, os.O_WRONLY | os.O_CREAT, 0o644)
+                os.ftruncate(file.fd, file.size)
+
+    def _resume_offset(self, file: FileDownload) -> int:
+        """Get the bytes of a file downloaded whole to resume from, those of its partial download."""
+        offset: int = os.path.getsize(file.part) if os.path.exists(file.part) else 0
+        # cannot tell a complete one from one of a changed file, so start over
+        return offset if offset < file.size else 0
+
+    def _download(self, work: RangeWork, url: str) -> None:
+        """Download one range of a file, or all of it resuming its partial download, from url."""
+        file: FileDownload = work.file
+        name: str = os.path.basename(file.path)
+        with self.tuner.slot(), self._host_slot(url):
+            start: float = time.monotonic()
+            if work.start is None:
+                offset: int = self._resume_offset(file)
+                with etl_trace.span(name, "download", size=file.size, offset=offset):
+                    file.md5 = small_download(
+                        url, file.part, offset=offset, on_throttle=self.tuner.throttled, session=self.session
+                    )
+                self.tuner.record(file.size - offset, time.monotonic() - start, ranged=False)
+            else:
+                with etl_trace.span(f"{name} {work.start}-{work.end}", "download", size=file.size):
+                    md5s: list[str] = download_range(
+                        self.session,
+                        url,
+                        work.start,
+                        work.end,
+                        file.fd,
+                        part_size=self.part_size,
+                        on_throttle=self.tuner.throttled,
+                    )
+                self.tuner.record(work.end - work.start + 1, time.monotonic() - start, ranged=True)
+                with file.lock:
+                    file.part_md5s.update(zip(range(work.start, work.end + 1, self.part_size), md5s))
+                journal_range(file.part, work.start, work.end, md5s)
+
+    def _fail(self, file: FileDownload, error: Exception | None) -> None:
+        """Fail a file once, its remaining ranges are skipped."""
+        with file.lock:
+            if file.failed:
+                return
+            file.failed = True
+        if error is None:
+            # not attempted, like after a cancel
+            self.tracker.fail_type(file.file_type)
+        else:
+            self.tracker.add_failed(file.file_id, file.path, error)
+
+    def _work_done(self, file: FileDownload) -> None:
+        """Count a range of a file as done, completing the file and its type after the last one."""
+        with file.lock:
+            file.pending -= 1
+            if file.pending:
+                return
+            if file.fd is not None:
+                os.close(file.fd)
+                file.fd = None
+        self._file_done(file)
+
+    def _file_done(self, file: FileDownload) -> None:
+        """Move a complete file into place, leaving a failed one's partial download to resume, and count it done."""
+        if not file.failed:
+            try:
+                written: int = os.path.getsize(file.part)
+                if written != file.size:
+                    msg = f"Downloaded {written} bytes, expected {file.size}"
+                    raise ValueError(msg)
+                finish_part(file.part, file.path)
+                md5: str | None = file.md5
+                etag: str | None = None
+                part_size: int | None = None
+                if file.part_md5s:
+                    etag = multipart_etag([file.part_md5s[start] for start in range(0, file.size, self.part_size)])
+                    part_size = self.part_size
+                if self.state is not None:
+                    self.state.record(
+                        file.path, file.file_id, file.size, md5, etag, part_size, file.expected_md5, file.version
+                    )
+                if self.cache is not None:
+                    self.cache.store(
+                        file.file_id, file.path, md5, etag, part_size, file.expected_md5, file.version
+                    )
+                self.tracker.add_success(file.file_id, file.path)
+            except (OSError, ValueError) as e:
+                file.failed = True
+                self.tracker.add_failed(file.file_id, file.path, e)
+        with self.lock:
+            self.type_pending[file.file_type] -= 1
+            complete: bool = file.file_type in self.finished_types and not self.type_pending[file.file_type]
+        if complete:
+            self.tracker.complete_type(file.file_type)
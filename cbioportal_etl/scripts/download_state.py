@@ -0,0 +1,286 @@
+"""Size, version and digests of downloaded files, recorded as they are written so reruns and step 5 can use them.
+
+Every file downloaded by step 4 gets a record in the download_state.db SQLite database in the
+working dir, keyed by its file_type/file_name path. A record holds:
+- the source file ID and version, like the SBG modified time or S3 version ID or ETag
+- the size, and md5 or ETag if any, the source reported
+- the size and mtime written, and the digest of the file
+
+Whole file downloads are hashed with MD5 as their bytes stream in. Files fetched in ranges hash each
+part instead, combined like an S3 multipart ETag, md5 of the part md5s and their count, so neither
+takes a read pass of its own.
+
+A file changed since its record, by size or mtime, no longer matches its recorded digest. Reruns
+compare each manifest file to its record to download only the delta: files new to the manifest or
+missing locally, and files whose source ID, version or size changed or that were changed locally.
+Recorded files no longer in the manifest are reported as removed. Records of download_state.json,
+written by earlier versions, are imported into a new database.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import Counter
+from threading import Lock
+from typing import Any
+from urllib.parse import quote
+
+STATE_FILE: str = "download_state.db"
+# Written by earlier versions, imported once into a new database
+LEGACY_STATE_FILE: str = "download_state.json"
+# Record columns, after the path they are keyed by
+COLUMNS: tuple[str, ...] = (
+    "file_id",
+    "version",
+    "expected_size",
+    "size",
+    "mtime_ns",
+    "md5",
+    "etag",
+    "part_size",
+    "expected_md5",
+    "downloaded_at",
+)
+# Classes of manifest files against their records
+NEW: str = "new"
+CHANGED: str = "changed"
+UNCHANGED: str = "unchanged"
+REMOVED: str = "removed"
+
+
+def multipart_etag(range_md5s: list[str]) -> str:
+    """Combine the md5 hex digests of consecutive ranges of a file like an S3 multipart ETag."""
+    combined = hashlib.md5(b"".join(bytes.fromhex(md5) for md5 in range_md5s))  # noqa: S324
+    return f"{combined.hexdigest()}-{len(range_md5s)}"
+
+
+def file_md5(path: str, part_size: int | None = None) -> str:
+    """Hash a file on disk, as one md5 or as a multipart ETag of part_size ranges if given."""
+    whole = hashlib.md5()  # noqa: S324
+    parts: list[str] = []
+    with open(path, "rb") as f:
+        while chunk := f.read(part_size or 1024 * 1024):
+            if part_size:
+                parts.append(hashlib.md5(chunk).hexdigest())  # noqa: S324
+            else:
+                whole.update(chunk)
+    return multipart_etag(parts) if part_size else whole.hexdigest()
+
+
+class DownloadState:
+    """Read and write download records, safe to share across threads."""
+
+    def __init__(self, path: str = STATE_FILE, read_only: bool = False) -> None:
+        """Open the state database, creating it with the records of download_state.json if there are any.
+
+        Args:
+            path: State database location
+            read_only: Open it without writing to it, like to check downloads. Without a database, its
+                records are only imported into memory
+
+        """
+        self.path: str = path
+        self.lock = Lock()
+        self.counts: Counter[str] = Counter()
+        new: bool = not os.path.isfile(path)
+        if read_only and not new:
+            uri: str = f"file:{quote(os.path.abspath(path))}?mode=ro"
+            self.db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            # shared by the download threads, the lock serializes its use
+            self.db = sqlite3.connect(":memory:" if read_only else path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        if read_only and not new:
+            return
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS downloads (path TEXT PRIMARY KEY, {', '.join(COLUMNS)})"  # noqa: S608
+        )
+        if new:
+            self._import_legacy(os.path.join(os.path.dirname(path), LEGACY_STATE_FILE))
+
+    def _import_legacy(self, legacy_path: str) -> None:
+        """Import the records of a download_state.json of an earlier version, if there is one."""
+        if not os.path.isfile(legacy_path):
+            return
+        try:
+            with open(legacy_path) as f:
+                records: dict[str, dict[str, Any]] = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"WARN: {e} reading {legacy_path}, ignoring recorded downloads", file=sys.stderr)
+            return
+        with self.lock, self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO downloads VALUES (?, {', '.join('?' * len(COLUMNS))})",  # noqa: S608
+                [(path, *(record.get(column) for column in COLUMNS)) for path, record in records.items()],
+            )
+
+    def _write(self, path: str, record: dict[str, Any]) -> None:
+        """Replace the record of a file. Call with the lock held, in a transaction."""
+        self.db.execute(
+            f"INSERT OR REPLACE INTO downloads VALUES (?, {', '.join('?' * len(COLUMNS))})",  # noqa: S608
+            (path, *(record.get(column) for column in COLUMNS)),
+        )
+
+    def get(self, path: str) -> dict[str, Any] | None:
+        """Get the record of a file, None if it has none."""
+        with self.lock:
+            row: sqlite3.Row | None = self.db.execute("SELECT * FROM downloads WHERE path = ?", (path,)).fetchone()
+        return {column: row[column] for column in COLUMNS} if row is not None else None
+
+    def all_records(self) -> dict[str, dict[str, Any]]:
+        """Get every record, by path, in one query."""
+        with self.lock:
+            rows: list[sqlite3.Row] = self.db.execute("SELECT * FROM downloads").fetchall()
+        return {row["path"]: {column: row[column] for column in COLUMNS} for row in rows}
+
+    def classify(self, path: str, file_id: str, size: int | None, version: str | None = None) -> str:
+        """Compare a manifest file to its record and the file on disk, and count it by class.
+
+        Args:
+            path: Path the file is downloaded to
+            file_id: ID of the file at the source
+            size: Size the source reports
+            version: Version the source reports, like a modified time or S3 version ID
+
+        Returns:
+            NEW if it is not on disk, CHANGED if the source or the local file changed since it was
+            recorded, else UNCHANGED. Files on disk without a record, downloaded before records
+            were kept, are unchanged if their size matches.
+
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            status: str = NEW
+        else:
+            record: dict[str, Any] | None = self.get(path)
+            if record is None:
+                same: bool = size is None or st.st_size == size
+            elif record["size"] is None:
+                # only expected so far, kept from before records were kept
+                same = record["file_id"] == file_id and (size is None or st.st_size == size)
+            else:
+                same = (
+                    record["file_id"] == file_id
+                    and (size is None or record["expected_size"] == size)
+                    and (version is None or record["version"] in (None, version))
+                    and (record["size"], record["mtime_ns"]) == (st.st_size, st.st_mtime_ns)
+                )
+            status = UNCHANGED if same else CHANGED
+        with self.lock:
+            self.counts[status] += 1
+        return status
+
+    def expect(
+        self, path: str, file_id: str, size: int | None, md5: str | None = None, version: str | None = None
+    ) -> None:
+        """Record the source ID, size, md5, or ETag, and version of a file, like one kept from an earlier run."""
+        with self.lock, self.db:
+            row: sqlite3.Row | None = self.db.execute("SELECT * FROM downloads WHERE path = ?", (path,)).fetchone()
+            record: dict[str, Any] = {column: row[column] for column in COLUMNS} if row is not None else {}
+            record["file_id"] = file_id
+            record["expected_size"] = size
+            if md5 is not None:
+                record["expected_md5"] = md5
+            if version is not None:
+                record["version"] = version
+            self._write(path, record)
+
+    def record(
+        self,
+        path: str,
+        file_id: str,
+        size: int,
+        md5: str | None = None,
+        etag: str | None = None,
+        part_size: int | None = None,
+        expected_md5: str | None = None,
+        version: str | None = None,
+    ) -> None:
+        """Record a file downloaded to path, with its md5, or ETag of part_size ranges, as streamed.
+
+        Args:
+            path: Path of the downloaded file
+            file_id: ID of the file at the source
+            size: Size reported by the source
+            md5: md5 of a file downloaded whole
+            etag: Multipart ETag of a file downloaded in ranges
+            part_size: Range size the ETag was computed with
+            expected_md5: md5, or ETag, reported by the source
+            version: Version reported by the source
+
+        """
+        st = os.stat(path)
+        with self.lock, self.db:
+            self._write(
+                path,
+                {
+                    "file_id": file_id,
+                    "version": version,
+                    "expected_size": size,
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "md5": md5,
+                    "etag": etag,
+                    "part_size": part_size,
+                    "expected_md5": expected_md5,
+                    "downloaded_at": time.time(),
+                },
+            )
+
+    def copy_records(self, source: DownloadState, paths: list[str]) -> int:
+        """Copy the records of files from another state, like that of a download whose files were linked here.
+
+        Paths are relative, so records copy as is to a working dir the same files were linked into.
+
+        Args:
+            source: State the files were recorded in
+            paths: Paths of the files
+
+        Returns:
+            Number of records copied, paths source has none for are skipped
+
+        """
+        records: dict[str, dict[str, Any]] = source.all_records()
+        copied: list[str] = [path for path in paths if path in records]
+        with self.lock, self.db:
+            for path in copied:
+                self._write(path, records[path])
+        return len(copied)
+
+    def removed(self, paths: set[str], file_types: list[str]) -> list[str]:
+        """List recorded files of the given types not among paths, like those dropped from the manifest.
+
+        Args:
+            paths: Paths of every file of the manifest
+            file_types: Types, the dirs files are downloaded to, to look for removed files in
+
+        Returns:
+            Paths of the removed files, sorted
+
+        """
+        with self.lock:
+            recorded: list[str] = [row["path"] for row in self.db.execute("SELECT path FROM downloads")]
+        removed: list[str] = sorted(
+            path for path in recorded if path not in paths and os.path.dirname(path) in file_types
+        )
+        with self.lock:
+            self.counts[REMOVED] += len(removed)
+        return removed
+
+    def forget(self, paths: list[str]) -> None:
+        """Drop the records of files."""
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM downloads WHERE path = ?", [(path,) for path in paths])
+
+    def save(self) -> None:
+        """Flush the records to the database file, each is committed as written."""
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(PASSIVE)")
@@ -0,0 +1,258 @@
+"""Adaptive range size and concurrency of the download scheduler, tuned AIMD style as transfers complete.
+
+Concurrency is a window of transfers allowed in flight, below the worker count. While the window is
+full, it is probed one transfer larger at a time. Each probe is judged on the throughput of the
+interval after it against the baseline measured just before it, so every comparison is between
+windows one transfer apart. A probe is kept if the added transfer brought at least half the
+throughput of a connection of the baseline. Otherwise the window steps back by one and holds for
+a few intervals, since more transfers no longer pay off, before probing again from a new
+baseline. A drop in throughput, like a passing dip, at most undoes one probe. Only when a server
+throttles with a 429 or 503, or a request fails to connect or times out, is the window halved.
+
+Range size grows while ranges finish too fast for their request overhead to amortize and shrinks
+when they take long enough that a failure costs much to redo or that a few large ranges leave
+workers idle at the end of a file. Ranges are whole parts, so digests of files fetched in ranges
+of changing size still combine into one multipart ETag of the part size.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any
+
+# Seconds of transfers each throughput comparison covers
+INTERVAL: float = 2.0
+# Share of a baseline connection's throughput a probe's added transfer must bring to be kept
+PROBE_GAIN: float = 0.5
+# Intervals the window holds after a probe did not pay off, or after throttling
+SETTLE_INTERVALS: int = 5
+# Window kept after throttling or a failed request
+THROTTLE_DECREASE: float = 0.5
+# Ranges finishing faster than this double in size, slower than that halve
+RANGE_MIN_SECONDS: float = 1.0
+RANGE_MAX_SECONDS: float = 15.0
+# Adjustments kept for the run report
+HISTORY: int = 100
+
+
+def wake(waiter: asyncio.Future[None]) -> None:
+    """Wake a coroutine waiting for a slot, on its loop, unless it gave up waiting."""
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class TransferTuner:
+    """AIMD controller of the range size and concurrency of downloads, safe to share across threads."""
+
+    def __init__(
+        self, max_concurrency: int, part_size: int, initial_parts: int = 4, max_parts: int = 16
+    ) -> None:
+        """Start at half the concurrency allowed, and ranges of initial_parts parts.
+
+        Args:
+            max_concurrency: Most transfers in flight at once, the worker count
+            part_size: Bytes ranges are a whole number of
+            initial_parts: Parts per range to start with
+            max_parts: Most parts per range
+
+        """
+        self.max_concurrency: int = max_concurrency
+        self.part_size: int = part_size
+        self.max_parts: int = max_parts
+        self.parts: int = max(1, min(initial_parts, max_parts))
+        self.window: float = max(1, max_concurrency // 2)
+        self.in_flight: int = 0
+        self.condition = threading.Condition()
+        # futures of coroutines waiting for a slot, with their loops, as they cannot wait on the condition
+        self.async_waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future[None]]] = deque()
+        self.started: float = time.time()
+        # transfers and throughput of the current interval
+        self.interval_start: float = time.monotonic()
+        self.interval_bytes: int = 0
+        self.saturated: bool = False
+        self.throttled_in_interval: bool = False
+        # throughput and window of the interval before the probe in progress, if any
+        self.baseline: tuple[float, float] | None = None
+        self.settle: int = 0
+        self.peak_throughput: float = 0
+        self.total_bytes: int = 0
+        self.throttles: int = 0
+        self.history: list[dict[str, Any]] = []
+
+    @property
+    def range_size(self) -> int:
+        """Bytes of a range to fetch now."""
+        return self.parts * self.part_size
+
+    @property
+    def concurrency(self) -> int:
+        """Transfers allowed in flight now."""
+        return int(self.window)
+
+    def _take_slot(self) -> bool:
+        """Take a transfer slot if one is free. Call with the condition held."""
+        if self.in_flight >= self.concurrency:
+            self.saturated = True
+            return False
+        self.in_flight += 1
+        if self.in_flight >= self.concurrency:
+            self.saturated = True
+        return True
+
+    def _wake_async(self, count: int | None = None) -> None:
+        """Wake count coroutines waiting for a slot, all if None, on their loops. Call with the condition held."""
+        while self.async_waiters and (count is None or count > 0):
+            loop, waiter = self.async_waiters.popleft()
+            loop.call_soon_threadsafe(wake, waiter)
+            if count is not None:
+                count -= 1
+
+    def _release_slot(self) -> None:
+        """Free a transfer slot."""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+            self._wake_async(1)
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Hold one of the transfers allowed in flight, waiting for one to free up."""
+        with self.condition:
+            while not self._take_slot():
+                self.condition.wait()
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+    @asynccontextmanager
+    async def async_slot(self) -> AsyncIterator[None]:
+        """Hold one of the transfers allowed in flight from a coroutine, without blocking its event loop."""
+        while True:
+            with self.condition:
+                if self._take_slot():
+                    break
+                loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+                waiter: asyncio.Future[None] = loop.create_future()
+                entry = (loop, waiter)
+                self.async_waiters.append(entry)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self.condition:
+                    if entry in self.async_waiters:
+                        self.async_waiters.remove(entry)
+                    else:
+                        # woken already, pass the freed slot on
+                        self._wake_async(1)
+                raise
+        try:
+            yield
+        finally:
+            self._release_slot()
+
+    def _log(self, reason: str, throughput: float | None) -> None:
+        """Note an adjustment, for the run report. Call with the condition held."""
+        self.history.append(
+            {
+                "at_s": round(time.time() - self.started, 1),
+                "reason": reason,
+                "concurrency": self.concurrency,
+                "range_size": self.range_size,
+                "throughput_mib_s": round(throughput / (1024 * 1024), 2) if throughput is not None else None,
+            }
+        )
+        del self.history[:-HISTORY]
+        logging.getLogger(__name__).debug("Download tuning, %s: %s", reason, self.history[-1])
+
+    def _set_window(self, window: float) -> None:
+        """Resize the window, waking transfers waiting on a grown one. Call with the condition held."""
+        self.window = min(float(self.max_concurrency), max(1.0, window))
+        self.condition.notify_all()
+        self._wake_async()
+
+    def throttled(self) -> None:
+        """Back off after a server throttled, failed or timed out a request, once per interval."""
+        with self.condition:
+            self.throttles += 1
+            if self.throttled_in_interval:
+                return
+            self.throttled_in_interval = True
+            self._set_window(self.window * THROTTLE_DECREASE)
+            self.baseline = None
+            self.settle = SETTLE_INTERVALS
+            self._log("throttled", None)
+
+    def record(self, nbytes: int, seconds: float, ranged: bool) -> None:
+        """Account a finished transfer, adjusting range size and, once an interval passed, concurrency.
+
+        Args:
+            nbytes: Bytes transferred
+            seconds: Time the transfer took
+            ranged: Whether it was one range of a larger file
+
+        """
+        with self.condition:
+            self.interval_bytes += nbytes
+            self.total_bytes += nbytes
+            if ranged and seconds < RANGE_MIN_SECONDS and self.parts < self.max_parts:
+                self.parts = min(self.max_parts, self.parts * 2)
+                self._log("fast ranges", nbytes / seconds if seconds else None)
+            elif ranged and seconds > RANGE_MAX_SECONDS and self.parts > 1:
+                self.parts //= 2
+                self._log("slow ranges", nbytes / seconds)
+            elapsed: float = time.monotonic() - self.interval_start
+            if elapsed < INTERVAL:
+                return
+            throughput: float = self.interval_bytes / elapsed
+            self.peak_throughput = max(self.peak_throughput, throughput)
+            if self.throttled_in_interval:
+                pass
+            elif self.baseline is not None:
+                base_throughput, base_window = self.baseline
+                added: float = self.window - base_window
+                if throughput - base_throughput >= PROBE_GAIN * added * base_throughput / base_window:
+                    self.baseline = None
+                    self._log("probe paid off", throughput)
+                else:
+                    self._set_window(base_window)
+                    self.baseline = None
+                    self.settle = SETTLE_INTERVALS
+                    self._log("probe did not pay off", throughput)
+            elif self.settle:
+                self.settle -= 1
+            if (
+                self.baseline is None
+                and not self.settle
+                and not self.throttled_in_interval
+                and self.saturated
+                and self.concurrency < self.max_concurrency
+            ):
+                self.baseline = (throughput, self.window)
+                self._set_window(self.window + 1)
+            self.interval_start = time.monotonic()
+            self.interval_bytes = 0
+            self.saturated = self.in_flight >= self.concurrency
+            self.throttled_in_interval = False
+
+    def summary(self) -> dict[str, Any]:
+        """Get the parameters chosen and the adjustments made, for the run report."""
+        with self.condition:
+            elapsed: float = time.time() - self.started
+            return {
+                "concurrency": self.concurrency,
+                "max_concurrency": self.max_concurrency,
+                "range_size": self.range_size,
+                "part_size": self.part_size,
+                "bytes": self.total_bytes,
+                "mean_throughput_mib_s": round(self.total_bytes / elapsed / (1024 * 1024), 2) if elapsed else None,
+                "peak_throughput_mib_s": round(self.peak_throughput / (1024 * 1024), 2),
+                "throttles": self.throttles,
+                "adjustments": list(self.history),
+            }
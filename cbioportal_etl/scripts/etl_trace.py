@@ -0,0 +1,224 @@
+"""Timeline of an ETL run in Chrome Trace Event format, viewable in Perfetto or chrome://tracing.
+
+Tracing is switched on for a whole process tree by the CBIO_ETL_TRACE environment variable, set to
+a dir every traced process appends its events to, one JSON line per event in a <pid>.jsonl file.
+Forked jobs, subprocess jobs and pool workers inherit it, so steps, downloads, merge jobs and the
+tasks of their worker pools all end up on one timeline, merged into a single trace file at the end.
+Each event is one O_APPEND write, so threads and forked children need no lock. Spans of coroutines,
+many of which overlap on one thread, are recorded as async events, each on a track of its own.
+
+When tracing is off, spans only cost an environment lookup.
+"""
+
+from __future__ import annotations
+
+import itertools
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections.abc import AsyncIterator, Callable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any
+
+TRACE_ENV: str = "CBIO_ETL_TRACE"
+TRACE_FILE: str = "etl_trace.json"
+
+# pid labelled by name_process, a forked child has a pid of its own to label
+_named_pid: int | None = None
+# ids pairing the begin and end of async events, unique within a process
+_async_ids = itertools.count(1)
+
+
+def is_tracing() -> bool:
+    """Check if this process records trace events."""
+    return bool(os.environ.get(TRACE_ENV))
+
+
+def _write(event: dict[str, Any]) -> None:
+    """Append an event to the events file of this process."""
+    events_dir: str | None = os.environ.get(TRACE_ENV)
+    if not events_dir:
+        return
+    try:
+        events_file: str = os.path.join(events_dir, f"{os.getpid()}.jsonl")
+        fd: int = os.open(events_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, (json.dumps(event) + "\n").encode())
+        finally:
+            os.close(fd)
+    except OSError as e:
+        # a trace is never worth failing the run over
+        print(f"WARN: {e} writing trace event {event['name']}", file=sys.stderr)
+
+
+def add_event(
+    name: str,
+    cat: str,
+    start: float,
+    duration: float,
+    args: dict[str, Any] | None = None,
+    pid: int | None = None,
+    tid: int | None = None,
+) -> None:
+    """Record a complete event.
+
+    Args:
+        name: Event name shown on the timeline
+        cat: Event category, like step, download, job or task
+        start: Start as seconds since the epoch, so events of all processes line up
+        duration: Duration in seconds
+        args: Details shown when the event is selected
+        pid: Process the event belongs to, this one if not given
+        tid: Thread the event belongs to, the calling thread if not given
+
+    """
+    if not is_tracing():
+        return
+    event: dict[str, Any] = {
+        "name": name,
+        "cat": cat,
+        "ph": "X",
+        "ts": round(start * 1e6),
+        "dur": round(duration * 1e6),
+        "pid": pid or os.getpid(),
+        "tid": tid or threading.get_native_id(),
+    }
+    if args:
+        event["args"] = args
+    _write(event)
+
+
+def name_process(name: str, pid: int | None = None) -> None:
+    """Label a process on the timeline, this one once if no pid is given."""
+    global _named_pid
+    if not is_tracing():
+        return
+    if pid is None:
+        if _named_pid == os.getpid():
+            return
+        _named_pid = pid = os.getpid()
+    _write({"name": "process_name", "ph": "M", "pid": pid, "tid": pid, "args": {"name": name}})
+
+
+@contextmanager
+def span(name: str, cat: str, **args: Any) -> Iterator[None]:
+    """Record the time spent in a block as an event of the calling thread.
+
+    Args:
+        name: Event name shown on the timeline
+        cat: Event category, like step, download, job or task
+        args: Details shown when the event is selected
+
+    """
+    if not is_tracing():
+        yield
+        return
+    started: float = time.time()
+    start: float = time.monotonic()
+    try:
+        yield
+    except BaseException as e:
+        args["error"] = repr(e)
+        raise
+    finally:
+        add_event(name, cat, started, time.monotonic() - start, args)
+
+
+@asynccontextmanager
+async def async_span(name: str, cat: str, **args: Any) -> AsyncIterator[None]:
+    """Record the time spent in a block of a coroutine as an async event, apart from others on its thread.
+
+    Args:
+        name: Event name shown on the timeline
+        cat: Event category, like step, download, job or task
+        args: Details shown when the event is selected
+
+    """
+    if not is_tracing():
+        yield
+        return
+    event: dict[str, Any] = {
+        "name": name,
+        "cat": cat,
+        "id": f"{os.getpid()}.{next(_async_ids)}",
+        "pid": os.getpid(),
+        "tid": threading.get_native_id(),
+    }
+    _write({**event, "ph": "b", "ts": round(time.time() * 1e6), **({"args": args} if args else {})})
+    try:
+        yield
+    except BaseException as e:
+        event["args"] = {"error": repr(e)}
+        raise
+    finally:
+        _write({**event, "ph": "e", "ts": round(time.time() * 1e6)})
+
+
+def run_traced(name: str, cat: str, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Call func in a span. Top level, so it can be submitted to process pools in place of func."""
+    name_process(f"{func.__module__.rsplit('.', 1)[-1]} worker")
+    with span(name, cat):
+        return func(*args, **kwargs)
+
+
+def merge_events(events_dir: str, path: str) -> int:
+    """Merge the event files of every traced process into one trace file.
+
+    Args:
+        events_dir: Dir of <pid>.jsonl event files
+        path: Trace file to write
+
+    Returns:
+        Number of events written
+
+    """
+    events: list[dict[str, Any]] = []
+    for entry in os.scandir(events_dir):
+        if not entry.name.endswith(".jsonl"):
+            continue
+        with open(entry.path) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # cut short by a killed process
+                    continue
+    # metadata first, then in time order
+    events.sort(key=lambda event: (event["ph"] != "M", event.get("ts", 0), event["pid"]))
+    tmp_path: str = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    os.replace(tmp_path, path)
+    return len(events)
+
+
+@contextmanager
+def tracing(path: str | None, process_name: str = "cbio-etl") -> Iterator[None]:
+    """Trace this process and everything it starts within a block, then write the trace to path.
+
+    Does nothing if path is not given, or if an outer block, maybe of a parent process, is already
+    tracing, as that one writes the trace.
+
+    Args:
+        path: Trace file to write
+        process_name: Label of this process on the timeline
+
+    """
+    if not path or is_tracing():
+        yield
+        return
+    events_dir: str = os.path.abspath(f"{path}.events")
+    shutil.rmtree(events_dir, ignore_errors=True)
+    os.makedirs(events_dir)
+    os.environ[TRACE_ENV] = events_dir
+    name_process(process_name)
+    try:
+        yield
+    finally:
+        del os.environ[TRACE_ENV]
+        count: int = merge_events(events_dir, path)
+        shutil.rmtree(events_dir, ignore_errors=True)
+        print(f"Wrote {count} trace events to {path}, open it in https://ui.perfetto.dev", file=sys.stderr)
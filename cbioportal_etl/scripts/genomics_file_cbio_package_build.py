@@ -10,52 +10,61 @@ import argparse
 import csv
 import json
 import os
+import re
 import subprocess
 import sys
-import time
+from collections.abc import Callable
 from functools import partial
-
+from typing import TYPE_CHECKING
+
+from cbioportal_etl.scripts import etl_trace
+from cbioportal_etl.scripts.checkpoint import (
+    CheckpointStore,
+    StageFingerprint,
+    hash_obj,
+    parse_force,
+    stat_paths,
+)
+from cbioportal_etl.scripts.job_scheduler import JobScheduler, PyEntry
 from cbioportal_etl.scripts.resolve_config_paths import resolve_config_paths
-
-
-def log_cmd(cmd):
-    """Print output commands run to stderr."""
-    print(cmd, file=sys.stderr)
-    sys.stderr.flush()
-
-
-def check_status(status, data_type, run_status):
-    if status:
-        print(
-            f"Something went wrong while processing the {data_type} shutting down other running procs",
-            file=sys.stderr,
-        )
-        for key in run_status:
-            if run_status[key] is None:
-                run_status[key].kill()
-        sys.exit(1)
-    else:
-        sys.stderr.write("Processing " + data_type + " successful!\n")
-        sys.stderr.flush()
+from cbioportal_etl.scripts.resource_budget import JobResources, ResourceBudget, parse_memory
+from cbioportal_etl.scripts.run_report import RunReport
+from cbioportal_etl.scripts.stage_profiler import parse_profile_stages
+
+if TYPE_CHECKING:
+    from cbioportal_etl.scripts.get_files_from_manifest import DownloadTracker
+
+# etl_file_type values of the manifest rows each job reads
+JOB_ETL_FILE_TYPES: dict[str, tuple[str, ...]] = {
+    "mafs": ("maf",),
+    "dgd_maf": ("DGD_MAF",),
+    "rsem": ("rsem",),
+    "fusion": ("fusion",),
+    "dgd_fusion": ("DGD_FUSION",),
+    "cnvs": ("cnv", "seg", "info"),
+    "load_package": (),
+}
+# Rough memory estimate of a job: a fixed cost per process plus a multiple of its (compressed) input size
+PROCESS_MEMORY: int = 256 * 1024**2
+MEMORY_PER_INPUT_BYTE: int = 8
 
 
 def process_maf(
     maf_loc_dict: dict[str, str | list[str]],
     cbio_id_table: str,
     data_config_file: str,
-    dgd_status: str,
     script_dir: str,
-    run_status: dict[str, subprocess.Popen],
-) -> None:
-    """Collate and process pbta/kf style mafs. Call append if also adding dgd data.
+) -> tuple[str, PyEntry] | None:
+    """Collate and process pbta/kf style mafs.
 
     Args:
         maf_loc_dict: Config dict entry with dbt file_type names and file header location
         cbio_id_table: Path of ETL table with IDs and file locations
         data_config_file: Path of file with ETL reference locations
-        dgd_status: values of kf, both, and dgd to determine whether to append data or not
         script_dir: path of dir containing ETL processing scripts
-        run_status: Dict to track subprocess call statuses
+
+    Returns:
+        Command to run the maf merge script and its in-process equivalent, None if no maf types are defined in the config
 
     """
     print("Processing maf files", file=sys.stderr)
@@ -67,9 +76,13 @@ def process_maf(
         if not maf_dir:
             print(f"Skipping {maf_type} as it is not defined in the config", file=sys.stderr)
             continue
+        # maf_merge collates every maf type in the manifest at once, so one run covers all of them
         maf_cmd = f"python3 {os.path.join(script_dir, 'maf_merge.py')} -t {cbio_id_table} -i {maf_header} -j {data_config_file} 2> collate_mafs.log"
-        log_cmd(maf_cmd)
-        run_status["maf"] = subprocess.Popen(maf_cmd, shell=True)
+        maf_args = argparse.Namespace(
+            table=cbio_id_table, header=maf_header, config_file=data_config_file, engine="bytes"
+        )
+        return maf_cmd, PyEntry("cbioportal_etl.scripts.maf_merge", maf_args, "collate_mafs.log")
+    return None
 
 
 def process_append_dgd_maf(
@@ -77,7 +90,7 @@ def process_append_dgd_maf(
     cbio_id_table: str,
     cbio_study_id: str,
     script_dir: str,
-) -> subprocess.Popen:
+) -> str:
     """Append DGD mafs to existing collated kf maf.
 
     Args:
@@ -87,59 +100,67 @@ def process_append_dgd_maf(
         script_dir: path of dir containing ETL processing scripts
 
     Returns:
-        Subprocess run of append python script
+        Command to run the append python script
 
     """
     print("Appending DGD to exsting KF maf", file=sys.stderr)
     maf_header = maf_loc_dict["header"]
     in_maf_dir = maf_loc_dict["dgd"]
     append_maf = "merged_mafs/" + cbio_study_id + ".maf"
-    append_cmd = f"python3 {os.path.join(script_dir, 'add_dgd_maf_to_pbta.py')} -i {maf_header} -m {in_maf_dir} -t {cbio_id_table} >> {append_maf} 2> dgd_append_maf.log"
-    log_cmd(append_cmd)
-    return subprocess.Popen(append_cmd, shell=True)
+    return f"python3 {os.path.join(script_dir, 'add_dgd_maf_to_pbta.py')} -i {maf_header} -m {in_maf_dir} -t {cbio_id_table} >> {append_maf} 2> dgd_append_maf.log"
 
 
 def process_cnv(
     data_config_file: str,
     cbio_id_table: str,
     script_dir: str,
-    run_status: dict[str, subprocess.Popen],
-) -> None:
+) -> tuple[str, PyEntry]:
     """Convert CNV data to wide format tables for RAW copy number and GISTIC-stlye, and output SEG CNV formats.
 
     Args:
         cbio_id_table: Path of ETL table with IDs and file locations
         data_config_file: Path of file with ETL reference locations
         script_dir: path of dir containing ETL processing scripts
-        run_status: Dict to track subprocess call statuses
+
+    Returns:
+        Command to run the CNV processing script and its in-process equivalent
 
     """
     print("Processing CNV calls", file=sys.stderr)
     process_cnv_cmd = f"python3 {os.path.join(script_dir, 'process_cnv_data.py')} -t {cbio_id_table} -j {data_config_file} 2> cnv_processing.log"
-    log_cmd(process_cnv_cmd)
-    run_status["convert_to_gene"] = subprocess.Popen(process_cnv_cmd, shell=True)
-    run_status["convert_to_gene"].wait()
+    cnv_args = argparse.Namespace(table=cbio_id_table, config_file=data_config_file)
+    return process_cnv_cmd, PyEntry("cbioportal_etl.scripts.process_cnv_data", cnv_args, "cnv_processing.log")
 
 
 def process_rsem(
-    rsem_dir: str, cbio_id_table: str, script_dir: str, run_status: dict[str, subprocess.Popen], expression_type: str, study_config: str, default_match_type: str
-) -> None:
+    rsem_dir: str, cbio_id_table: str, script_dir: str, expression_type: str, study_config: str, default_match_type: str
+) -> tuple[str, PyEntry]:
     """Merge rsem results by expression_type, calculate z-scores.
 
     Args:
         rsem_dir: Path to rsem data
         cbio_id_table: Path of ETL table with IDs and file locations
         script_dir: path of dir containing ETL processing scripts
-        run_status: Dict to track subprocess call statuses
         expression_type: TPM or FPKM for calculating zscores
         study_config: path to cbio study config json
         default_match_type: match type for samples with unknown RNA library type for z-score calculations (polyA, totalRNA, or none)
 
+    Returns:
+        Command to run the RSEM merge script and its in-process equivalent
+
     """
     print("Processing RNA expression data", file=sys.stderr)
     merge_rsem_cmd = f"python3 {os.path.join(script_dir, 'rna_merge_rename_expression.py')} -t {cbio_id_table} -r {rsem_dir} -et {expression_type} -sc {study_config} -dmt {default_match_type} 2> rna_merge_rename_expression.log"
-    log_cmd(merge_rsem_cmd)
-    run_status["rsem_merge"] = subprocess.Popen(merge_rsem_cmd, shell=True)
+    rsem_args = argparse.Namespace(
+        table=cbio_id_table,
+        rsem_dir=rsem_dir,
+        expression_type=expression_type,
+        study_config=study_config,
+        default_match_type=default_match_type,
+    )
+    return merge_rsem_cmd, PyEntry(
+        "cbioportal_etl.scripts.rna_merge_rename_expression", rsem_args, "rna_merge_rename_expression.log"
+    )
 
 
 def process_kf_fusion(
@@ -147,8 +168,7 @@ def process_kf_fusion(
     cbio_id_table: str,
     mode: str,
     script_dir: str,
-    run_status: dict[str, subprocess.Popen],
-) -> None:
+) -> tuple[str, PyEntry]:
     """Collate and process annoFuse output.
 
     Args:
@@ -156,18 +176,22 @@ def process_kf_fusion(
         cbio_id_table: Path of ETL table with IDs and file locations
         mode: describe source - openX or kfprod or dgd
         script_dir: path of dir containing ETL processing scripts
-        run_status: Dict to track subprocess call statuses
+
+    Returns:
+        Command to run the fusion conversion script and its in-process equivalent
 
     """
     print("Processing KF fusion calls", file=sys.stderr)
     fusion_cmd = f"python3 {os.path.join(script_dir, 'convert_fusion_as_sv.py')} -t {cbio_id_table} -f {fusion_dir} -m {mode} 2> convert_fusion_as_sv.log"
-    log_cmd(fusion_cmd)
-    run_status["fusion"] = subprocess.Popen(fusion_cmd, shell=True)
+    fusion_args = argparse.Namespace(
+        table=cbio_id_table, fusion_results=fusion_dir, out_dir="merged_fusion/", mode=mode, append=False
+    )
+    return fusion_cmd, PyEntry("cbioportal_etl.scripts.convert_fusion_as_sv", fusion_args, "convert_fusion_as_sv.log")
 
 
 def process_dgd_fusion(
     cbio_id_table: str, fusion_dir: str, dgd_status: str, script_dir: str, cbio_study_id: str
-) -> subprocess.Popen:
+) -> tuple[str, PyEntry]:
     """Collate process DGD fusion output.
 
     Append if part of a KF/PBTA load, make solo file if not
@@ -178,23 +202,138 @@ def process_dgd_fusion(
         script_dir: path of dir containing ETL processing scripts
 
     Returns:
-        Subprocess run of DGD fusion processing step
+        Command to run the DGD fusion processing step and its in-process equivalent
 
     """
     dgd_fusion_cmd = f"python3 {os.path.join(script_dir, 'convert_fusion_as_sv.py')} -t {cbio_id_table} -f {fusion_dir} -m dgd"
+    dgd_args = argparse.Namespace(
+        table=cbio_id_table, fusion_results=fusion_dir, out_dir="merged_fusion/", mode="dgd", append=False
+    )
+    append_fusion: str | None = None
     if dgd_status == "both":
         sys.stderr.write("Appending DGD fusion calls\n")
         append_fusion = "merged_fusion/" + cbio_study_id + ".fusions.txt"
         dgd_fusion_cmd += " -a >> " + append_fusion
+        dgd_args.append = True
     else:
         sys.stderr.write("Processing DGD fusion calls\n")
         dgd_fusion_cmd += " -o merged_fusion/"
     dgd_fusion_cmd += " 2> add_dgd_fusion.log"
-    log_cmd(dgd_fusion_cmd)
-    return subprocess.Popen(dgd_fusion_cmd, shell=True)
+    return dgd_fusion_cmd, PyEntry(
+        "cbioportal_etl.scripts.convert_fusion_as_sv", dgd_args, "add_dgd_fusion.log", stdout=append_fusion
+    )
+
+
+def profile_job(cmd: str, entry: PyEntry | None = None) -> tuple[str, PyEntry | None]:
+    """Run a job under the stage profiler, writing its stats as a .prof file next to its log.
+
+    Args:
+        cmd: Job shell command, a python3 script call with stderr sent to a .log file
+        entry: In-process equivalent of cmd, if any
+
+    Returns:
+        Profiled command and in-process entry
+
+    """
+    log: re.Match | None = re.search(r"2> (\S+)\.log", cmd)
+    if log is None:
+        msg = f"Cannot profile {cmd}, it has no log to write the stats next to"
+        raise ValueError(msg)
+    prof: str = f"{log.group(1)}.prof"
+    cmd = cmd.replace("python3 ", f"python3 -m cbioportal_etl.scripts.stage_profiler -o {prof} ", 1)
+    return cmd, entry._replace(profile=prof) if entry is not None else None
+
+
+def job_fingerprint(
+    manifest_rows: list[dict[str, str]],
+    etl_file_types: tuple[str, ...],
+    outputs: tuple[str, ...],
+    config_sections: list | None = None,
+    flags: dict[str, str] | None = None,
+    extra_inputs: list[str] | None = None,
+) -> StageFingerprint:
+    """Fingerprint a step 6 job by its manifest rows, their file sizes/mtimes, config sections and flags.
+
+    Args:
+        manifest_rows: All rows of the ETL manifest
+        etl_file_types: etl_file_type values the job reads
+        outputs: Paths the job writes
+        config_sections: Parts of the study config the job uses
+        flags: Command line flags that change the job output
+        extra_inputs: Other files or dirs the job reads, like references or headers
+
+    Returns:
+        Fingerprint used to skip the job if already complete
+
+    """
+    rows: list[dict[str, str]] = [row for row in manifest_rows if row.get("etl_file_type") in etl_file_types]
+    input_files: list[str] = [f"{row['file_type']}/{row['file_name']}" for row in rows]
+    inputs: dict = {
+        "rows": rows,
+        "files": stat_paths(input_files + [path for path in extra_inputs or [] if path]),
+        "config": config_sections,
+        "flags": flags,
+    }
+    return StageFingerprint(hash_obj(inputs), outputs)
+
+
+def appended_fingerprint(
+    base: Callable[[], StageFingerprint], append: Callable[[], StageFingerprint]
+) -> StageFingerprint:
+    """Fold the inputs of a job appending to a base job's output into the base job's fingerprint.
+
+    The base job then reruns, rewriting its output, whenever the append would, so appends never
+    land on an already appended file.
+
+    Args:
+        base: Fingerprint of the job writing the file
+        append: Fingerprint of the job appending to it
+
+    """
+    fingerprint: StageFingerprint = base()
+    return StageFingerprint(hash_obj([fingerprint.inputs, append().inputs]), fingerprint.outputs)
+
 
+def job_resources(
+    manifest_rows: list[dict[str, str]],
+    etl_file_types: tuple[str, ...],
+    pooled: bool = False,
+    streaming: bool = False,
+) -> JobResources:
+    """Estimate the workers and memory a step 6 job needs from the size of its input files.
 
-def run_py(args):
+    Args:
+        manifest_rows: All rows of the ETL manifest
+        etl_file_types: etl_file_type values the job reads
+        pooled: Job spreads input files over a process pool, one file per worker at a time
+        streaming: Job, or each of its workers, reads inputs a block at a time instead of holding them in memory
+
+    Returns:
+        Most workers the job can use, and memory it holds regardless of and per worker
+
+    """
+    input_files: list[str] = [
+        f"{row['file_type']}/{row['file_name']}" for row in manifest_rows if row.get("etl_file_type") in etl_file_types
+    ]
+    sizes: list[int] = [size or 0 for _path, size, _mtime in stat_paths(input_files)]
+    base_memory: int = PROCESS_MEMORY + (0 if streaming else MEMORY_PER_INPUT_BYTE * sum(sizes))
+    if not pooled:
+        return JobResources(1, base_memory)
+    worker_memory: int = PROCESS_MEMORY + (0 if streaming else MEMORY_PER_INPUT_BYTE * max(sizes, default=0))
+    return JobResources(max(1, len(sizes)), base_memory, worker_memory)
+
+
+def run_py(args, download_tracker: "DownloadTracker | None" = None, report: RunReport | None = None):
+    """Collate genomic files and build the load package.
+
+    Args:
+        args: Parsed command line args
+        download_tracker: Tracker of step 4 downloads still in progress. If given, each job starts as soon
+            as the file types it reads are downloaded instead of assuming all files are present
+        report: Run report to record the resource usage of each job in. If not given, one is written
+            to etl_run_report.json once the jobs are done
+
+    """
     TOOL_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
     with open(args.study_config) as f:
@@ -222,39 +361,36 @@ def run_py(args):
     # iterate through config file - file should only have keys related to data to be loaded
     script_dir: str = os.path.join(TOOL_DIR, config_data["script_dir"])
     etl_file_types: set[str] = set()
+    manifest_rows: list[dict[str, str]] = []
     # get existing file types from manifest, since when doing inc updates, not all frm config may be there
     with open(args.manifest) as f:
         reader = csv.DictReader(f, delimiter='\t')
         for row in reader:
             if len(row) > 0:
                 etl_file_types.add(row.get("etl_file_type"))
-    # Store a list of run priorities to ensure historically slower jobs kick off first using partial:
-    # https://stackoverflow.com/questions/59221490/can-you-store-functions-with-parameters-in-a-list-and-call-them-later-in-python
+                manifest_rows.append(row)
+    # Jobs are added in order of run priority to ensure historically slower jobs kick off first
     run_priority: list[str] = ["rsem", "mafs", "fusion", "cnvs"]
-    run_queue: dict[str, partial] = {}
-    run_status: dict[str, subprocess.Popen] = {}
+    run_queue: dict[str, tuple[str, PyEntry]] = {}
     for key in config_data:
         if key.startswith("merged_"):
             data_type: str = "_".join(key.split("_")[1:])
             if data_type == "mafs" and "maf" in etl_file_types:
-                print("Both config and manifest have MAF data. Adding to queue", file=sys.stderr)
-                run_queue["mafs"] = partial(
-                    process_maf,
+                maf_job: tuple[str, PyEntry] | None = process_maf(
                     config_data["file_loc_defs"]["mafs"],
                     args.manifest,
                     args.study_config,
-                    args.dgd_status,
                     script_dir,
-                    run_status,
                 )
+                if maf_job:
+                    print("Both config and manifest have MAF data. Adding to queue", file=sys.stderr)
+                    run_queue["mafs"] = maf_job
             elif data_type == "rsem" and "rsem" in etl_file_types:
                 print("Both config and manifest have RSEM data. Adding to queue", file=sys.stderr)
-                run_queue["rsem"] = partial(
-                    process_rsem,
+                run_queue["rsem"] = process_rsem(
                     config_data["file_loc_defs"]["rsem"],
                     args.manifest,
                     script_dir,
-                    run_status,
                     args.expression_type,
                     args.study_config,
                     args.default_match_type
@@ -263,31 +399,25 @@ def run_py(args):
                 # Status both works for...both, only when one is specifically picked should one not be run
                 if args.dgd_status != "dgd":
                     print("Both config and manifest have FUSION data. Adding to queue", file=sys.stderr)
-                    run_queue["fusion"] = partial(
-                        process_kf_fusion,
+                    run_queue["fusion"] = process_kf_fusion(
                         config_data["file_loc_defs"]["fusion"],
                         args.manifest,
                         "kfprod",
                         script_dir,
-                        run_status,
                     )
 
             elif data_type == "cnvs" and "cnv" in etl_file_types:
                 print("Both config and manifest have CNV data. Adding to queue", file=sys.stderr)
-                run_queue["cnvs"] = partial(
-                    process_cnv,
+                run_queue["cnvs"] = process_cnv(
                     data_config_file=args.study_config,
                     cbio_id_table=args.manifest,
                     script_dir=script_dir,
-                    run_status=run_status,
                 )
 
-    for job in run_priority:
-        if job in run_queue:
-            run_queue[job]()
-
-    if args.dgd_status == "dgd":
-        run_status["fusion"] = process_dgd_fusion(
+    # DGD fusions are appended to the KF/PBTA fusion file as soon as it is done when set to both
+    add_dgd_fusion: bool = args.dgd_status == "dgd" or (args.dgd_status == "both" and "fusion" in run_queue)
+    if add_dgd_fusion:
+        run_queue["dgd_fusion"] = process_dgd_fusion(
             args.manifest,
             config_data["file_loc_defs"]["dgd_fusion"],
             args.dgd_status,
@@ -295,66 +425,220 @@ def run_py(args):
             cbio_study_id,
         )
 
-    # Wait for concurrent processes to finish and report statuses
-    x: int = 30
-    n: int = 0
-    done: bool = False
-
-    # cheat flag to add append dgd maf once KF/PBTA maf is done when set to both
-    dgd_fusion_append: int = 0
-    while not done:
-        time.sleep(x)
-        n += x
-        # don't need to check the same process over and over again if done
-        rm_keys: list[str] = []
-        done = True
-        print(f"{n} seconds have passed", file=sys.stderr)
-        sys.stderr.flush()
+    in_process: bool = getattr(args, "exec_mode", "subprocess") == "inprocess"
+    if in_process:
+        # Parse the manifest once and hand it, and the already parsed config, to every job
+        import pandas as pd
+
+        all_file_meta = pd.read_csv(args.manifest, sep="\t", dtype={"cbio_sample_name": str})
+        shared_kwargs: dict[str, dict] = {
+            "mafs": {"all_file_meta": all_file_meta},
+            "rsem": {"config_data": config_data, "all_file_meta": all_file_meta},
+            "fusion": {"all_file_meta": all_file_meta},
+            "dgd_fusion": {"all_file_meta": all_file_meta},
+            "cnvs": {"config_data": config_data},
+        }
+        for job, (cmd, entry) in run_queue.items():
+            run_queue[job] = (cmd, entry._replace(kwargs=shared_kwargs[job]))
+
+    # Fingerprint each job so that reruns skip the ones that are already complete.
+    # Evaluated once a job's dependencies are done, as pipelined downloads may still be writing its inputs
+    file_loc_defs: dict = config_data["file_loc_defs"]
+    fingerprints: dict[str, Callable[[], StageFingerprint]] = {
+        "mafs": partial(
+            job_fingerprint,
+            manifest_rows,
+            JOB_ETL_FILE_TYPES["mafs"],
+            ("merged_mafs/",),
+            [file_loc_defs.get("mafs"), config_data.get("merged_mafs")],
+            extra_inputs=[file_loc_defs.get("mafs", {}).get("header")],
+        ),
+        "rsem": partial(
+            job_fingerprint,
+            manifest_rows,
+            JOB_ETL_FILE_TYPES["rsem"],
+            ("merged_rsem/",),
+            [file_loc_defs.get("rsem"), config_data.get("merged_rsem"), config_data.get("rsem_ref")],
+            {"expression_type": args.expression_type, "default_match_type": args.default_match_type},
+            [config_data.get("rsem_ref", {}).get("archive")],
+        ),
+        "fusion": partial(
+            job_fingerprint,
+            manifest_rows,
+            JOB_ETL_FILE_TYPES["fusion"],
+            ("merged_fusion/",),
+            [file_loc_defs.get("fusion"), config_data.get("merged_fusion")],
+        ),
+        "dgd_fusion": partial(
+            job_fingerprint,
+            manifest_rows,
+            JOB_ETL_FILE_TYPES["dgd_fusion"],
+            ("merged_fusion/",),
+            [config_data.get("merged_fusion")],
+            {"dgd_status": args.dgd_status},
+            [file_loc_defs.get("dgd_fusion")],
+        ),
+        "cnvs": partial(
+            job_fingerprint,
+            manifest_rows,
+            JOB_ETL_FILE_TYPES["cnvs"],
+            ("merged_cnvs/",),
+            [
+                config_data.get("cnv_priority"),
+                config_data.get("bed_genes"),
+                config_data.get("cnv_high_gain"),
+                config_data.get("merged_cnvs"),
+            ],
+            extra_inputs=[config_data.get("bed_genes")],
+        ),
+        "dgd_maf": partial(
+            job_fingerprint,
+            manifest_rows,
+            JOB_ETL_FILE_TYPES["dgd_maf"],
+            ("merged_mafs/",),
+            [file_loc_defs.get("mafs")],
+            extra_inputs=[file_loc_defs.get("mafs", {}).get("dgd")],
+        ),
+        "load_package": partial(
+            job_fingerprint,
+            manifest_rows,
+            JOB_ETL_FILE_TYPES["load_package"],
+            ("processed/",),
+            [config_data],
+            {"add_data": args.add_data},
+            [config_data.get("data_sheets", {}).get("dir")],
+        ),
+    }
+
+    # Worker pools of all jobs share one budget, so concurrent jobs do not oversubscribe cpus or memory
+    resources: dict[str, Callable[[], JobResources]] = {
+        "mafs": partial(job_resources, manifest_rows, JOB_ETL_FILE_TYPES["mafs"], pooled=True, streaming=True),
+        "dgd_maf": partial(job_resources, manifest_rows, JOB_ETL_FILE_TYPES["dgd_maf"], streaming=True),
+        "rsem": partial(job_resources, manifest_rows, JOB_ETL_FILE_TYPES["rsem"], pooled=True),
+        "fusion": partial(job_resources, manifest_rows, JOB_ETL_FILE_TYPES["fusion"]),
+        "dgd_fusion": partial(job_resources, manifest_rows, JOB_ETL_FILE_TYPES["dgd_fusion"]),
+        "cnvs": partial(job_resources, manifest_rows, JOB_ETL_FILE_TYPES["cnvs"], pooled=True),
+        "load_package": partial(job_resources, manifest_rows, JOB_ETL_FILE_TYPES["load_package"]),
+    }
+    budget = ResourceBudget(getattr(args, "max_workers", None), parse_memory(getattr(args, "max_memory", None)))
+    print(
+        f"Sharing {budget.max_workers} workers and {getattr(args, 'max_memory', None) or 'unlimited'} memory between jobs",
+        file=sys.stderr,
+    )
 
-        if dgd_fusion_append:
-            run_queue["dgd_fusion_append"] = partial(
-                process_dgd_fusion,
-                args.manifest,
-                config_data["file_loc_defs"]["dgd_fusion"],
-                args.dgd_status,
-                script_dir,
-                cbio_study_id,
+    # DGD data is appended to the merged files of the KF/PBTA jobs, which must be rebuilt before any append reruns
+    append_dgd_maf: bool = bool(
+        args.dgd_status == "both"
+        and "mafs" in run_queue
+        and "DGD_MAF" in etl_file_types
+        and config_data["file_loc_defs"]["mafs"].get("dgd")
+    )
+    appends: dict[str, str] = {}
+    if add_dgd_fusion and args.dgd_status == "both":
+        appends["dgd_fusion"] = "fusion"
+    if append_dgd_maf:
+        appends["dgd_maf"] = "mafs"
+    for append, base in appends.items():
+        fingerprints[base] = partial(appended_fingerprint, fingerprints[base], fingerprints[append])
+    force: set[str] = parse_force(getattr(args, "force", None))
+    force.update(base for append, base in appends.items() if append in force)
+    checkpoints = CheckpointStore(force)
+    own_report: bool = report is None
+    if report is None:
+        report = RunReport()
+    scheduler = JobScheduler(
+        in_process=in_process, checkpoints=checkpoints, checkpoint_group="6", budget=budget, report=report
+    )
+
+    def download_gates(job: str) -> tuple[str, ...]:
+        """Add a gate per file type a job reads that completes once that type is downloaded."""
+        if download_tracker is None:
+            return ()
+        file_types: set[str] = {
+            row["file_type"] for row in manifest_rows if row.get("etl_file_type") in JOB_ETL_FILE_TYPES[job]
+        }
+        gates: list[str] = []
+        for file_type in sorted(file_types):
+            gate: str = f"download_{file_type}"
+            if gate not in scheduler.jobs:
+                scheduler.add_gate(gate, partial(download_tracker.wait_type, file_type))
+            gates.append(gate)
+        return tuple(gates)
+
+    # jobs of stages picked with --profile-stage run under cProfile
+    profile_jobs: set[str] = parse_profile_stages(getattr(args, "profile_stage", None))
+    for job in run_queue:
+        if job in profile_jobs:
+            run_queue[job] = profile_job(*run_queue[job])
+
+    for job in run_priority:
+        if job in run_queue:
+            cmd, entry = run_queue[job]
+            scheduler.add_job(
+                job,
+                cmd,
+                deps=download_gates(job),
+                entry=entry,
+                checkpoint=fingerprints[job],
+                resources=resources[job],
             )
-            run_queue["dgd_fusion_append"]()
-            sys.stderr.write("dgd status was both, appending dgd fusions\n")
-            # don't want to restart this job, let regular logic take over
-            dgd_fusion_append = 0
-
-        for data_type, process in run_status.items():
-            process.poll()
-            print(f"Checking {data_type} status", file=sys.stderr)
-            if process.returncode is not None:
-                check_status(process.returncode, data_type, run_status)
-                rm_keys.append(data_type)
-                if data_type == "fusion" and args.dgd_status == "both":
-                    dgd_fusion_append = 1
-                    done = False
-            else:
-                done = False
-        for data_type in rm_keys:
-            print(f"Removed {data_type} from check queue as task is complete", file=sys.stderr)
-            del run_status[data_type]
-
-    # Run final package builder script
-    print("Creating load packages", file=sys.stderr)
+    if add_dgd_fusion:
+        cmd, entry = run_queue["dgd_fusion"]
+        scheduler.add_job(
+            "dgd_fusion",
+            cmd,
+            deps=download_gates("dgd_fusion") + (("fusion",) if args.dgd_status == "both" else ()),
+            entry=entry,
+            checkpoint=fingerprints["dgd_fusion"],
+            resources=resources["dgd_fusion"],
+        )
+    # Likewise, DGD mafs are appended once the KF/PBTA maf is collated
+    if append_dgd_maf:
+        dgd_maf_cmd: str = process_append_dgd_maf(
+            config_data["file_loc_defs"]["mafs"], args.manifest, cbio_study_id, script_dir
+        )
+        if "dgd_maf" in profile_jobs:
+            dgd_maf_cmd, _entry = profile_job(dgd_maf_cmd)
+        scheduler.add_job(
+            "dgd_maf",
+            dgd_maf_cmd,
+            deps=(*download_gates("dgd_maf"), "mafs"),
+            checkpoint=fingerprints["dgd_maf"],
+            resources=resources["dgd_maf"],
+        )
+
+    # Run final package builder script once every data type is done
     pck_cmd = f"python3 {os.path.join(script_dir, 'organize_upload_packages.py')} -o processed -c {args.study_config}"
     if args.add_data:
         pck_cmd += " -ad"
     pck_cmd += " 2> load_package_create.log"
-    exit_status = subprocess.call(pck_cmd, shell=True)
-    check_status(exit_status, "load package", run_status)
+    pck_entry = PyEntry(
+        "cbioportal_etl.scripts.organize_upload_packages",
+        argparse.Namespace(out_dir="processed", config_file=args.study_config, add_data=args.add_data),
+        "load_package_create.log",
+        kwargs={"config_data": config_data} if in_process else None,
+    )
+    scheduler.add_job(
+        "load_package",
+        pck_cmd,
+        deps=tuple(scheduler.jobs),
+        entry=pck_entry,
+        checkpoint=fingerprints["load_package"],
+        resources=resources["load_package"],
+    )
+    try:
+        scheduler.run()
+    finally:
+        if own_report:
+            report.write()
 
     # Run cbioportal data validator
     if not args.add_data:
         print("Validating load packages", file=sys.stderr)
         sys.stderr.flush()
         validate = f"{config_data['cbioportal_validator']}  -s processed/{cbio_study_id} -n -v 2> validator.errs > validator.out"
-        exit_status = subprocess.call(validate, shell=True)
+        with etl_trace.span("validate_package", "packaging"):
+            exit_status = subprocess.call(validate, shell=True)
         if exit_status:
             print(
                 f"Validator quit with status {exit_status}. Check validator.errs and validator.out for more info",
@@ -416,9 +700,46 @@ def main():
         default="none", 
         help="Default match type for samples with unknown RNA library type for z-score calculations. Use 'polyA' or 'totalRNA' to override fallback to intra-cohort z-score."
     )
-
+    parser.add_argument(
+        "-em",
+        "--exec-mode",
+        action="store",
+        dest="exec_mode",
+        choices=["inprocess", "subprocess"],
+        default="subprocess",
+        help="Run merge jobs as separate python3 commands (subprocess), or as calls of each script's entry point in a forkserver process pool, handed the parsed config and manifest (inprocess)",
+    )
+    parser.add_argument(
+        "--max-workers",
+        action="store",
+        dest="max_workers",
+        type=int,
+        help="Total worker processes shared by all merge jobs. Default is the number of cpus",
+    )
+    parser.add_argument(
+        "--max-memory",
+        action="store",
+        dest="max_memory",
+        help="Total memory shared by all merge jobs, like 48G. Jobs wait for memory to free up if their estimate does not fit. Default is unlimited",
+    )
+    parser.add_argument(
+        "--force",
+        action="store",
+        dest="force",
+        help="csv list of jobs to rerun even if their checkpoint is unchanged: rsem, mafs, fusion, cnvs, dgd_fusion, dgd_maf, load_package, or all. Forcing dgd_fusion or dgd_maf also reruns the merge it appends to",
+    )
+    parser.add_argument(
+        "--profile-stage",
+        action="store",
+        dest="profile_stage",
+        help="csv list of stages to run under cProfile, writing a .prof file next to each stage log: maf, cnv, rsem, fusion",
+    )
 
     args = parser.parse_args()
+    try:
+        parse_profile_stages(args.profile_stage)
+    except ValueError as e:
+        parser.error(str(e))
     run_py(args)
 
 
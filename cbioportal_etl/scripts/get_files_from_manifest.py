@@ -1,27 +1,40 @@
 #!/usr/bin/env python3
-"""Download using a manifest files from SBG Platform."""
+"""Download using a manifest files from SBG Platform, or straight from S3 for buckets listed in an AWS table."""
+
+from __future__ import annotations
 
 import argparse
 import concurrent.futures
 import logging
 import os
 import sys
+from functools import partial
 from typing import TYPE_CHECKING
 
 import pandas as pd
-import sevenbridges as sbg
-from sevenbridges.errors import SbgError
-from sevenbridges.http.error_handlers import maintenance_sleeper, rate_limit_sleeper
 
-from cbioportal_etl.scripts.url_download_helper import parallel_download, small_download
+from cbioportal_etl.scripts import etl_trace
+from cbioportal_etl.scripts.download_cache import DownloadCache
+from cbioportal_etl.scripts.download_scheduler import DownloadScheduler, RateLimiter
+from cbioportal_etl.scripts.download_state import CHANGED, NEW, REMOVED, UNCHANGED, DownloadState
+from cbioportal_etl.scripts.run_report import RunReport
+from cbioportal_etl.scripts.s3_download import S3Source
+from cbioportal_etl.scripts.url_download_helper import PART_SUFFIX, discard_partial
 
+# The SBG client is only imported once files are actually downloaded, debug runs that only preview
+# the manifest subset do without it
 if TYPE_CHECKING:
+    import sevenbridges as sbg
     from numpy import ndarray
-from threading import Lock
+from threading import Event, Lock
 
 
 class DownloadTracker:
-    """Class to track download status of files across threads."""
+    """Class to track download status of files across threads.
+
+    Also publishes a completion event per file type, so that consumers like the step 6 merges can
+    start on a file type as soon as all of its files are downloaded.
+    """
 
     def __init__(self) -> None:
         """Initialize the tracker with empty lists and a lock."""
@@ -29,59 +42,121 @@ class DownloadTracker:
         self.invalid = []
         self.success = []
         self.lock = Lock()
+        self.failed_types: set[str] = set()
+        self.type_events: dict[str, Event] = {}
+        self.published = Event()
+        self.cancelled = Event()
 
     def add_failed(self, file_id: str, path: str, error: Exception) -> None:
         """Add a failed download entry to the tracker."""
         with self.lock:
             self.failed.append((file_id, path, str(error)))
+            self.failed_types.add(os.path.dirname(path))
 
-    def add_invalid(self, file_id: str) -> None:
+    def add_invalid(self, file_id: str, file_type: str | None = None) -> None:
         """Add an invalid file ID to the tracker."""
         with self.lock:
             self.invalid.append(file_id)
+            if file_type is not None:
+                self.failed_types.add(file_type)
 
     def add_success(self, file_id: str, path: str) -> None:
         """Add a successful download entry to the tracker."""
         with self.lock:
             self.success.append((file_id, path))
 
-def sbg_download_with_retry(
-        file_obj: sbg.File,
-        out: str,
-        tracker: DownloadTracker,
-        retries: int = 5,
-        delay: int=3,
-        ) -> None:
-    """Download a file from SBG with retry logic.
+    def fail_type(self, file_type: str) -> None:
+        """Flag a file type as incomplete when files could not be attempted, like on a failed batch lookup."""
+        with self.lock:
+            self.failed_types.add(file_type)
+
+    def publish_types(self, file_types: list[str]) -> None:
+        """Set the file types that will be downloaded. Consumers wait on these only."""
+        with self.lock:
+            for file_type in file_types:
+                self.type_events.setdefault(file_type, Event())
+        self.published.set()
+
+    def complete_type(self, file_type: str) -> None:
+        """Notify consumers that every file of a type was attempted."""
+        with self.lock:
+            event: Event = self.type_events.setdefault(file_type, Event())
+        event.set()
+
+    def close(self) -> None:
+        """Release all consumers. Types that never completed, like after a crash, count as failed."""
+        with self.lock:
+            for file_type, event in self.type_events.items():
+                if not event.is_set():
+                    self.failed_types.add(file_type)
+                    event.set()
+        self.published.set()
+
+    def wait_type(self, file_type: str) -> bool:
+        """Block until all files of a type were attempted. Return True if all downloaded successfully.
+
+        Types that are not part of the download are ready right away.
+        """
+        self.published.wait()
+        with self.lock:
+            event: Event | None = self.type_events.get(file_type)
+        if event is None:
+            return True
+        event.wait()
+        with self.lock:
+            return file_type not in self.failed_types
+
+
+# SBG allows 1000 API calls per 5 minutes, resolving download URLs ahead of the downloads keeps under it
+sbg_url_limiter = RateLimiter(rate=3.0, burst=100)
+
+
+def sbg_download_url(file_obj: sbg.File) -> str:
+    """Get a signed download URL of an SBG file, throttled to the API rate limit."""
+    sbg_url_limiter.acquire()
+    return file_obj.download_info().url
+
+
+def sbg_md5(file_obj: sbg.File) -> str | None:
+    """Get the md5 listed in the metadata of an SBG file, if any."""
+    md5 = dict(getattr(file_obj, "metadata", None) or {}).get("md5")
+    return md5.lower() if isinstance(md5, str) and len(md5) == 32 else None
 
-    Will attempt to download a file up to `retries` times, with an exponential
-    backoff delay between attempts.
+
+def in_delta(
+    scheduler: DownloadScheduler,
+    out: str,
+    file_id: str,
+    size: int | None,
+    overwrite: bool,
+    md5: str | None = None,
+    version: str | None = None,
+) -> bool:
+    """Tell if a manifest file is new or changed since it was downloaded, recording it as expected if not.
 
     Args:
-        file_obj: SBG File object to download
-        out: Output file path
-        tracker: DownloadTracker object to track download status
-        retries: Number of retry attempts
-        delay: Delay between retries in seconds
+        scheduler: Run-wide download queue, with the state of earlier downloads
+        out: Path the file is downloaded to
+        file_id: ID of the file at the source
+        size: Size the source reports
+        overwrite: Flag to download it even if unchanged
+        md5: md5, or ETag, the source reports
+        version: Version the source reports
 
     """
     logger = logging.getLogger(__name__)
-    file_id = file_obj.id
-    try:
-        file_url = file_obj.download_info().url
-        chunk_size: int = 32 * 1024 * 1024
-        total_size: int = file_obj.size
-        if total_size <= chunk_size:
-            small_download(file_url, out, retries, delay)
-        else:
-            parallel_download(file_url, out, total_size, num_workers=12,
-                              chunk_size=chunk_size)
-        tracker.add_success(file_id, out)
-    except (Exception, SbgError) as e:
-        logger.exception("Failed to download %s after %d attempts from url: %s", out, retries, file_url)
-        tracker.add_failed(file_id, out, e)
-        dl_err_msg = f"Download failed for {file_obj.id} to location {out} with error {e}"
-        raise Exception(dl_err_msg) from e
+    if scheduler.state is None:
+        return overwrite or not os.path.isfile(out)
+    status: str = scheduler.state.classify(out, file_id, size, version)
+    if status == CHANGED:
+        logger.info("%s changed since it was downloaded, downloading it again", out)
+        # a partial download left from before the change must not be resumed
+        discard_partial(out + PART_SUFFIX)
+    if overwrite or status != UNCHANGED:
+        return True
+    logger.info("Skipping %s it is unchanged and overwrite not set", out)
+    scheduler.state.expect(out, file_id, size, md5, version)
+    return False
 
 
 def download_sbg(
@@ -90,8 +165,9 @@ def download_sbg(
     api: sbg.Api,
     overwrite: bool,
     tracker: DownloadTracker,
+    scheduler: DownloadScheduler,
 ) -> None:
-    """Download from SBG to file_type dir if SBG profile was given.
+    """Look up files of a type on SBG and queue their download to file_type dir.
 
     Args:
         file_type: String representation of genomic file type from ETL file
@@ -99,53 +175,146 @@ def download_sbg(
         api: SBG API object, if applicable
         overwrite: Flag to overwrite existing files
         tracker: DownloadTracker object to track download status across threads
+        scheduler: Run-wide download queue shared by all file types
 
     """
     logger = logging.getLogger(__name__)
     # get file id file name pairs from manifest
-    sub_df = selected.loc[selected["file_type"] == file_type, ["file_id", "file_name", "s3_path"]]
+    # files listed by more than one manifest are only downloaded once
+    sub_df = selected.loc[
+        selected["file_type"] == file_type, ["file_id", "file_name"]
+    ].drop_duplicates()
     total_files = len(sub_df)
 
     batch_size = 100
     for batch_start_idx in range(0, len(sub_df), batch_size):
+        if tracker.cancelled.is_set():
+            logger.warning("Downloads cancelled, stopping %s downloads", file_type)
+            tracker.fail_type(file_type)
+            return
         logger.info("Processed %s files %d out of %d", file_type, batch_start_idx, total_files)
         batch = sub_df.iloc[batch_start_idx : batch_start_idx + batch_size]
-        batch_ids = batch["file_id"].tolist()
-        batch_names = batch["file_name"].tolist()
-        try:
-            bulk_files = api.files.bulk_get(batch_ids)
-            for j, file_obj in enumerate(bulk_files):
-                if file_obj.valid:
-                    out = f"{file_type}/{batch_names[j]}"
-                    if not os.path.isfile(out) or overwrite:
-                        sbg_download_with_retry(file_obj.resource, out, tracker)
+        with etl_trace.span(f"{file_type} lookup {batch_start_idx // batch_size + 1}", "download", files=len(batch)):
+            batch_ids = batch["file_id"].tolist()
+            batch_names = batch["file_name"].tolist()
+            try:
+                bulk_files = api.files.bulk_get(batch_ids)
+                for j, file_obj in enumerate(bulk_files):
+                    if tracker.cancelled.is_set():
+                        break
+                    if file_obj.valid:
+                        out = f"{file_type}/{batch_names[j]}"
+                        modified_on = getattr(file_obj.resource, "modified_on", None)
+                        version: str | None = str(modified_on) if modified_on else None
+                        md5: str | None = sbg_md5(file_obj.resource)
+                        if in_delta(scheduler, out, batch_ids[j], file_obj.resource.size, overwrite, md5, version):
+                            scheduler.submit(
+                                batch_ids[j],
+                                file_type,
+                                out,
+                                file_obj.resource.size,
+                                partial(sbg_download_url, file_obj.resource),
+                                md5,
+                                version,
+                            )
+                    else:
+                        logger.warning("File ID %s is not valid. Skipping download.", batch_ids[j])
+                        tracker.add_invalid(batch_ids[j], file_type)
+            except Exception as e:
+                logger.exception("Unexpected error for batch starting at index %d: %s", batch_start_idx, e)
+                tracker.fail_type(file_type)
+    logger.info("Queued all %s files", file_type)
+
+
+def download_s3(
+    file_type: str,
+    selected: pd.DataFrame,
+    s3: S3Source,
+    overwrite: bool,
+    tracker: DownloadTracker,
+    scheduler: DownloadScheduler,
+) -> pd.DataFrame:
+    """Look up files of a type in their S3 bucket and queue their download to file_type dir.
+
+    Args:
+        file_type: String representation of genomic file type from ETL file
+        selected: Dataframe with filtered ETL entries
+        s3: S3 buckets and the AWS profiles to read them with
+        overwrite: Flag to overwrite existing files
+        tracker: DownloadTracker object to track download status across threads
+        scheduler: Run-wide download queue shared by all file types
 
+    Returns:
+        Entries of the file type left to download from SBG, in buckets not in the AWS table or that could not be read
+
+    """
+    logger = logging.getLogger(__name__)
+    if "s3_path" not in selected:
+        # a manifest without S3 paths is all downloaded from SBG
+        return selected.loc[selected["file_type"] == file_type, ["file_type", "file_id", "file_name"]].drop_duplicates()
+    sub_df = selected.loc[
+        selected["file_type"] == file_type, ["file_type", "file_id", "file_name", "s3_path"]
+    ].drop_duplicates()
+    in_s3: pd.Series[bool] = sub_df["s3_path"].map(lambda path: isinstance(path, str) and s3.profile(path) is not None)
+    fallback: list = sub_df.index[~in_s3].tolist()
+    s3_df = sub_df[in_s3]
+
+    batch_size = 100
+    for batch_start_idx in range(0, len(s3_df), batch_size):
+        if tracker.cancelled.is_set():
+            logger.warning("Downloads cancelled, stopping %s downloads", file_type)
+            tracker.fail_type(file_type)
+            return sub_df.iloc[0:0]
+        batch = s3_df.iloc[batch_start_idx : batch_start_idx + batch_size]
+        with etl_trace.span(f"{file_type} s3 lookup {batch_start_idx // batch_size + 1}", "download", files=len(batch)):
+            for row in batch.itertuples():
+                out = f"{file_type}/{row.file_name}"
+                has_sbg_id: bool = isinstance(row.file_id, str) and bool(row.file_id)
+                file_id: str = row.file_id if has_sbg_id else row.s3_path
+                try:
+                    s3_object = s3.head(row.s3_path)
+                except Exception as e:
+                    if has_sbg_id:
+                        logger.warning("Could not read %s, downloading it from SBG instead: %s", row.s3_path, e)
+                        fallback.append(row.Index)
                     else:
-                        logger.info("Skipping %s it exists and overwrite not set", out)
-                else:
-                    logger.warning("File ID %s is not valid. Skipping download.", batch_ids[j])
-                    tracker.add_invalid(batch_ids[j])
-        except Exception as e:
-            logger.exception("Unexpected error for batch starting at index %d: %s", batch_start_idx, e)
-    logger.info("Completed downloading files for %s", file_type)
+                        logger.exception("Could not read %s", row.s3_path)
+                        tracker.add_failed(file_id, out, e)
+                    continue
+                if in_delta(scheduler, out, file_id, s3_object.size, overwrite, s3_object.etag, s3_object.version):
+                    scheduler.submit(
+                        file_id,
+                        file_type,
+                        out,
+                        s3_object.size,
+                        partial(s3.presign, row.s3_path),
+                        s3_object.etag,
+                        s3_object.version,
+                    )
+    logger.info("Queued all %s files in S3", file_type)
+    return sub_df.loc[fallback]
 
 
 def mt_type_download(
     file_type: str,
     selected: pd.DataFrame,
-    api: sbg.Api,
+    api: sbg.Api | None,
     overwrite: bool,
     tracker: DownloadTracker,
+    scheduler: DownloadScheduler,
+    s3: S3Source | None = None,
 ) -> None:
-    """Download files from each desired file type at the same time.
+    """Queue files from each desired file type at the same time.
 
-    Picks the download protocol based on provided args
+    Picks the download protocol per entry, S3 for those in buckets of the AWS table, else SBG
     Args:
         file_type: String representation of genomic file type from ETL file
         selected: Dataframe with filtered ETL entries
         api: SBG API object, if applicable
         overwrite: Flag to overwrite existing files
         tracker: DownloadTracker object to track download status across threads
+        scheduler: Run-wide download queue shared by all file types
+        s3: S3 buckets and the AWS profiles to read them with, if an AWS table was given
 
     """
     logger = logging.getLogger(__name__)
@@ -153,13 +322,23 @@ def mt_type_download(
         logger.info("Downloading %s files", file_type)
         try:
             os.makedirs(file_type, exist_ok=True)
-            download_sbg(file_type, selected, api, overwrite, tracker)
-        except Exception as e:
+            if s3 is not None:
+                selected = download_s3(file_type, selected, s3, overwrite, tracker, scheduler)
+            sbg_ids: pd.Series = selected.loc[selected["file_type"] == file_type, "file_id"]
+            if len(sbg_ids) and api is None:
+                logger.error("No SBG profile given for %s files not in S3 buckets of the AWS table", file_type)
+                for file_id in sbg_ids:
+                    tracker.add_invalid(file_id, file_type)
+            elif len(sbg_ids):
+                download_sbg(file_type, selected, api, overwrite, tracker, scheduler)
+        except Exception:
             logger.exception("error while making directory for %s", file_type)
+            tracker.fail_type(file_type)
     else:
         logger.warning(
             "No files of type %s in which file_id and s3_path is not NA. Skipping!", file_type
         )
+    scheduler.finish_type(file_type)
     sys.stderr.flush()
 
 
@@ -182,8 +361,16 @@ def flag_adjustments(args: argparse.Namespace, selected: pd.DataFrame) -> pd.Dat
     return selected
 
 
-def run_py(args: argparse.Namespace) -> int:
-    """Run the main logic of the script."""
+def run_py(args: argparse.Namespace, tracker: DownloadTracker | None = None, report: RunReport | None = None) -> int:
+    """Run the main logic of the script.
+
+    Args:
+        args: Parsed command line args
+        tracker: Tracker to publish per file type completion events on, for pipelined runs
+        report: Run report to record the tuned transfer parameters in. If not given, one is written
+            to etl_run_report.json once the downloads are done
+
+    """
     # concat multiple possible manifests
     logging.basicConfig(
         level=logging.INFO,
@@ -227,32 +414,99 @@ def run_py(args: argparse.Namespace) -> int:
         logger.info("Debug flag given. No downloads actually happen, just a manifest subset to preview")
         return 0
     # download files by type
+    aws_tbl: str | None = getattr(args, "aws_tbl", None)
+    # entries in buckets of the AWS table are downloaded from S3, the rest from SBG
+    s3: S3Source | None = None
+    if aws_tbl:
+        s3 = S3Source(aws_tbl, getattr(args, "s3_endpoint_url", None), getattr(args, "download_workers", None) or 16)
     if args.sbg_profile is None:
-        crit_arg = "Please provide sbg_profile"
-        raise ValueError(crit_arg)
-    config: sbg.Config = sbg.Config(profile=args.sbg_profile)
-    api = sbg.Api(config=config, error_handlers=[rate_limit_sleeper, maintenance_sleeper])
-
-    tracker = DownloadTracker()
-    with concurrent.futures.ThreadPoolExecutor(16) as executor:
-        futures ={
-            executor.submit(
-                mt_type_download,
-                ftype,
-                selected,
-                api,
-                args.overwrite,
-                tracker,
-            ): ftype
-            for ftype in file_types_list
+        s3_paths: pd.Series = selected["s3_path"] if "s3_path" in selected else pd.Series(None, index=selected.index)
+        in_s3: pd.Series = s3_paths.map(
+            lambda path: s3 is not None and isinstance(path, str) and s3.profile(path) is not None
+        )
+        if (~in_s3 & selected["file_id"].notna()).any():
+            crit_arg = "Please provide sbg_profile, the manifest has files not in S3 buckets of the aws_tbl"
+            raise ValueError(crit_arg)
+    api: sbg.Api | None = None
+    if args.sbg_profile is not None:
+        import sevenbridges as sbg
+        from sevenbridges.http.error_handlers import maintenance_sleeper, rate_limit_sleeper
+
+        config: sbg.Config = sbg.Config(profile=args.sbg_profile)
+        api = sbg.Api(config=config, error_handlers=[rate_limit_sleeper, maintenance_sleeper])
+
+    if tracker is None:
+        tracker = DownloadTracker()
+    tracker.publish_types(file_types_list)
+    # file types are looked up side by side, feeding one download queue that interleaves them
+    # size and digest of every file, for check_downloads to verify
+    state = DownloadState()
+    cache: DownloadCache | None = None
+    if getattr(args, "download_cache", None):
+        cache_size: float | None = getattr(args, "download_cache_size", None)
+        cache = DownloadCache(args.download_cache, int(cache_size * 1024**3) if cache_size else None)
+    own_report: bool = report is None
+    if report is None:
+        report = RunReport()
+    scheduler_class: type[DownloadScheduler] = DownloadScheduler
+    if getattr(args, "download_engine", "threads") == "async":
+        from cbioportal_etl.scripts.async_download import AsyncDownloadScheduler
+
+        scheduler_class = AsyncDownloadScheduler
+    scheduler = scheduler_class(
+        tracker,
+        getattr(args, "download_workers", None),
+        getattr(args, "download_per_host", None),
+        state=state,
+        cache=cache,
+        report=report,
+    )
+    try:
+        with concurrent.futures.ThreadPoolExecutor(16) as executor:
+            futures ={
+                executor.submit(
+                    mt_type_download,
+                    ftype,
+                    selected,
+                    api,
+                    args.overwrite,
+                    tracker,
+                    scheduler,
+                    s3,
+                ): ftype
+                for ftype in file_types_list
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        manifest_paths: set[str] = {
+            f"{file_type}/{file_name}" for file_type, file_name in zip(selected["file_type"], selected["file_name"])
         }
-
-        for future in concurrent.futures.as_completed(futures):
-            future.result()
+        # recorded downloads dropped from the manifest, like files replaced by a newer version
+        removed: list[str] = state.removed(manifest_paths, file_types_list)
+        prune: bool = getattr(args, "prune_removed", False)
+        for path in removed:
+            logger.info("%s is no longer in the manifest%s", path, ", removing it" if prune else "")
+        if removed and prune:
+            for path in removed:
+                if os.path.exists(path):
+                    os.remove(path)
+            state.forget(removed)
+    finally:
+        scheduler.wait()
+        state.save()
+        if cache is not None:
+            cache.evict()
+        if own_report:
+            report.write()
     logger.info("======== DOWNLOAD SUMMARY ========")
     logger.info("Successful downloads: %d", len(tracker.success))
     logger.info("Failed downloads: %d", len(tracker.failed))
     logger.info("Invalid file IDs: %d", len(tracker.invalid))
+    logger.info(
+        "Manifest delta: %d new, %d changed, %d unchanged, %d removed",
+        *(state.counts[status] for status in (NEW, CHANGED, UNCHANGED, REMOVED)),
+    )
 
     if tracker.failed:
         logger.info("---- FAILED DOWNLOADS ----")
@@ -287,12 +541,25 @@ def main() -> None:
         action="store",
         help="csv list of workflow types to download",
     )
+    parser.add_argument(
+        "-at",
+        "--aws-tbl",
+        action="store",
+        dest="aws_tbl",
+        help="Table with bucket name and AWS profile pairs. Entries with an s3_path in them download from S3",
+    )
+    parser.add_argument(
+        "--s3-endpoint-url",
+        action="store",
+        dest="s3_endpoint_url",
+        help="S3 endpoint to download from other than AWS, like a MinIO server",
+    )
     parser.add_argument(
         "-sp",
         "--sbg-profile",
         action="store",
         dest="sbg_profile",
-        help="sbg profile name",
+        help="sbg profile name. Leave blank if using AWS only",
     )
     parser.add_argument(
         "-c",
@@ -333,6 +600,43 @@ def main() -> None:
         dest="overwrite",
         help="If set, overwrite if file exists",
     )
+    parser.add_argument(
+        "--prune-removed",
+        action="store_true",
+        dest="prune_removed",
+        help="Delete downloaded files of the file types downloaded that are no longer in the manifest",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        dest="download_workers",
+        help="Most downloads, or ranges of large files, in flight at once across all file types. Default is 16",
+    )
+    parser.add_argument(
+        "--download-per-host",
+        type=int,
+        dest="download_per_host",
+        help="Most downloads in flight to any one host. Default is no limit beyond --download-workers",
+    )
+    parser.add_argument(
+        "--download-engine",
+        choices=["threads", "async"],
+        default="threads",
+        dest="download_engine",
+        help="Run downloads on a thread each, or as coroutines of one event loop thread, which keeps hundreds in "
+        "flight cheaply with a high --download-workers. async needs aiohttp. Default is threads",
+    )
+    parser.add_argument(
+        "--download-cache",
+        dest="download_cache",
+        help="Dir of a download cache shared across studies and runs. Files in it are linked instead of downloaded",
+    )
+    parser.add_argument(
+        "--download-cache-size",
+        type=float,
+        dest="download_cache_size",
+        help="Size in GB the download cache is kept under, evicting least recently used files. Default is no limit",
+    )
 
     args = parser.parse_args()
     run_py(args)
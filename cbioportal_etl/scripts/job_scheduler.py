@@ -0,0 +1,525 @@
+"""Dependency-aware scheduler for concurrent ETL shell jobs.
+
+Each running child is watched by its own thread that blocks on the child's exit, so the scheduler
+reacts as soon as any job finishes instead of on a polling interval. Dependent jobs start right away,
+and a failed job brings down every sibling still running.
+
+Jobs with a python entry point can also run in-process: the script's run_py is called in a worker
+of a process pool, handed pre-parsed config and manifest objects instead of reading them again. The
+workers are forked from a forkserver that imported the scripts once, never from the scheduler, whose
+watcher threads could leave a forked child holding one of their locks.
+
+Jobs with a checkpoint fingerprint are skipped when a previous run completed them with the same
+inputs and left their outputs untouched, unless a job they depend on had to run again.
+
+Gates are jobs that wait on an outside event instead of running a command, like a file type
+finishing download, so that jobs depending on them start as soon as their inputs are ready.
+
+Given a resource budget, jobs only start once worker slots and memory are free for them, and each
+is told through its environment how many workers its pools may use.
+
+By default a failed job brings down the whole run. With keep_going, only jobs that depend on it are
+dropped, which suits batches of independent studies.
+
+Given a run report, the wall time, cpu time, peak RSS and io of every job are recorded as it exits.
+When tracing, every job and gate wait is also added to the run timeline.
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib
+import multiprocessing
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections.abc import Callable
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from typing import Any, NamedTuple
+
+from cbioportal_etl.scripts import etl_trace
+from cbioportal_etl.scripts.checkpoint import CheckpointStore, StageFingerprint
+from cbioportal_etl.scripts.resource_budget import MEMORY_ENV, WORKERS_ENV, JobResources, ResourceBudget
+from cbioportal_etl.scripts.run_report import RunReport, StageTimer, wait_with_usage
+from cbioportal_etl.scripts.stage_profiler import profiled
+
+
+def log_cmd(cmd: str) -> None:
+    """Print output commands run to stderr."""
+    print(cmd, file=sys.stderr)
+    sys.stderr.flush()
+
+
+class PyEntry(NamedTuple):
+    """Named tuple to describe an in-process call of a script's run_py entry point."""
+
+    module: str
+    args: argparse.Namespace
+    log: str
+    stdout: str | None = None
+    kwargs: dict[str, Any] | None = None
+    profile: str | None = None
+
+
+class Job(NamedTuple):
+    """Named tuple to describe a shell command and the jobs that must finish before it starts."""
+
+    name: str
+    cmd: str
+    deps: tuple[str, ...] = ()
+    entry: PyEntry | None = None
+    checkpoint: StageFingerprint | Callable[[], StageFingerprint] | None = None
+    gate: Callable[[], bool] | None = None
+    resources: JobResources | Callable[[], JobResources] | None = None
+    after: tuple[str, ...] = ()
+
+
+def _wait_proc(proc: subprocess.Popen, on_exit: Callable[[], None]) -> tuple[int, dict[str, Any]]:
+    """Wait for a shell job, return its exit status and usage."""
+    status, usage = wait_with_usage(proc.pid, on_exit)
+    # reaped here rather than by Popen, let it know
+    proc.returncode = status
+    return status, usage
+
+
+def _wait_gate(name: str, wait: Callable[[], bool]) -> tuple[int, None]:
+    """Wait for a gate event and return it as an exit status."""
+    with etl_trace.span(name, "gate"):
+        return 0 if wait() else 1, None
+
+
+def _run_entry(entry: PyEntry) -> int:
+    """Call an entry point with stderr, and optionally stdout, sent to files. Return its exit status."""
+    status: int = 1
+    try:
+        log_fd: int = os.open(entry.log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(log_fd, sys.stderr.fileno())
+        os.close(log_fd)
+        if entry.stdout:
+            out_fd: int = os.open(entry.stdout, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.dup2(out_fd, sys.stdout.fileno())
+            os.close(out_fd)
+        with profiled(entry.profile):
+            importlib.import_module(entry.module).run_py(entry.args, **(entry.kwargs or {}))
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return status
+
+
+# Pids of the jobs pool workers are running, set in each worker by _init_entry_worker
+_entry_pids: Any = None
+
+
+def _init_entry_worker(entry_pids: Any) -> None:
+    """Keep the queue a pool worker reports the pid of each job it runs on."""
+    global _entry_pids
+    _entry_pids = entry_pids
+
+
+def _run_pooled_entry(name: str, entry: PyEntry, env: dict[str, str]) -> tuple[int, dict[str, Any]]:
+    """Run an entry point in a pool worker, in a session of its own. Return its exit status and usage.
+
+    The worker's cwd, environment, stdout and stderr are restored after, ready for its next job.
+    """
+    if os.getsid(0) != os.getpid():
+        # made a session leader once, so killing the session kills the job's own children too
+        os.setsid()
+    _entry_pids.put((name, os.getpid()))
+    cwd: str = os.getcwd()
+    environ: dict[str, str] = dict(os.environ)
+    saved_fds: list[int] = [os.dup(sys.stdout.fileno()), os.dup(sys.stderr.fileno())]
+    report = RunReport()
+    try:
+        os.environ.update(env)
+        with StageTimer(report, name, "job"):
+            status: int = _run_entry(entry)
+    finally:
+        os.dup2(saved_fds[0], sys.stdout.fileno())
+        os.dup2(saved_fds[1], sys.stderr.fileno())
+        for fd in saved_fds:
+            os.close(fd)
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(cwd)
+    usage: dict[str, Any] = {
+        key: value
+        for key, value in report.stages[name].items()
+        if key not in ("kind", "status", "started", "wall_time_s")
+    }
+    return status, {**usage, "pid": os.getpid()}
+
+
+def _wait_future(future: Future) -> tuple[int, dict[str, Any] | None]:
+    """Wait for a pooled job, return its exit status and usage."""
+    try:
+        return future.result()
+    except Exception:
+        # like a worker killed along with the run, or a job that could not be pickled
+        traceback.print_exc()
+        return 1, None
+
+
+class JobScheduler:
+    """Run shell jobs concurrently, honoring dependencies between them."""
+
+    def __init__(
+        self,
+        in_process: bool = False,
+        checkpoints: CheckpointStore | None = None,
+        checkpoint_group: str | None = None,
+        budget: ResourceBudget | None = None,
+        keep_going: bool = False,
+        report: RunReport | None = None,
+    ) -> None:
+        """Initialize the scheduler with no jobs.
+
+        Args:
+            in_process: Run jobs that have a python entry point in a process pool instead of a new interpreter
+            checkpoints: Store used to skip jobs that are already complete and to record completed ones
+            checkpoint_group: Step the jobs belong to, forcing it forces all jobs
+            budget: Worker slots and memory shared by all jobs, unlimited if not given
+            keep_going: On a job failure, keep running every job that does not depend on it
+            report: Report to record the resource usage of every job in
+
+        """
+        self.in_process: bool = in_process
+        self.checkpoints: CheckpointStore | None = checkpoints
+        self.checkpoint_group: str | None = checkpoint_group
+        self.budget: ResourceBudget | None = budget
+        self.keep_going: bool = keep_going
+        self.report: RunReport | None = report
+        self.jobs: dict[str, Job] = {}
+        self.running: dict[str, int | None] = {}
+        # pids of running jobs not yet exited, dropped before they are reaped so kills never hit a reused pid
+        self._live: dict[str, int] = {}
+        self._live_lock = threading.Lock()
+        self._pool: ProcessPoolExecutor | None = None
+        self._entry_pids: Any = None
+        self._futures: dict[str, Future] = {}
+        self.finished: set[str] = set()
+        self.skipped: set[str] = set()
+        self.failed: set[str] = set()
+        self._fingerprints: dict[str, StageFingerprint] = {}
+        self._resources: dict[str, JobResources] = {}
+        self._events: queue.Queue[tuple[str, int, dict[str, Any] | None]] = queue.Queue()
+        self._started: dict[str, tuple[float, float, int | None]] = {}
+
+    def add_job(
+        self,
+        name: str,
+        cmd: str,
+        deps: tuple[str, ...] = (),
+        entry: PyEntry | None = None,
+        checkpoint: StageFingerprint | Callable[[], StageFingerprint] | None = None,
+        resources: JobResources | Callable[[], JobResources] | None = None,
+        after: tuple[str, ...] = (),
+    ) -> None:
+        """Queue a job. Jobs with no pending dependencies start in the order they were added.
+
+        Args:
+            name: Unique job name, used in logs and to reference the job as a dependency
+            cmd: Shell command to run
+            deps: Names of jobs that must complete successfully before this one starts
+            entry: Equivalent in-process call of cmd, used instead of it when running in-process
+            checkpoint: Inputs hash and outputs of the job, used to skip it if already complete.
+                Can be a callable, evaluated once the job's dependencies finished
+            resources: Most workers the job can use and its memory estimate, one worker if not given.
+                Can be a callable, evaluated once the job's dependencies finished
+            after: Names of jobs that must finish before this one starts, whether they succeed or not
+
+        """
+        if name in self.jobs:
+            msg = f"Job {name} was already added to the scheduler"
+            raise ValueError(msg)
+        self.jobs[name] = Job(name, cmd, tuple(deps), entry, checkpoint, resources=resources, after=tuple(after))
+
+    def add_gate(
+        self, name: str, wait: Callable[[], bool], deps: tuple[str, ...] = (), after: tuple[str, ...] = ()
+    ) -> None:
+        """Queue a gate, a job that completes when wait returns instead of running a command.
+
+        Args:
+            name: Unique gate name, used in logs and to reference the gate as a dependency
+            wait: Blocks until the event the gate stands for, returns False if it failed.
+                Runs in a thread of the scheduler process
+            deps: Names of jobs that must complete successfully before the gate starts waiting
+            after: Names of jobs that must finish before the gate starts waiting, whether they succeed or not
+
+        """
+        if name in self.jobs:
+            msg = f"Job {name} was already added to the scheduler"
+            raise ValueError(msg)
+        self.jobs[name] = Job(name, "", tuple(deps), gate=wait, after=tuple(after))
+
+    def _fingerprint(self, job: Job) -> StageFingerprint | None:
+        """Get the fingerprint of a job, evaluating it once if it was given as a callable."""
+        if job.checkpoint is None or isinstance(job.checkpoint, StageFingerprint):
+            return job.checkpoint
+        if job.name not in self._fingerprints:
+            self._fingerprints[job.name] = job.checkpoint()
+        return self._fingerprints[job.name]
+
+    def _job_resources(self, job: Job) -> JobResources:
+        """Get the resource needs of a job, evaluating them once if they were given as a callable."""
+        if job.resources is None or isinstance(job.resources, JobResources):
+            return job.resources or JobResources()
+        if job.name not in self._resources:
+            self._resources[job.name] = job.resources()
+        return self._resources[job.name]
+
+    def _is_complete(self, job: Job) -> bool:
+        """Check if a job can be skipped. Never if any job it depends on ran again, gates aside."""
+        if self.checkpoints is None or job.checkpoint is None:
+            return False
+        if not all(dep in self.skipped or self.jobs[dep].gate is not None for dep in job.deps):
+            return False
+        return self.checkpoints.is_current(job.name, self._fingerprint(job), self.checkpoint_group)
+
+    def _is_ready(self, job: Job) -> bool:
+        """Check if every job that must run first is done."""
+        return all(dep in self.finished for dep in job.deps) and all(
+            dep in self.finished or dep in self.failed for dep in job.after
+        )
+
+    def _job_env(self, name: str, workers: int | None) -> dict[str, str]:
+        """Get the environment variables passing a job its share of the budget."""
+        if workers is None or self.budget is None:
+            return {}
+        env: dict[str, str] = {WORKERS_ENV: str(workers)}
+        if self.budget.max_memory is not None:
+            env[MEMORY_ENV] = str(self.budget.granted[name][1])
+        return env
+
+    def _watch(self, name: str, wait: Callable[[], tuple[int, dict[str, Any] | None]]) -> None:
+        """Block until a child exits, then notify the scheduler loop."""
+        self._events.put((name, *wait()))
+
+    def _exited(self, name: str) -> None:
+        """Note that a job's process exited, before it is reaped."""
+        with self._live_lock:
+            self._live.pop(name, None)
+
+    def _entry_pool(self) -> ProcessPoolExecutor:
+        """Get the pool in-process jobs run in, started on first use."""
+        if self._pool is None:
+            methods: list[str] = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            if context.get_start_method() == "forkserver":
+                # imported once in the forkserver, so every worker starts with them loaded
+                context.set_forkserver_preload(
+                    sorted({job.entry.module for job in self.jobs.values() if job.entry is not None})
+                )
+            self._entry_pids = context.SimpleQueue()
+            self._pool = ProcessPoolExecutor(
+                max_workers=max(1, sum(job.entry is not None for job in self.jobs.values())),
+                mp_context=context,
+                initializer=_init_entry_worker,
+                initargs=(self._entry_pids,),
+            )
+        return self._pool
+
+    def _track_pooled(self) -> None:
+        """Add the workers of pooled jobs still running to the live pids. Call with the live lock held."""
+        while self._entry_pids is not None and not self._entry_pids.empty():
+            name, pid = self._entry_pids.get()
+            # a done job's worker may be idle, or running another job reported later
+            if not self._futures[name].done():
+                self._live[name] = pid
+
+    def _launch(self, name: str, workers: int | None = None) -> None:
+        """Start a job in its own process group so the whole shell pipeline can be killed.
+
+        Args:
+            name: Job to start
+            workers: Worker slots granted to the job from the budget, if any
+
+        """
+        job: Job = self.jobs[name]
+        if job.gate is not None:
+            log_cmd(f"Waiting for {name}")
+            self.running[name] = None
+            threading.Thread(target=self._watch, args=(name, partial(_wait_gate, name, job.gate)), daemon=True).start()
+            return
+        if self.checkpoints is not None and job.checkpoint is not None:
+            self.checkpoints.invalidate(name)
+        if workers is not None:
+            log_cmd(f"Granted {name} {workers} worker(s)")
+        pid: int | None = None
+        if self.in_process and job.entry is not None:
+            log_cmd(f"Running {job.entry.module}.run_py in-process for {name}, logging to {job.entry.log}")
+            future: Future = self._entry_pool().submit(
+                _run_pooled_entry, name, job.entry, self._job_env(name, workers)
+            )
+            self._futures[name] = future
+            future.add_done_callback(lambda _future: self._exited(name))
+            # its worker's pid is only known once the job starts there
+            wait: Callable[[], tuple[int, dict[str, Any] | None]] = partial(_wait_future, future)
+        else:
+            log_cmd(job.cmd)
+            job_env: dict[str, str] = self._job_env(name, workers)
+            proc = subprocess.Popen(
+                job.cmd, shell=True, start_new_session=True, env={**os.environ, **job_env} if job_env else None
+            )
+            pid = proc.pid
+            wait = partial(_wait_proc, proc, partial(self._exited, name))
+            with self._live_lock:
+                self._live[name] = pid
+        self._started[name] = (time.time(), time.monotonic(), workers)
+        self.running[name] = pid
+        threading.Thread(target=self._watch, args=(name, wait), daemon=True).start()
+
+    def _launch_ready(self, pending: set[str]) -> None:
+        """Start every pending job whose dependencies have all finished and fits the budget, skipping complete ones."""
+        progress: bool = True
+        while progress:
+            progress = False
+            ready: list[str] = [name for name in self.jobs if name in pending and self._is_ready(self.jobs[name])]
+            # split free worker slots between jobs ready at the same time
+            shares: dict[str, int] = {}
+            if self.budget is not None:
+                shares = self.budget.shares(
+                    {
+                        name: self._job_resources(self.jobs[name]).max_workers
+                        for name in ready
+                        if self.jobs[name].gate is None
+                    }
+                )
+            for name in ready:
+                job: Job = self.jobs[name]
+                if self._is_complete(job):
+                    pending.discard(name)
+                    print(f"Skipping {name}, inputs and outputs unchanged since it last completed", file=sys.stderr)
+                    self.skipped.add(name)
+                    self.finished.add(name)
+                    if self.report is not None:
+                        self.report.add_skipped(name)
+                    # a skipped job can make its dependents ready right away
+                    progress = True
+                    continue
+                workers: int | None = None
+                if self.budget is not None and job.gate is None:
+                    workers = self.budget.acquire(name, self._job_resources(job), shares[name])
+                    if not workers:
+                        # waits for a running job to release its workers
+                        continue
+                pending.discard(name)
+                self._launch(name, workers)
+
+    def kill_running(self) -> None:
+        """Kill every job that is still running."""
+        # held while signalling, so a job exiting meanwhile is reaped only after
+        with self._live_lock:
+            self._track_pooled()
+            for name, pid in self._live.items():
+                try:
+                    os.killpg(pid, signal.SIGTERM)
+                    print(f"Killing {name}", file=sys.stderr)
+                except ProcessLookupError:
+                    pass
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _record(self, name: str, pid: int | None, status: int, usage: dict[str, Any] | None) -> None:
+        """Add the usage of an exited job to the report and its run to the trace. Gates are not recorded."""
+        if self.jobs[name].gate is not None:
+            return
+        # pooled jobs report the pid of the worker they ran in
+        pid = (usage or {}).pop("pid", pid)
+        started, start, workers = self._started[name]
+        record: dict[str, Any] = {
+            "kind": "job",
+            "status": "failed" if status else "success",
+            "started": started,
+            "wall_time_s": round(time.monotonic() - start, 3),
+            **(usage or {}),
+        }
+        if workers is not None:
+            record["workers"] = workers
+        if self.report is not None:
+            self.report.add(name, record)
+        if pid is None:
+            # a pooled job whose worker died never reported its pid
+            return
+        # on the track of the job's own process, where its in-process spans also land
+        etl_trace.name_process(name, pid)
+        details: dict[str, Any] = {key: record[key] for key in ("status", "workers") if key in record}
+        etl_trace.add_event(name, "job", started, record["wall_time_s"], details, pid, pid)
+
+    def _drop_dependents(self, pending: set[str]) -> None:
+        """Fail every pending job that depends on a failed one, directly or not."""
+        progress: bool = True
+        while progress:
+            progress = False
+            for name in list(self.jobs):
+                failed_deps: list[str] = [dep for dep in self.jobs[name].deps if dep in self.failed]
+                if name in pending and failed_deps:
+                    print(f"Not running {name} as {', '.join(failed_deps)} failed", file=sys.stderr)
+                    pending.discard(name)
+                    self.failed.add(name)
+                    progress = True
+
+    def run(self) -> None:
+        """Run all queued jobs to completion. Exit with status 1 if any job fails."""
+        for job in self.jobs.values():
+            missing: list[str] = [dep for dep in job.deps + job.after if dep not in self.jobs]
+            if missing:
+                msg = f"Job {job.name} depends on jobs that were never added: {', '.join(missing)}"
+                raise ValueError(msg)
+        pending: set[str] = set(self.jobs)
+        try:
+            self._launch_ready(pending)
+            while self.running:
+                name, status, usage = self._events.get()
+                self._record(name, self.running.pop(name), status, usage)
+                if self.budget is not None:
+                    self.budget.release(name)
+                if status and self.keep_going:
+                    print(f"Something went wrong while processing the {name}, continuing with other jobs", file=sys.stderr)
+                    self.failed.add(name)
+                    self._drop_dependents(pending)
+                    self._launch_ready(pending)
+                    continue
+                if status:
+                    print(
+                        f"Something went wrong while processing the {name} shutting down other running procs",
+                        file=sys.stderr,
+                    )
+                    sys.exit(1)
+                sys.stderr.write(f"Processing {name} successful!\n")
+                sys.stderr.flush()
+                job: Job = self.jobs[name]
+                if self.checkpoints is not None and job.checkpoint is not None:
+                    self.checkpoints.record(name, self._fingerprint(job))
+                self.finished.add(name)
+                self._launch_ready(pending)
+        except BaseException:
+            # Covers job failures as well as interrupts, which children in their own sessions never see
+            self.kill_running()
+            raise
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+        if pending:
+            # ready jobs left pending were refused workers with none left running to release theirs
+            starved: list[str] = sorted(name for name in pending if self._is_ready(self.jobs[name]))
+            if starved:
+                msg = f"Jobs could not be granted workers from the budget: {', '.join(starved)}"
+                raise RuntimeError(msg)
+            msg = f"Jobs could not be started due to circular dependencies: {', '.join(sorted(pending))}"
+            raise RuntimeError(msg)
+        if self.failed:
+            print(f"Failed jobs: {', '.join(sorted(self.failed))}", file=sys.stderr)
+            sys.exit(1)
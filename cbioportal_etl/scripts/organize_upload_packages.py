@@ -11,6 +11,7 @@ import os
 import subprocess
 import sys
 
+from cbioportal_etl.scripts.etl_trace import span
 from cbioportal_etl.scripts.resolve_config_paths import resolve_config_paths
 
 
@@ -42,13 +43,14 @@ def process_meta_study(meta_data: dict, output_dir: str) -> str:
     return study
 
 
-def process_meta_data(meta_data: dict, output_dir: str, canc_study_id: str) -> None:
+def process_meta_data(meta_data: dict, output_dir: str, canc_study_id: str, cwd: str) -> None:
     """Create meta_ format files for genomic data cBio import.
 
     Args:
         meta_data: Pointer to dict within config dict with genomic file info
         output_dir: Location to create each meta file
         canc_study_id: Name of study/project
+        cwd: Working dir with trailing slash, used to hard link data files
 
     """
     try:
@@ -90,7 +92,7 @@ def process_meta_data(meta_data: dict, output_dir: str, canc_study_id: str) -> N
 
 
 def process_clinical_data(
-    meta_data: dict, output_dir: str, canc_study_id: str, add_data_mode: bool = False
+    meta_data: dict, output_dir: str, canc_study_id: str, cwd: str, add_data_mode: bool = False
 ) -> None:
     """Create meta_ format files for clinical data cBio import.
 
@@ -98,6 +100,7 @@ def process_clinical_data(
         meta_data: Pointer to dict within config dict with clinical file info
         output_dir: Location to create each meta file
         canc_study_id: Name of study/project
+        cwd: Working dir with trailing slash, used to hard link data files
         add_data_mode: Flag whether creating in add data mode versus whole study
 
     """
@@ -133,7 +136,7 @@ def process_clinical_data(
 
 
 def write_case_list(
-    case_key: str, attr_dict: dict[str, str], sample_list: list[str], case_dir: str
+    case_key: str, attr_dict: dict[str, str], sample_list: list[str], case_dir: str, canc_study_id: str
 ) -> None:
     """Write case lists based on data type being described.
 
@@ -142,6 +145,7 @@ def write_case_list(
         attr_dict: Attribute dict dor that data type
         sample_list: List of samples relevant to data type
         case_dir: Output dir location
+        canc_study_id: Name of study/project
 
     """
     try:
@@ -162,12 +166,17 @@ def write_case_list(
         print(f"{e}\nError writing case list for {case_key}", file=sys.stderr)
 
 
-def create_case_lists(data_dict: dict[str, int], output_dir: str):
+def create_case_lists(
+    data_dict: dict[str, int], output_dir: str, config_data: dict, canc_study_id: str
+) -> None:
     """Iterate through config file for case list creation.
 
     Determine data types available, and initialize relevant sample lists for each data type and data type combo
     Args:
         data_dict: Dict with flags indicating data type present
+        output_dir: Study package dir
+        config_data: Study config with case list attributes
+        canc_study_id: Name of study/project
     """
     try:
         case_dir = f"{output_dir}case_lists/"
@@ -192,7 +201,7 @@ def create_case_lists(data_dict: dict[str, int], output_dir: str):
                     data: list[str] = line.rstrip("\n").split("\t")
                     muts_list.append(data[s_idx])
             muts_list = [*{*muts_list}]
-            write_case_list("cases_sequenced", config_data["cases_sequenced"], muts_list, case_dir)
+            write_case_list("cases_sequenced", config_data["cases_sequenced"], muts_list, case_dir, canc_study_id)
         # Initialize all cases with muts list, even if empty
         all_cases: list[str] = muts_list
         if data_dict["merged_cnvs"]:
@@ -202,11 +211,11 @@ def create_case_lists(data_dict: dict[str, int], output_dir: str):
                 head: str = next(cna_file)
                 # assumes header is Hugo_symbols\tsample_name1\tsamplename2 etc, if entrez ID, will need to change!
                 cna_list: list[str] = head.rstrip("\n").split("\t")[1:]
-            write_case_list("cases_cna", config_data["cases_cna"], cna_list, case_dir)
+            write_case_list("cases_cna", config_data["cases_cna"], cna_list, case_dir, canc_study_id)
             all_cases += cna_list
             # Create case list for samples with muts and cnv data
             muts_plus_cna: list[str] = list(set(muts_list) & set(cna_list))
-            write_case_list("cases_cnaseq", config_data["cases_cnaseq"], muts_plus_cna, case_dir)
+            write_case_list("cases_cnaseq", config_data["cases_cnaseq"], muts_plus_cna, case_dir, canc_study_id)
 
         if data_dict["merged_rsem"]:
             # Get samples from merged rsem file - is a simple gene by sample table
@@ -221,17 +230,17 @@ def create_case_lists(data_dict: dict[str, int], output_dir: str):
                 head: str = next(rna_file)
                 rna_list: list[str] = head.rstrip("\n").split("\t")[1:]
             write_case_list(
-                "cases_RNA_Seq_v2_mRNA", config_data["cases_RNA_Seq_v2_mRNA"], rna_list, case_dir
+                "cases_RNA_Seq_v2_mRNA", config_data["cases_RNA_Seq_v2_mRNA"], rna_list, case_dir, canc_study_id
             )
             # loading mutations is a minimum, so if cna exists...3 way file can be made
             if len(cna_list) > 0:
                 three_way: list[str] = list(set(muts_list) & set(cna_list) & set(rna_list))
                 write_case_list(
-                    "cases_3way_complete", config_data["cases_3way_complete"], three_way, case_dir
+                    "cases_3way_complete", config_data["cases_3way_complete"], three_way, case_dir, canc_study_id
                 )
             all_cases += rna_list
 
-        if "merged_fusion" in data_keys and data_keys["merged_fusion"]:
+        if "merged_fusion" in data_dict and data_dict["merged_fusion"]:
             # Get samples from merge fusion file
             fusion_fname: str = (
                 f"{output_dir}{config_data['merged_fusion']['dtypes']['fusion']['cbio_name']}"
@@ -245,80 +254,99 @@ def create_case_lists(data_dict: dict[str, int], output_dir: str):
                     data: list[str] = line.rstrip("\n").split("\t")
                     fusion_list.append(data[s_idx])
             fusion_list = [*{*fusion_list}]
-            write_case_list("cases_sv", config_data["cases_sv"], fusion_list, case_dir)
+            write_case_list("cases_sv", config_data["cases_sv"], fusion_list, case_dir, canc_study_id)
             all_cases += fusion_list
 
         all_cases = [*{*all_cases}]
-        write_case_list("cases_all", config_data["cases_all"], all_cases, case_dir)
+        write_case_list("cases_all", config_data["cases_all"], all_cases, case_dir, canc_study_id)
     except Exception as e:
         print(f"{e}\nError creating case lists", file=sys.stderr)
         sys.exit(1)
 
 
-parser = argparse.ArgumentParser(
-    description="Create cases lists, meta files, and organize data for cbio upload."
-    " It is assumed you are at the dir level of all input data files"
-)
-parser.add_argument(
-    "-o", "--output_dir", action="store", dest="out_dir", help="output directory name"
-)
-parser.add_argument(
-    "-c",
-    "--config",
-    action="store",
-    dest="config_file",
-    help="json config file with meta information; see REFS/case_meta_config.json example",
-)
-parser.add_argument(
-    "-ad",
-    "--add-data",
-    action="store_true",
-    dest="add_data",
-    help="Flag to skip validation when running for add_data directory",
-)
-
-args = parser.parse_args()
-
-cwd: str = os.getcwd() + "/"
-TOOL_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-
-with open(args.config_file) as f:
-    config_data: dict = json.load(f)
-config_data: dict = resolve_config_paths(config_data, TOOL_DIR)
-
-out_dir: str = args.out_dir if args.out_dir[-1] == "/" else args.out_dir + "/"
-os.makedirs(out_dir, exist_ok=True)
-
-try:
-    study_id: str = config_data["study"]["cancer_study_identifier"]
-    if os.path.isdir(config_data["data_sheets"]["dir"]):
-        cur_dir: str = f"{out_dir}{config_data['study']['cancer_study_identifier']}/"
-        os.makedirs(cur_dir, exist_ok=True)
-        if not args.add_data:
-            print(f"Creating meta study file for {study_id}", file=sys.stderr)
-            canc_study_id = process_meta_study(config_data["study"], cur_dir)
-        else:
-            canc_study_id = study_id
-        # track whether data type in study
-        data_keys: dict[str, int] = {
-            "merged_mafs": 0,
-            "merged_cnvs": 0,
-            "merged_rsem": 0,
-            "merged_fusion": 0,
-        }
-        for key in data_keys:
-            merged_dir = config_data[key]["dir"]
-            if key in config_data and merged_dir != "" and os.path.isdir(merged_dir):
-                data_keys[key] = 1
-                process_meta_data(config_data[key], cur_dir, canc_study_id)
-                print(f"Creating meta data files and links for {key}", file=sys.stderr)
+def run_py(args: argparse.Namespace, config_data: dict | None = None) -> None:
+    """Run the script, likely a wrapper function call.
+
+    Args:
+        args: Command line arguments
+        config_data: Pre-parsed study config with resolved paths, read from args.config_file if not given
+
+    """
+    cwd: str = os.getcwd() + "/"
+    if config_data is None:
+        TOOL_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(args.config_file) as f:
+            config_data = json.load(f)
+        config_data = resolve_config_paths(config_data, TOOL_DIR)
+
+    out_dir: str = args.out_dir if args.out_dir[-1] == "/" else args.out_dir + "/"
+    os.makedirs(out_dir, exist_ok=True)
+
+    try:
+        study_id: str = config_data["study"]["cancer_study_identifier"]
+        if os.path.isdir(config_data["data_sheets"]["dir"]):
+            cur_dir: str = f"{out_dir}{config_data['study']['cancer_study_identifier']}/"
+            os.makedirs(cur_dir, exist_ok=True)
+            if not args.add_data:
+                print(f"Creating meta study file for {study_id}", file=sys.stderr)
+                canc_study_id = process_meta_study(config_data["study"], cur_dir)
             else:
-                print(f"Skipping meta files for {key}, either key or path not present", file=sys.stderr)
-        print("Creating clinical meta sheets and link", file=sys.stderr)
-        process_clinical_data(config_data["data_sheets"], cur_dir, canc_study_id, args.add_data)
-        if not args.add_data:
-            create_case_lists(data_keys, cur_dir)
-    else:
-        print(f"No datasheets for {study_id}, skipping!", file=sys.stderr)
-except Exception as e:
-    print(f"{e}\nerror processing files for {study_id}!", file=sys.stderr)
+                canc_study_id = study_id
+            # track whether data type in study
+            data_keys: dict[str, int] = {
+                "merged_mafs": 0,
+                "merged_cnvs": 0,
+                "merged_rsem": 0,
+                "merged_fusion": 0,
+            }
+            for key in data_keys:
+                merged_dir = config_data[key]["dir"]
+                if key in config_data and merged_dir != "" and os.path.isdir(merged_dir):
+                    data_keys[key] = 1
+                    with span(f"meta {key}", "packaging"):
+                        process_meta_data(config_data[key], cur_dir, canc_study_id, cwd)
+                    print(f"Creating meta data files and links for {key}", file=sys.stderr)
+                else:
+                    print(f"Skipping meta files for {key}, either key or path not present", file=sys.stderr)
+            print("Creating clinical meta sheets and link", file=sys.stderr)
+            with span("clinical data", "packaging"):
+                process_clinical_data(config_data["data_sheets"], cur_dir, canc_study_id, cwd, args.add_data)
+            if not args.add_data:
+                with span("case lists", "packaging"):
+                    create_case_lists(data_keys, cur_dir, config_data, canc_study_id)
+        else:
+            print(f"No datasheets for {study_id}, skipping!", file=sys.stderr)
+    except Exception as e:
+        print(f"{e}\nerror processing files for {study_id}!", file=sys.stderr)
+
+
+def main() -> None:
+    """Parse args and run script."""
+    parser = argparse.ArgumentParser(
+        description="Create cases lists, meta files, and organize data for cbio upload."
+        " It is assumed you are at the dir level of all input data files"
+    )
+    parser.add_argument(
+        "-o", "--output_dir", action="store", dest="out_dir", help="output directory name"
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        action="store",
+        dest="config_file",
+        help="json config file with meta information; see REFS/case_meta_config.json example",
+    )
+    parser.add_argument(
+        "-ad",
+        "--add-data",
+        action="store_true",
+        dest="add_data",
+        help="Flag to skip validation when running for add_data directory",
+    )
+
+    args = parser.parse_args()
+    run_py(args)
+
+
+if __name__ == "__main__":
+    main()
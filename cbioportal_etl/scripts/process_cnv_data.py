@@ -13,6 +13,9 @@ from typing import IO
 from pybedtools import BedTool, cleanup
 
 from cbioportal_etl.scripts.resolve_config_paths import resolve_config_paths
+from cbioportal_etl.scripts.resource_budget import worker_count
+from cbioportal_etl.scripts.shared_refs import load_gene_bed
+from cbioportal_etl.scripts.stage_profiler import run_task
 
 
 def mp_process_cnv_data(
@@ -184,7 +187,8 @@ def read_and_process_ctrlfreec_seg(ctrlfreec_seg_fname: str, sample_id: str) ->
     """
     with open(ctrlfreec_seg_fname) as f:
         cnv_reader: csv.reader._reader = csv.reader(f, delimiter="\t")
-        _header = next(cnv_reader)
+        # skip header
+        next(cnv_reader)
         out_seg_list: list[str] = []
         for entry in cnv_reader:
             entry[0] = sample_id
@@ -256,7 +260,8 @@ def read_and_process_cnvkit_theta2_cns(cns_fname: str) -> BedTool:
     """
     with open(cns_fname) as f:
         cnv_reader = csv.reader(f, delimiter="\t")
-        _header = next(cnv_reader)
+        # skip header
+        next(cnv_reader)
         # create bed str representation of CNV data, stripping leading chr from chrom
         cnv_filtered_as_bed: str = "\n".join(
             ["\t".join([bed[0].removeprefix("chr"), bed[1], bed[2], bed[6]]) for bed in cnv_reader]
@@ -357,37 +362,24 @@ def prioritize_cnvs(
     return cnv_ftypes
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Merges files in gene <tab> entrez id <tab> copy number format into a genes-by-sample copy number table"
-    )
-    parser.add_argument(
-        "-t",
-        "--table",
-        action="store",
-        dest="table",
-        help="Table with cbio project, kf bs ids, cbio IDs, and file names",
-    )
+def run_py(args: argparse.Namespace, config_data: dict | None = None) -> None:
+    """Run the script, likely a wrapper function call.
 
-    parser.add_argument(
-        "-j",
-        "--config",
-        action="store",
-        dest="config_file",
-        help="json config file with data types and data locations",
-    )
-
-    args = parser.parse_args()
-    TOOL_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    Args:
+        args: Command line arguments
+        config_data: Pre-parsed study config with resolved paths, read from args.config_file if not given
 
-    with open(args.config_file) as f:
-        config_data = json.load(f)
-    config_data: dict = resolve_config_paths(config_data, TOOL_DIR)
+    """
+    if config_data is None:
+        TOOL_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(args.config_file) as f:
+            config_data = json.load(f)
+        config_data = resolve_config_paths(config_data, TOOL_DIR)
     print(f"Prioritizing CNV calls base on {config_data['cnv_priority']}", file=sys.stderr)
     # subset cnv and seg data using priority from config file
     prioritized_cnv_meta = prioritize_cnvs(args.table, config_data['cnv_priority'])
 
-    ref_bed = BedTool(config_data["bed_genes"])
+    ref_bed = load_gene_bed(config_data["bed_genes"])
     out_dir: str = "merged_cnvs"
     os.makedirs(out_dir, exist_ok=True)
     # cnv meta should have ALL IDs to be processed
@@ -401,9 +393,12 @@ def main():
         # Keep track of ploidy for non-GATK to use as default value
         ploidy_dict: dict[str, int] = {}
         samp_list: list[str] = list(samp_data.keys())
-        with ProcessPoolExecutor() as executor:
+        with ProcessPoolExecutor(max_workers=worker_count()) as executor:
             tasks = [
                 executor.submit(
+                    run_task,
+                    f"cnv {cbio_sample}",
+                    "task",
                     mp_process_cnv_data,
                     cbio_sample,
                     prioritized_cnv_meta["cnv"][project][cbio_sample],
@@ -462,5 +457,31 @@ def main():
         print(f"Finished processing {project} CNV data", file=sys.stderr)
 
 
+
+def main():
+    """Parse args and run script."""
+    parser = argparse.ArgumentParser(
+        description="Merges files in gene <tab> entrez id <tab> copy number format into a genes-by-sample copy number table"
+    )
+    parser.add_argument(
+        "-t",
+        "--table",
+        action="store",
+        dest="table",
+        help="Table with cbio project, kf bs ids, cbio IDs, and file names",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--config",
+        action="store",
+        dest="config_file",
+        help="json config file with data types and data locations",
+    )
+
+    args = parser.parse_args()
+    run_py(args)
+
+
 if __name__ == "__main__":
     main()
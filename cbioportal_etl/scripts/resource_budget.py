@@ -0,0 +1,134 @@
+"""Run-wide CPU and memory budget shared by concurrent ETL jobs.
+
+The scheduler grants each job a number of worker slots out of --max-workers, and only as many as fit
+its memory estimate within --max-memory. The grant reaches the job through the CBIO_ETL_WORKERS
+environment variable, which scripts use to size their worker pools via worker_count, and memory
+granted out of a limited budget through CBIO_ETL_MEMORY.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+from threading import Lock
+from typing import NamedTuple
+
+WORKERS_ENV: str = "CBIO_ETL_WORKERS"
+MEMORY_ENV: str = "CBIO_ETL_MEMORY"
+MEMORY_UNITS: dict[str, int] = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+class JobResources(NamedTuple):
+    """Named tuple with the most workers a job can use and its memory estimate in bytes."""
+
+    max_workers: int = 1
+    base_memory: int = 0
+    worker_memory: int = 0
+
+
+def parse_memory(memory: str | None) -> int | None:
+    """Parse a memory size like 48G or 512M into bytes. None means no limit."""
+    if not memory:
+        return None
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*", memory, re.IGNORECASE)
+    if match is None:
+        msg = f"Invalid memory size {memory}, expected a number with an optional K, M, G or T suffix"
+        raise ValueError(msg)
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+
+
+def worker_count(default: int | None = None) -> int:
+    """Get the worker pool size granted to this job, or default if not run under a budget.
+
+    Args:
+        default: Pool size to use when run standalone, the number of cpus if not given
+
+    """
+    granted: str | None = os.environ.get(WORKERS_ENV)
+    if granted:
+        return max(1, int(granted))
+    return default or os.cpu_count() or 1
+
+
+class ResourceBudget:
+    """Worker slots and memory handed out to running jobs, safe to share across threads."""
+
+    def __init__(self, max_workers: int | None = None, max_memory: int | None = None) -> None:
+        """Initialize a budget with nothing granted.
+
+        Args:
+            max_workers: Total worker slots across all jobs, the number of cpus if not given
+            max_memory: Total memory in bytes across all jobs, unlimited if not given
+
+        """
+        self.max_workers: int = max_workers or os.cpu_count() or 1
+        self.max_memory: int | None = max_memory
+        self.granted: dict[str, tuple[int, int]] = {}
+        self.lock = Lock()
+
+    def free(self) -> tuple[int, int | None]:
+        """Get the worker slots and memory not granted to any job."""
+        with self.lock:
+            workers: int = self.max_workers - sum(w for w, _m in self.granted.values())
+            if self.max_memory is None:
+                return workers, None
+            return workers, self.max_memory - sum(m for _w, m in self.granted.values())
+
+    def shares(self, demands: dict[str, int]) -> dict[str, int]:
+        """Split free worker slots between jobs ready at the same time.
+
+        Jobs wanting fewer slots than an even split get all they want, and the rest is split evenly
+        between the others.
+
+        Args:
+            demands: Most workers each job can use
+
+        Returns:
+            Most workers to grant each job, at least one
+
+        """
+        free_workers, _free_memory = self.free()
+        shares: dict[str, int] = {}
+        remaining: list[str] = sorted(demands, key=lambda name: demands[name])
+        while remaining:
+            name: str = remaining.pop(0)
+            shares[name] = max(1, min(demands[name], free_workers // (len(remaining) + 1)))
+            free_workers -= shares[name]
+        return shares
+
+    def acquire(self, name: str, resources: JobResources, share: int | None = None) -> int:
+        """Grant a job as many workers as are free, up to its max and share, that fit in free memory.
+
+        A job is always granted one worker if nothing else holds any, even if over budget,
+        so that a single large job can still run.
+
+        Args:
+            name: Job name
+            resources: Worker and memory needs of the job
+            share: Most workers to grant, to leave slots for other jobs ready at the same time
+
+        Returns:
+            Number of workers granted, 0 if the job must wait for others to release theirs
+
+        """
+        with self.lock:
+            free_workers: int = self.max_workers - sum(w for w, _m in self.granted.values())
+            workers: int = min(resources.max_workers, free_workers, share or free_workers)
+            if self.max_memory is not None:
+                free_memory: int = self.max_memory - sum(m for _w, m in self.granted.values())
+                fit_memory: int = free_memory - resources.base_memory
+                if resources.worker_memory:
+                    workers = min(workers, fit_memory // resources.worker_memory)
+                elif fit_memory < 0:
+                    workers = 0
+            if workers < 1:
+                if self.granted:
+                    return 0
+                workers = 1
+            self.granted[name] = (workers, resources.base_memory + workers * resources.worker_memory)
+            return workers
+
+    def release(self, name: str) -> None:
+        """Return the workers and memory granted to a job."""
+        with self.lock:
+            self.granted.pop(name, None)
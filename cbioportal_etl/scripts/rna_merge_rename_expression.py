@@ -9,15 +9,16 @@ Final result also z scored across cohort as log2(FPKM + 1) or as log2(TPM + 1)
 
 import argparse
 import concurrent.futures
-import io
 import json
 import os
 import sys
-import tarfile
 
 import numpy as np
 import pandas as pd
 from cbioportal_etl.scripts.resolve_config_paths import resolve_config_paths
+from cbioportal_etl.scripts.resource_budget import worker_count
+from cbioportal_etl.scripts.shared_refs import load_healthy_refs
+from cbioportal_etl.scripts.stage_profiler import run_task
 from scipy import stats
 
 
@@ -40,63 +41,36 @@ def load_rsem_file(rsem_file: str, sample: str, rsem_dir: str, expr_type: str) -
         return None
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Merge rsem files using cavatica file info.")
-    parser.add_argument(
-        "-t",
-        "--table",
-        action="store",
-        dest="table",
-        help="Table with cbio project, kf bs ids, cbio IDs, and file names",
-    )
-    parser.add_argument(
-        "-r", 
-        "--rsem-dir", 
-        action="store", 
-        dest="rsem_dir", 
-        help="rsem file directory"
-    )
-    parser.add_argument(
-        "-et", 
-        "--expression-type", 
-        action="store", 
-        dest="expression_type", 
-        choices=["TPM", "FPKM"], 
-        default="TPM", 
-        help="Which expression value to use: TPM or FPKM. Default is TPM."
-    )
-    parser.add_argument(
-        "-sc", 
-        "--study-config", 
-        action="store", 
-        dest="study_config", 
-        help="cbio study config file."
-    )
-    parser.add_argument(
-        "-dmt", 
-        "--default-match-type", 
-        action="store", 
-        dest="default_match_type", 
-        choices=["polyA", "totalRNA", "none"], 
-        default="none", 
-        help="Default match type for samples with unknown RNA library type for z-score calculations. Use 'polyA' or 'totalRNA' to override fallback to intra-cohort z-score."
-    )    
-    args = parser.parse_args()
+def run_py(
+    args: argparse.Namespace,
+    config_data: dict | None = None,
+    all_file_meta: pd.DataFrame | None = None,
+) -> None:
+    """Run the script, likely a wrapper function call.
+
+    Args:
+        args: Command line arguments
+        config_data: Pre-parsed study config with resolved paths, read from args.study_config if not given
+        all_file_meta: Pre-parsed ETL table, read from args.table if not given
 
+    """
     rsem_dir = args.rsem_dir.rstrip("/")
     out_dir = "merged_rsem/"
     os.makedirs(out_dir, exist_ok=True)
 
-    all_file_meta = pd.read_csv(args.table, sep="\t", dtype={"cbio_sample_name": str})
+    if all_file_meta is None:
+        all_file_meta = pd.read_csv(args.table, sep="\t", dtype={"cbio_sample_name": str})
     rna_subset = all_file_meta[all_file_meta["etl_file_type"] == "rsem"].copy()
     rsem_list = rna_subset[["file_name", "cbio_sample_name"]].drop_duplicates().values.tolist()
 
     print("Reading RSEM files...", file=sys.stderr)
     seen = set()
     df_list = []
-    with concurrent.futures.ProcessPoolExecutor() as executor:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count()) as executor:
         futures = {
-            executor.submit(load_rsem_file, fname, sample, rsem_dir, args.expression_type): sample
+            executor.submit(
+                run_task, f"rsem {fname}", "task", load_rsem_file, fname, sample, rsem_dir, args.expression_type
+            ): sample
             for fname, sample in rsem_list if sample not in seen and not seen.add(sample)
         }
         for i, fut in enumerate(concurrent.futures.as_completed(futures), 1):
@@ -129,33 +103,13 @@ if __name__ == "__main__":
     # Studies with library type column will be processed by library type 
     if "etl_experiment_strategy" in rna_subset.columns:
         # load healthy references
-        TOOL_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-
-        with open(args.study_config) as f:
-            config_data: dict = json.load(f)
-        config_data = resolve_config_paths(config_data, TOOL_DIR)
-
-        healthy_files = {}
-
-        archive_path = config_data["rsem_ref"]["archive"]
-        with tarfile.open(archive_path, "r:gz") as tar:
-            for member in tar.getmembers():
-                if not member.isfile():
-                    continue
-                name = os.path.basename(member.name)
-                if name.endswith(f"_{args.expression_type}.tsv"):
-                    key = name.replace(f"_log_{args.expression_type}.tsv", "") + f"_{args.expression_type}"
-                    file_obj = tar.extractfile(member)
-                    if file_obj:
-                        df = pd.read_csv(io.TextIOWrapper(file_obj), sep="\t", index_col=0)
-                        # convert genes to Hugo symbols
-                        df["Hugo_Symbol"] = df.index.str.split("_", n=1).str[1]
-                        # keep the most highly expressed entry per Hugo symbol for duplicates
-                        df["mean_expr"] = df.drop(columns="Hugo_Symbol").mean(axis=1)
-                        df = df.sort_values("mean_expr", ascending=False).drop_duplicates("Hugo_Symbol", keep="first")
-                        df.set_index("Hugo_Symbol", inplace=True)
-                        df.drop(columns="mean_expr", inplace=True)
-                        healthy_files[key] = df
+        if config_data is None:
+            TOOL_DIR: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            with open(args.study_config) as f:
+                config_data = json.load(f)
+            config_data = resolve_config_paths(config_data, TOOL_DIR)
+
+        healthy_files = load_healthy_refs(config_data["rsem_ref"]["archive"], args.expression_type)
 
         zscore_intracohort = []
         zscore_vs_healthy = []
@@ -240,3 +194,53 @@ if __name__ == "__main__":
             sub_samples = rna_subset[rna_subset["cbio_project"] == project]["cbio_sample_name"].tolist()
             outfile = f"{out_dir}{project}.rsem_merged_tumor_only_zscore_{args.expression_type}.txt"
             master_zscore_log[sub_samples].to_csv(outfile, sep="\t", float_format="%.4f")
+
+
+def main() -> None:
+    """Parse args and run script."""
+    parser = argparse.ArgumentParser(description="Merge rsem files using cavatica file info.")
+    parser.add_argument(
+        "-t",
+        "--table",
+        action="store",
+        dest="table",
+        help="Table with cbio project, kf bs ids, cbio IDs, and file names",
+    )
+    parser.add_argument(
+        "-r", 
+        "--rsem-dir", 
+        action="store", 
+        dest="rsem_dir", 
+        help="rsem file directory"
+    )
+    parser.add_argument(
+        "-et", 
+        "--expression-type", 
+        action="store", 
+        dest="expression_type", 
+        choices=["TPM", "FPKM"], 
+        default="TPM", 
+        help="Which expression value to use: TPM or FPKM. Default is TPM."
+    )
+    parser.add_argument(
+        "-sc", 
+        "--study-config", 
+        action="store", 
+        dest="study_config", 
+        help="cbio study config file."
+    )
+    parser.add_argument(
+        "-dmt", 
+        "--default-match-type", 
+        action="store", 
+        dest="default_match_type", 
+        choices=["polyA", "totalRNA", "none"], 
+        default="none", 
+        help="Default match type for samples with unknown RNA library type for z-score calculations. Use 'polyA' or 'totalRNA' to override fallback to intra-cohort z-score."
+    )    
+    args = parser.parse_args()
+    run_py(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Per-stage performance records of an ETL run, written to etl_run_report.json.
+
+Each run_etl step and each scheduled job gets a record with wall time, user and sys cpu time, peak
+RSS, and bytes read and written. Jobs are measured from their exit status and rusage (wait4), which
+include every process they spawned, and from /proc/<pid>/io read before the job is reaped. Steps are
+measured with getrusage and /proc/self/io deltas, which include the jobs the step waited on.
+
+Records are keyed by stage name and merged into an existing report, so that reruns, or runs split
+across several calls like batch phases, keep the latest measurement of every stage.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import resource
+import sys
+import time
+from collections.abc import Callable
+from threading import Lock
+from typing import Any
+
+REPORT_FILE: str = "etl_run_report.json"
+
+
+def read_proc_io(pid: int | str = "self") -> dict[str, int] | None:
+    """Read the io counters of a process, including its reaped children. None where /proc is missing."""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f if ": " in line)}
+    except (OSError, ValueError):
+        return None
+
+
+def wait_with_usage(pid: int, on_exit: Callable[[], None] | None = None) -> tuple[int, dict[str, Any]]:
+    """Wait for a child and reap it, measuring what it and its descendants used.
+
+    Args:
+        pid: Child process id
+        on_exit: Called once the child exited, before it is reaped and its pid can be reused
+
+    Returns:
+        Exit status of the child and its usage: user/sys cpu seconds, peak RSS in KB of the
+        largest process, and bytes read and written
+
+    """
+    io_counters: dict[str, int] | None = None
+    can_peek: bool = hasattr(os, "waitid")
+    if can_peek:
+        # wait without reaping, so the exited child's io counters can still be read
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        io_counters = read_proc_io(pid)
+        if on_exit is not None:
+            on_exit()
+    _pid, wait_status, rusage = os.wait4(pid, 0)
+    if on_exit is not None and not can_peek:
+        on_exit()
+    usage: dict[str, Any] = {
+        "user_cpu_s": round(rusage.ru_utime, 3),
+        "sys_cpu_s": round(rusage.ru_stime, 3),
+        "max_rss_kb": rusage.ru_maxrss,
+        **io_usage(io_counters),
+    }
+    return os.waitstatus_to_exitcode(wait_status), usage
+
+
+def io_usage(io_counters: dict[str, int] | None, start: dict[str, int] | None = None) -> dict[str, int | None]:
+    """Get bytes read and written, all and from disk only, optionally since a start reading."""
+    keys: dict[str, str] = {
+        "bytes_in": "rchar",
+        "bytes_out": "wchar",
+        "disk_bytes_in": "read_bytes",
+        "disk_bytes_out": "write_bytes",
+    }
+    if io_counters is None:
+        return {field: None for field in keys}
+    start = start or {}
+    return {field: io_counters.get(key, 0) - start.get(key, 0) for field, key in keys.items()}
+
+
+class StageTimer:
+    """Context manager measuring a stage run in this process, including children it waited on."""
+
+    def __init__(self, report: RunReport, name: str, kind: str = "step") -> None:
+        """Set the stage to measure.
+
+        Args:
+            report: Report to add the record to
+            name: Stage name
+            kind: Type of stage, like step or job
+
+        """
+        self.report: RunReport = report
+        self.name: str = name
+        self.kind: str = kind
+
+    def __enter__(self) -> StageTimer:
+        """Take starting readings."""
+        self.started: float = time.time()
+        self.start: float = time.monotonic()
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io_start: dict[str, int] | None = read_proc_io()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        """Add the record of the stage, failed if it raised or exited non-zero."""
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        failed: bool = exc_type is not None and not (exc_type is SystemExit and not getattr(exc, "code", 1))
+        io_end: dict[str, int] | None = read_proc_io() if self.io_start is not None else None
+        self.report.add(
+            self.name,
+            {
+                "kind": self.kind,
+                "status": "failed" if failed else "success",
+                "started": self.started,
+                "wall_time_s": round(time.monotonic() - self.start, 3),
+                "user_cpu_s": round(
+                    self_usage.ru_utime - self.self_usage.ru_utime + child_usage.ru_utime - self.child_usage.ru_utime, 3
+                ),
+                "sys_cpu_s": round(
+                    self_usage.ru_stime - self.self_usage.ru_stime + child_usage.ru_stime - self.child_usage.ru_stime, 3
+                ),
+                # lifetime peaks, as rusage has no per-stage peak
+                "max_rss_kb": max(self_usage.ru_maxrss, child_usage.ru_maxrss),
+                **io_usage(io_end, self.io_start),
+            },
+        )
+
+
+class RunReport:
+    """Performance records of the stages of a run, safe to share across threads."""
+
+    def __init__(self, path: str = REPORT_FILE) -> None:
+        """Initialize an empty report.
+
+        Args:
+            path: Report file location
+
+        """
+        self.path: str = path
+        self.stages: dict[str, dict[str, Any]] = {}
+        self.lock = Lock()
+
+    def add(self, name: str, record: dict[str, Any]) -> None:
+        """Add or replace the record of a stage."""
+        with self.lock:
+            self.stages[name] = record
+
+    def add_skipped(self, name: str, kind: str = "job") -> None:
+        """Note a stage skipped by its checkpoint. Keeps its last measured record, if any, in the file."""
+        self.add(name, {"kind": kind, "status": "skipped", "started": time.time()})
+
+    def write(self) -> None:
+        """Merge this run's records into the report file."""
+        with self.lock:
+            records: dict[str, dict[str, Any]] = {}
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path) as f:
+                        records = json.load(f).get("stages", {})
+                except (OSError, ValueError) as e:
+                    print(f"WARN: {e} reading {self.path}, starting a new report", file=sys.stderr)
+            for name, record in self.stages.items():
+                if record["status"] != "skipped" or name not in records:
+                    records[name] = record
+            tmp_path: str = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"updated": time.strftime("%Y-%m-%d %H:%M:%S"), "stages": records}, f, indent=2)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,121 @@
+"""Native S3 downloads for manifest rows with an s3_path in a bucket listed by the --aws-tbl.
+
+The AWS table lists a bucket, or a prefix of one, and the AWS profile to read it with on each line:
+    s3://bucket-name    profile-name
+
+Objects are looked up with a HEAD request for their size and ETag, then fetched through presigned
+URLs by the same run-wide download scheduler as SBG files. Large objects are split into ranges over
+every free worker, like a multipart S3 transfer, and get the resume journal, digests and download
+cache of any other download. Presigned URLs that expire during a long run are signed anew.
+
+Rows in buckets the table does not list, or whose object cannot be read, fall back to SBG.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    from botocore.client import BaseClient
+
+# Presigned URLs outlive most downloads, longer ones sign a new URL when it expires
+PRESIGN_SECONDS: int = 3600
+
+
+class S3Object(NamedTuple):
+    """Named tuple with the size, ETag and version of an S3 object.
+
+    The ETag is None if it is no md5, like with KMS encryption. The version is the version ID in a
+    versioned bucket, else the ETag as sent.
+    """
+
+    size: int
+    etag: str | None
+    version: str
+
+
+def split_s3_path(s3_path: str) -> tuple[str, str]:
+    """Split an s3://bucket/key path into bucket and key."""
+    bucket, _sep, key = s3_path.removeprefix("s3://").partition("/")
+    return bucket, key
+
+
+def parse_aws_tbl(aws_tbl: str) -> dict[str, str]:
+    """Read an AWS table of bucket, or bucket prefix, and AWS profile name pairs.
+
+    Args:
+        aws_tbl: Tab or space separated file, lines starting with # are skipped
+
+    Returns:
+        AWS profile names by s3 path prefix
+
+    """
+    profiles: dict[str, str] = {}
+    with open(aws_tbl) as f:
+        for line in f:
+            fields: list[str] = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            if len(fields) < 2:
+                logging.getLogger(__name__).warning("No AWS profile for %s in %s, skipping it", fields[0], aws_tbl)
+                continue
+            prefix: str = fields[0] if fields[0].startswith("s3://") else f"s3://{fields[0]}"
+            profiles[prefix.rstrip("/")] = fields[1]
+    return profiles
+
+
+class S3Source:
+    """Looks up and signs S3 objects with the AWS profile of their bucket, safe to share across threads."""
+
+    def __init__(self, aws_tbl: str, endpoint_url: str | None = None, max_connections: int = 10) -> None:
+        """Initialize the source, clients are created on first use of each profile.
+
+        Args:
+            aws_tbl: AWS table of bucket and profile name pairs
+            endpoint_url: S3 endpoint other than AWS, like a MinIO server
+            max_connections: Connection pool size of each client
+
+        """
+        self.profiles: dict[str, str] = parse_aws_tbl(aws_tbl)
+        self.endpoint_url: str | None = endpoint_url
+        self.max_connections: int = max_connections
+        self.clients: dict[str, BaseClient] = {}
+        self.lock = threading.Lock()
+
+    def profile(self, s3_path: str) -> str | None:
+        """Get the AWS profile of the longest table prefix of an s3 path, None if it has none."""
+        matches: list[str] = [
+            prefix for prefix in self.profiles if s3_path == prefix or s3_path.startswith(f"{prefix}/")
+        ]
+        return self.profiles[max(matches, key=len)] if matches else None
+
+    def client(self, profile: str) -> BaseClient:
+        """Get the S3 client of an AWS profile."""
+        with self.lock:
+            if profile not in self.clients:
+                import boto3
+                from botocore.config import Config
+
+                config = Config(
+                    max_pool_connections=self.max_connections, retries={"max_attempts": 10, "mode": "adaptive"}
+                )
+                self.clients[profile] = boto3.Session(profile_name=profile).client(
+                    "s3", endpoint_url=self.endpoint_url, config=config
+                )
+            return self.clients[profile]
+
+    def head(self, s3_path: str) -> S3Object:
+        """Get the size, ETag and version of an object, raising if it cannot be read."""
+        bucket, key = split_s3_path(s3_path)
+        response: dict = self.client(self.profile(s3_path)).head_object(Bucket=bucket, Key=key)
+        etag: str | None = response["ETag"].strip('"') if response.get("ServerSideEncryption") != "aws:kms" else None
+        return S3Object(response["ContentLength"], etag, response.get("VersionId") or response["ETag"].strip('"'))
+
+    def presign(self, s3_path: str) -> str:
+        """Sign a URL to GET an object with."""
+        bucket, key = split_s3_path(s3_path)
+        return self.client(self.profile(s3_path)).generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=PRESIGN_SECONDS
+        )
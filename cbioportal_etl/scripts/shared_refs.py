@@ -0,0 +1,62 @@
+"""Reference data used by merge jobs, loaded at most once per process.
+
+In-process merge jobs run in pool workers that are reused across jobs, so each worker reads a
+reference once however many jobs use it.
+"""
+
+from __future__ import annotations
+
+import io
+import os
+import tarfile
+from functools import cache
+from typing import TYPE_CHECKING
+
+import pandas as pd
+
+if TYPE_CHECKING:
+    from pybedtools import BedTool
+
+
+@cache
+def load_healthy_refs(archive_path: str, expression_type: str) -> dict[str, pd.DataFrame]:
+    """Read healthy expression references of one type from the rsem_ref archive.
+
+    Args:
+        archive_path: tar.gz archive with *_log_{expression_type}.tsv reference tables
+        expression_type: TPM or FPKM
+
+    Returns:
+        Reference tables indexed by Hugo symbol, keyed by healthy_{match type}_{expression type}.
+        Shared by all callers, do not modify
+
+    """
+    healthy_files: dict[str, pd.DataFrame] = {}
+    with tarfile.open(archive_path, "r:gz") as tar:
+        for member in tar.getmembers():
+            if not member.isfile():
+                continue
+            name = os.path.basename(member.name)
+            if name.endswith(f"_{expression_type}.tsv"):
+                key = name.replace(f"_log_{expression_type}.tsv", "") + f"_{expression_type}"
+                file_obj = tar.extractfile(member)
+                if file_obj:
+                    df = pd.read_csv(io.TextIOWrapper(file_obj), sep="\t", index_col=0)
+                    # convert genes to Hugo symbols
+                    df["Hugo_Symbol"] = df.index.str.split("_", n=1).str[1]
+                    # keep the most highly expressed entry per Hugo symbol for duplicates
+                    df["mean_expr"] = df.drop(columns="Hugo_Symbol").mean(axis=1)
+                    df = df.sort_values("mean_expr", ascending=False).drop_duplicates("Hugo_Symbol", keep="first")
+                    df.set_index("Hugo_Symbol", inplace=True)
+                    df.drop(columns="mean_expr", inplace=True)
+                    healthy_files[key] = df
+    return healthy_files
+
+
+@cache
+def load_gene_bed(bed_path: str) -> BedTool:
+    """Load the bed_genes reference intersected with every CNV file."""
+    from pybedtools import BedTool
+
+    return BedTool(bed_path)
+
@@ -0,0 +1,150 @@
+"""cProfile hooks for the ETL stages selected with --profile-stage.
+
+The entry point of a profiled stage runs under cProfile, and so do the tasks its process pool
+workers run. Workers dump their stats next to the stage's, and these are merged into a single .prof
+file once the stage ends, written next to the stage log, like collate_mafs.prof for collate_mafs.log.
+Examine them with python3 -m pstats or snakeviz.
+
+Thread pool tasks run outside the profiled thread and show up as time the stage spent waiting on
+them.
+
+Also runs a script under the stage profiler, for subprocess jobs:
+    python3 -m cbioportal_etl.scripts.stage_profiler -o collate_mafs.prof maf_merge.py [args]
+"""
+
+from __future__ import annotations
+
+import argparse
+import cProfile
+import glob
+import os
+import pstats
+import runpy
+import sys
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+from cbioportal_etl.scripts.etl_trace import run_traced
+
+PROFILE_ENV: str = "CBIO_ETL_PROFILE"
+# --profile-stage names and the step 6 jobs, or step, each profiles
+STAGE_JOBS: dict[str, tuple[str, ...]] = {
+    "maf": ("mafs", "dgd_maf"),
+    "cnv": ("cnvs",),
+    "rsem": ("rsem",),
+    "fusion": ("fusion", "dgd_fusion"),
+    "diff": ("3",),
+}
+
+# profile of the stage run by this process, and of the pool tasks run by it if it is a worker
+_stage_profile: cProfile.Profile | None = None
+_stage_pid: int | None = None
+_task_profile: cProfile.Profile | None = None
+_task_pid: int | None = None
+
+
+def parse_profile_stages(stages: str | None) -> set[str]:
+    """Parse a csv string of stages to profile into the step 6 jobs and steps they cover.
+
+    Args:
+        stages: csv string of maf, cnv, rsem, fusion and diff
+
+    Returns:
+        Step 6 job names and step numbers to profile
+
+    """
+    if not stages:
+        return set()
+    jobs: set[str] = set()
+    for stage in stages.split(","):
+        stage = stage.strip()
+        if stage not in STAGE_JOBS:
+            msg = f"Unknown stage {stage} to profile, expected any of {', '.join(STAGE_JOBS)}"
+            raise ValueError(msg)
+        jobs.update(STAGE_JOBS[stage])
+    return jobs
+
+
+@contextmanager
+def profiled(path: str | None) -> Iterator[None]:
+    """Profile a stage run in this process and the pool tasks of its workers, then write the stats to path.
+
+    Args:
+        path: Stats file to write, nothing is profiled if not given
+
+    """
+    global _stage_profile, _stage_pid
+    if not path:
+        yield
+        return
+    path = os.path.abspath(path)
+    for stale in glob.glob(f"{path}.*.worker"):
+        os.remove(stale)
+    os.environ[PROFILE_ENV] = path
+    profile = cProfile.Profile()
+    _stage_profile, _stage_pid = profile, os.getpid()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _stage_profile = None
+        del os.environ[PROFILE_ENV]
+        stats = pstats.Stats(profile)
+        worker_files: list[str] = sorted(glob.glob(f"{path}.*.worker"))
+        for worker_file in worker_files:
+            stats.add(worker_file)
+            os.remove(worker_file)
+        stats.dump_stats(path)
+        print(f"Wrote profile of this stage and {len(worker_files)} pool worker(s) to {path}", file=sys.stderr)
+
+
+@contextmanager
+def profile_task() -> Iterator[None]:
+    """Profile a pool task if its stage is profiled, adding it to the stats of this worker."""
+    global _task_profile, _task_pid
+    path: str | None = os.environ.get(PROFILE_ENV)
+    if not path or os.getpid() == _stage_pid:
+        yield
+        return
+    if _task_pid != os.getpid():
+        if _stage_profile is not None:
+            # forked from the stage process while it was profiled, stop recording into the copy
+            _stage_profile.disable()
+        _task_profile, _task_pid = cProfile.Profile(), os.getpid()
+    _task_profile.enable()
+    try:
+        yield
+    finally:
+        _task_profile.disable()
+        # workers may never exit cleanly, so the stats so far are dumped after every task
+        _task_profile.dump_stats(f"{path}.{os.getpid()}.worker")
+
+
+def run_task(name: str, cat: str, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Call a pool task in a trace span, profiled if its stage is.
+
+    Top level, so it can be submitted to process pools in place of func.
+    """
+    with profile_task():
+        return run_traced(name, cat, func, *args, **kwargs)
+
+
+def main() -> None:
+    """Run a script under the stage profiler."""
+    parser = argparse.ArgumentParser(description="Run a python script, profiling it and its pool tasks")
+    parser.add_argument("-o", "--outfile", action="store", dest="outfile", required=True, help="Stats file to write")
+    parser.add_argument("script", help="Script to run")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Args of the script")
+    args = parser.parse_args()
+
+    # run it as python3 script.py would, with its dir first on the path
+    sys.argv = [args.script, *args.script_args]
+    sys.path[0] = os.path.dirname(os.path.abspath(args.script))
+    with profiled(args.outfile):
+        runpy.run_path(args.script, run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
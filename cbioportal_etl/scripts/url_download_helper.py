@@ -1,12 +1,14 @@
-"""Helper functions for downloading files from URLs with retry logic and parallelization.
+"""Helper functions for downloading files or byte ranges of them from URLs with retry logic.
 
 Overall function created from co-pilot prompt, refined and debugged by M. Brown
 """
 from __future__ import annotations
 
+import hashlib
 import logging
+import os
 import random
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections.abc import Callable
 from time import sleep
 
 import requests
@@ -18,7 +20,40 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+# Hosts a session keeps a connection pool for, download URLs point at a handful of storage hosts
+POOLED_HOSTS: int = 10
+# Bytes read off the socket and written per call, bounding the memory of a transfer
+STREAM_CHUNK: int = 256 * 1024
+# Downloads are written to <name>.part, with the size and version of their source, and the byte
+# ranges done so far and their md5, listed in <name>.part.journal
+PART_SUFFIX: str = ".part"
+JOURNAL_SUFFIX: str = ".journal"
+# Statuses of a signed URL that expired, which no retry of the same URL fixes
+EXPIRED_STATUSES: tuple[int, ...] = (401, 403)
+# Statuses of a server throttling requests, retried after backing off like timeouts
+THROTTLE_STATUSES: tuple[int, ...] = (429, 503)
+
+
+class ExpiredURLError(Exception):
+    """A download URL was refused, like a signed URL past its expiry, and needs signing anew."""
+
+
+def pooled_session(pool_size: int) -> requests.Session:
+    """Create a session keeping alive up to pool_size connections per host, to share across download threads.
+
+    Args:
+        pool_size (int): Connections kept per host, the number of downloads run at once.
+
+    Returns:
+        requests.Session: Session reusing connections, and their TLS handshakes, across downloads.
+
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOLED_HOSTS, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 
 def _request_with_retries(
         session: requests.Session,
@@ -26,7 +61,8 @@ def _request_with_retries(
         headers: dict[str, str] | None = None,
         stream: bool = True,
         retries: int = 5,
-        delay: int = 3
+        delay: int = 3,
+        on_throttle: Callable[[], None] | None = None,
         ) -> requests.Response| None:
     """Perform a GET request with retries and exponential backoff.
 
@@ -37,6 +73,8 @@ def _request_with_retries(
         stream (bool, optional): Whether to stream the response. Defaults to True.
         retries (int, optional): Number of retry attempts on failure. Defaults to 5.
         delay (int, optional): Initial delay between retries in seconds. Defaults to 3.
+        on_throttle (Callable[[], None], optional): Called when the server throttles or times out a request,
+            so callers can back off. Defaults to None.
 
     Returns:
         requests.Response | None: The response object or None if all retries fail.
@@ -47,6 +85,12 @@ def _request_with_retries(
     for attempt in range(retries):
         try:
             response =  session.get(url, headers=headers, stream=stream, timeout=30)
+            if response.status_code in EXPIRED_STATUSES:
+                response.close()
+                msg = f"Download URL refused with status {response.status_code}, it may have expired"
+                raise ExpiredURLError(msg)
+            if response.status_code in THROTTLE_STATUSES and on_throttle is not None:
+                on_throttle()
             response.raise_for_status()
 
             if attempt > 0:
@@ -54,6 +98,8 @@ def _request_with_retries(
             return response
         except (requests.RequestException, requests.Timeout, requests.HTTPError) as e:  # noqa: PERF203
             logger.warning("Error downloading %s", url)
+            if isinstance(e, (requests.ConnectionError, requests.Timeout)) and on_throttle is not None:
+                on_throttle()
             if attempt < retries - 1:
                 logger.warning("Retrying in %d seconds...", delay)
                 sleep(delay + random.uniform(0, 1))
@@ -64,116 +110,235 @@ def _request_with_retries(
     return None
 
 
+def journal_header(size: int, version: str | None = None) -> str:
+    """First line of a journal, naming the size and version of the source its partial download is of."""
+    return f"# size {size} version {version or ''}".rstrip()
+
+
+def discard_partial(part_path: str) -> None:
+    """Remove a partial download and its journal, if any."""
+    for stale in (part_path, part_path + JOURNAL_SUFFIX):
+        if os.path.exists(stale):
+            os.remove(stale)
+
+
+def read_journal(part_path: str, size: int, version: str | None = None) -> dict[tuple[int, int], list[str]]:
+    """Get the byte ranges of a partial download already done, discarding it if it cannot be resumed.
+
+    A partial download is only kept if its journal names the same source size and version, so bytes
+    of a file changed at the source are never stitched to its new ones. Discarded, a new journal is
+    started in its place.
+
+    Args:
+        part_path (str): Path of the partial download.
+        size (int): Expected size of the whole file.
+        version (str | None): Version the source reports for the file, if any.
+
+    Returns:
+        dict[tuple[int, int], list[str]]: md5 hex digests of the parts of each range done, by its inclusive
+            start and end.
+
+    """
+    journal_path = part_path + JOURNAL_SUFFIX
+    header = journal_header(size, version)
+    same_source = False
+    done: dict[tuple[int, int], list[str]] = {}
+    try:
+        with open(journal_path) as f:
+            same_source = f.readline().strip() == header
+            # ranges are written into a file preallocated to its full size
+            if same_source and os.path.getsize(part_path) == size:
+                for line in f:
+                    byte_range, _sep, md5s = line.strip().partition(" ")
+                    start, sep, end = byte_range.partition("-")
+                    digests = md5s.split(",")
+                    # a line cut short by a crash is not a range done
+                    if sep and start.isdigit() and end.isdigit() and all(len(md5) == 32 for md5 in digests):
+                        done[(int(start), int(end))] = digests
+    except OSError:
+        pass
+    if not same_source:
+        discard_partial(part_path)
+        with open(journal_path, "w") as f:
+            f.write(header + "\n")
+    return done
+
+
+def journal_range(part_path: str, start: int, end: int, md5s: list[str]) -> None:
+    """Record a byte range of a partial download and the md5s of its parts, in one append so threads need no lock."""
+    fd = os.open(part_path + JOURNAL_SUFFIX, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, f"{start}-{end} {','.join(md5s)}\n".encode())
+    finally:
+        os.close(fd)
+
+
+def finish_part(part_path: str, output_path: str) -> None:
+    """Move a completed download into place atomically and drop its journal."""
+    os.replace(part_path, output_path)
+    if os.path.exists(part_path + JOURNAL_SUFFIX):
+        os.remove(part_path + JOURNAL_SUFFIX)
+
+
+def pwrite_all(fd: int, data: bytes, offset: int) -> None:
+    """Write all of data at an offset of a file, which os.pwrite alone may cut short."""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+class PartHasher:
+    """Hashes a stream in consecutive parts of a fixed size, as one part if no size is given."""
+
+    def __init__(self, part_size: int | None = None) -> None:
+        """Start with no bytes hashed.
+
+        Args:
+            part_size (int, optional): Size of the parts hashed on their own.
+
+        """
+        self.part_size = part_size
+        self.written = 0
+        self.digests = []
+
+    def update(self, chunk: bytes) -> None:
+        """Hash the next chunk of the stream, starting a new part at each part boundary."""
+        view = memoryview(chunk)
+        while view:
+            if not self.digests or self.part_size and self.written % self.part_size == 0:
+                self.digests.append(hashlib.md5())  # noqa: S324
+            # bytes left in the current part
+            room = self.part_size - self.written % self.part_size if self.part_size else len(view)
+            self.digests[-1].update(view[:room])
+            self.written += min(room, len(view))
+            view = view[room:]
+
+    def hexdigests(self) -> list[str]:
+        """Get the md5 hex digests of the parts hashed so far, one of no bytes if none were."""
+        return [digest.hexdigest() for digest in self.digests] or [hashlib.md5().hexdigest()]  # noqa: S324
+
+
+def check_range_response(status: int, content_range: str | None, start: int, end: int) -> None:
+    """Raise ValueError unless a response is the 206 Partial Content of exactly the range requested."""
+    logger = logging.getLogger(__name__)
+    if status != 206:
+        v_err = f"Expected 206 Partial Content, got {status}"
+        raise ValueError(v_err)
+    logger.debug("Content-Range: %s", content_range)
+    expected_prefix = f"bytes {start}-{end}/"
+    if not content_range or not content_range.startswith(expected_prefix):
+        v_err = f"Invalid Content-Range: {content_range}, expected {expected_prefix}"
+        raise ValueError(v_err)
+
+
+def check_range_size(start: int, end: int, written: int) -> None:
+    """Raise ValueError unless a range was written whole."""
+    logging.getLogger(__name__).debug("Downloaded chunk size: %d, expected: %d", written, end - start + 1)
+    expected_size = end - start + 1
+    if written != expected_size:
+        v_err = f"Incomplete chunk {start}-{end}: got {written}, expected {expected_size}"
+        raise ValueError(v_err)
+
+
 def download_range(session: requests.Session,
                    url: str,
                    start: int,
                    end: int,
+                   fd: int,
                    retries=5,
-                   delay=3) -> tuple[int, bytearray]:
-    """Download a specific byte range from a URL with retry logic.
+                   delay=3,
+                   part_size: int | None = None,
+                   on_throttle: Callable[[], None] | None = None) -> list[str]:
+    """Download a specific byte range from a URL with retry logic, straight into place in a file.
+
+    Chunks are written at their offset as they arrive, so ranges of one file can be downloaded by
+    several threads sharing the file descriptor, and no range is ever held in memory. The range is
+    hashed as it streams in, in parts of part_size bytes if given, so ranges of any size that start
+    on a part boundary combine into one multipart ETag.
 
     Args:
         session (requests.Session): The requests session to use.
         url (str): The URL to download from.
         start (int): The starting byte position.
         end (int): The ending byte position.
+        fd (int): Descriptor of the output file, opened for writing and preallocated.
         retries (int): Number of retry attempts on failure.
         delay (int): Initial delay between retries in seconds.
+        part_size (int, optional): Size of the parts hashed on their own, the whole range is one part if not given.
+        on_throttle (Callable[[], None], optional): Called when the server throttles or times out a request.
 
     Returns:
-        tuple[int, bytes]: A tuple containing the starting byte position and the downloaded data.
+        list[str]: md5 hex digests of the consecutive parts of the range.
 
     """
-    logger = logging.getLogger(__name__)
     headers = {"Range": f"bytes={start}-{end}"}
-    with _request_with_retries(session, url, headers, True, retries, delay) as response:
+    with _request_with_retries(session, url, headers, True, retries, delay, on_throttle) as response:
         # Validate range support
-        if response.status_code != 206:
-            v_err = f"Expected 206 Partial Content, got {response.status_code}"
-            raise ValueError(v_err)
-
-        content_range = response.headers.get("Content-Range")
-        logger.debug("Content-Range: %s", content_range)
-        expected_prefix = f"bytes {start}-{end}/"
-
-        if not content_range or not content_range.startswith(expected_prefix):
-            v_err = f"Invalid Content-Range: {content_range}, expected {expected_prefix}"
-            raise ValueError(v_err)
-        data = bytearray()
-        for chunk in response.iter_content(chunk_size=8192):
+        check_range_response(response.status_code, response.headers.get("Content-Range"), start, end)
+        hasher = PartHasher(part_size)
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK):
             if chunk:
-                data.extend(chunk)
+                pwrite_all(fd, chunk, start + hasher.written)
+                hasher.update(chunk)
     # Integrity check
-    logger.debug("Downloaded chunk size: %d, expected: %d", len(data), end - start + 1)
-    expected_size = end - start + 1
-    if len(data) != expected_size:
-        v_err = f"Incomplete chunk {start}-{end}: got {len(data)}, expected {expected_size}"
-        raise ValueError(v_err)
+    check_range_size(start, end, hasher.written)
 
-    return start, data
+    return hasher.hexdigests()
 
 
-def parallel_download(
+def small_download(
         url: str,
         output_path: str,
-        total_size: int,
-        num_workers: int = 8,
-        chunk_size: int = 32 * 1024 * 1024
-        ) -> None:
-    """Download a file in parallel using multiple threads.
-
-    Args:
-        url (str): The URL to download from.
-        output_path (str): The path to save the downloaded file.
-        total_size (int): The total size of the file in bytes.
-        num_workers (int): The number of parallel threads to use.
-        chunk_size (int): The size of each chunk to download.
-
-    """
-    logger = logging.getLogger(__name__)
-    ranges = [
-        (start, min(start + chunk_size - 1, total_size - 1))
-        for start in range(0, total_size, chunk_size)
-        ]
-    logger.debug("Download ranges: %s", ranges)
-    with open(output_path, "wb") as f:
-        f.truncate(total_size)  # preallocate
-
-    session = requests.Session()
-    session.mount("https://", adapter)
-
-    with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        futures = [
-            executor.submit(download_range, session, url, start, end)
-            for start, end in ranges
-        ]
-
-        with open(output_path, "r+b") as f:
-            for future in as_completed(futures):
-                start, data = future.result()
-                f.seek(start)
-                f.write(data)
-
-    session.close()
-
-
-def small_download(url: str, output_path: str, retries: int = 5, delay: int = 3) -> None:
-    """Download a small file with retry logic.
+        retries: int = 5,
+        delay: int = 3,
+        offset: int = 0,
+        on_throttle: Callable[[], None] | None = None,
+        session: requests.Session | None = None
+        ) -> str:
+    """Download a small file with retry logic, hashing it as it streams in.
 
     Args:
         url (str): The URL to download from.
         output_path (str): The path to save the downloaded file.
         retries (int): Number of retry attempts on failure.
         delay (int): Initial delay between retries in seconds.
+        offset (int): Bytes of the file already at output_path, only the rest is downloaded.
+        on_throttle (Callable[[], None], optional): Called when the server throttles or times out a request.
+        session (requests.Session, optional): Session to download with, like the pooled one of a run. A
+            session of its own is used if not given.
 
-    """
-    session = requests.Session()
-    session.mount("https://", adapter)
-
-    response = _request_with_retries(session, url, None, False, retries, delay)
-    with open(output_path, "wb") as f:
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
+    Returns:
+        str: md5 hex digest of the file.
 
-    session.close()
+    """
+    own_session = session is None
+    if session is None:
+        session = pooled_session(1)
+
+    headers = {"Range": f"bytes={offset}-"} if offset else None
+    try:
+        with _request_with_retries(session, url, headers, True, retries, delay, on_throttle) as response:
+            content_range = response.headers.get("Content-Range", "")
+            if offset and response.status_code == 206 and content_range.startswith(f"bytes {offset}-"):
+                mode = "r+b"
+            else:
+                # no range support, start over
+                mode, offset = "wb", 0
+            digest = hashlib.md5()  # noqa: S324
+            with open(output_path, mode) as f:
+                # a resumed download hashes the part it keeps, read back only this once
+                while f.tell() < offset and (chunk := f.read(min(STREAM_CHUNK, offset - f.tell()))):
+                    digest.update(chunk)
+                f.seek(offset)
+                f.truncate()
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK):
+                    if chunk:
+                        f.write(chunk)
+                        digest.update(chunk)
+    finally:
+        # a shared session keeps its connections alive for the next download
+        if own_session:
+            session.close()
+    return digest.hexdigest()
@@ -1,17 +1,39 @@
 """cBio ETL wrapper."""
 
+import csv
+import importlib
 import os
 import subprocess
 import sys
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 
-from cbioportal_etl.scripts.check_downloads import run_py as check_downloads
-from cbioportal_etl.scripts.diff_studies import run_py as diff_studies
-from cbioportal_etl.scripts.generate_config import run_py as generate_config
-from cbioportal_etl.scripts.genomics_file_cbio_package_build import (
-    run_py as genomics_file_cbio_package_build,
+from cbioportal_etl.scripts import etl_trace
+from cbioportal_etl.scripts.checkpoint import (
+    CheckpointStore,
+    StageFingerprint,
+    hash_file_content,
+    hash_obj,
+    parse_force,
+    stat_paths,
 )
-from cbioportal_etl.scripts.get_files_from_manifest import run_py as get_files_from_manifest
-from cbioportal_etl.scripts.get_study_metadata import run_py as get_study_metadata
+from cbioportal_etl.scripts.run_report import RunReport, StageTimer
+from cbioportal_etl.scripts.stage_profiler import parse_profile_stages, profiled
+
+# Scripts of each step, only imported once the step runs as most pull in pandas and database or API clients
+STEP_MODULES: dict[str, str] = {
+    "1": "cbioportal_etl.scripts.generate_config",
+    "2": "cbioportal_etl.scripts.get_study_metadata",
+    "3": "cbioportal_etl.scripts.diff_studies",
+    "4": "cbioportal_etl.scripts.get_files_from_manifest",
+    "5": "cbioportal_etl.scripts.check_downloads",
+    "6": "cbioportal_etl.scripts.genomics_file_cbio_package_build",
+}
+
+
+def step_entry(step: str) -> Callable:
+    """Import the script of a step and get its run_py entry point."""
+    return importlib.import_module(STEP_MODULES[step]).run_py
 
 
 def fetch_validator_scripts(tool_dir: str) -> None:
@@ -34,6 +56,90 @@ def fetch_validator_scripts(tool_dir: str) -> None:
             raise
 
 
+def manifest_file_paths(manifest: str) -> list[str]:
+    """List file_type/file_name paths of a downloaded files manifest, empty if it does not exist."""
+    if not os.path.isfile(manifest):
+        return []
+    with open(manifest) as f:
+        return [f"{row['file_type']}/{row['file_name']}" for row in csv.DictReader(f, delimiter="\t")]
+
+
+def download_fingerprint(args) -> StageFingerprint:
+    """Fingerprint step 4 by manifest and cbio manifest content and download flags."""
+    inputs: dict = {
+        "manifests": [hash_file_content(manifest) for manifest in args.manifest.split(",")],
+        "cbio": hash_file_content(args.cbio),
+        "flags": [args.file_types, args.active_only, args.rm_na, args.aws_tbl],
+    }
+    output_dirs: set[str] = {os.path.dirname(path) for path in manifest_file_paths(args.manifest_subset)}
+    return StageFingerprint(hash_obj(inputs), (args.manifest_subset, *sorted(output_dirs)))
+
+
+def check_fingerprint(args) -> StageFingerprint:
+    """Fingerprint step 5 by the downloaded files manifest, the size and mtime of its files and the checks run."""
+    inputs: dict = {
+        "manifest": hash_file_content(args.manifest_subset),
+        "files": stat_paths(manifest_file_paths(args.manifest_subset)),
+        "size_only": getattr(args, "size_only", False),
+    }
+    return StageFingerprint(hash_obj(inputs), ())
+
+
+class BackgroundDownload:
+    """Step 4 running in a background thread, publishing each completed file type to step 6."""
+
+    def __init__(self, args, report: RunReport) -> None:
+        """Start the downloads."""
+        from cbioportal_etl.scripts.get_files_from_manifest import DownloadTracker
+
+        self.tracker = DownloadTracker()
+        self.pool = ThreadPoolExecutor(1)
+        self.future = self.pool.submit(self._run, args, report)
+
+    def _run(self, args, report: RunReport) -> int:
+        """Download, releasing every waiting consumer however it ends."""
+        try:
+            # cpu time and io of the record overlap with step 6, which runs meanwhile
+            with StageTimer(report, "step_4"), etl_trace.span("step_4", "step"):
+                return step_entry("4")(args, self.tracker, report)
+        finally:
+            self.tracker.close()
+
+    def cancel(self) -> None:
+        """Stop downloading files and wait for in flight ones to finish."""
+        self.tracker.cancelled.set()
+        self.pool.shutdown(wait=True)
+
+    def result(self) -> int:
+        """Wait for all downloads, raising any step 4 error."""
+        try:
+            return self.future.result()
+        finally:
+            self.pool.shutdown()
+
+
+def run_package_build(
+    args, background: BackgroundDownload | None, checkpoints: CheckpointStore, report: RunReport
+) -> None:
+    """Run step 6, starting each merge as the files it reads are downloaded if step 4 runs in the background."""
+    if background is None:
+        step_entry("6")(args, report=report)
+        return
+    try:
+        step_entry("6")(args, background.tracker, report)
+    except BaseException:
+        background.cancel()
+        raise
+    print("Waiting for Step 4 to finish the remaining downloads...")
+    try:
+        background.result()
+    except Exception as e:
+        print(f"Error in Step 4: {e}", file=sys.stderr)
+        sys.exit(1)
+    checkpoints.record("4", download_fingerprint(args))
+    print("Step 4 completed successfully.\n")
+
+
 def run_etl(args, steps):
     tool_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -44,26 +150,82 @@ def run_etl(args, steps):
     args.ref_dir = args.ref_dir or os.path.join(tool_dir, "REFS")
 
     steps_map = {
-        "1": lambda: generate_config(args),
-        "2": lambda: get_study_metadata(args),
-        "3": lambda: diff_studies(args),
-        "4": lambda: get_files_from_manifest(args),
-        "5": lambda: check_downloads(args),
-        "6": lambda: genomics_file_cbio_package_build(args),
+        "1": lambda: step_entry("1")(args),
+        "2": lambda: step_entry("2")(args),
+        "3": lambda: step_entry("3")(args),
+        "4": lambda: step_entry("4")(args, report=report),
+        "5": lambda: step_entry("5")(args),
+        "6": lambda: run_package_build(args, background, checkpoints, report),
+    }
+
+    # Steps 1-3 pull from the data warehouse and portal, so they always rerun.
+    # Step 6 checkpoints each of its jobs on its own
+    step_fingerprints = {
+        "4": lambda: download_fingerprint(args),
+        "5": lambda: check_fingerprint(args),
     }
+    # Step 6 profiles its jobs itself, only steps run in this process are profiled here
+    step_profiles = {"3": "diff_studies.prof"}
+    profile_steps: set[str] = parse_profile_stages(getattr(args, "profile_stage", None)) & set(step_profiles)
+    checkpoints = CheckpointStore(parse_force(getattr(args, "force", None)))
+    if args.overwrite:
+        checkpoints.force.add("4")
+    # debug runs only preview the manifest subset, which is never a complete step 4
+    if args.debug:
+        del step_fingerprints["4"]
+
+    # Pipelined runs download in the background while step 6 starts each merge as soon as the file types
+    # it reads are complete. Step 5 then checks the downloads once they are all done
+    background: BackgroundDownload | None = None
+    pipeline: bool = (
+        getattr(args, "pipeline", False)
+        and not args.debug
+        and "4" in steps
+        and "6" in steps
+        and steps.index("4") < steps.index("6")
+    )
+    if pipeline and "5" in steps:
+        steps = [step for step in steps if step != "5"]
+        steps.insert(steps.index("6") + 1, "5")
 
     if "6" in steps:
         fetch_validator_scripts(tool_dir)
 
-    for step in steps:
-        if step in steps_map:
-            print(f"\nRunning Step {step}...")
-            try:
-                steps_map[step]()
-                print(f"Step {step} completed successfully.\n")
-            except Exception as e:
-                print(f"Error in Step {step}: {e}", file=sys.stderr)
-                sys.exit(1)
-        else:
-            print(f"Error: Invalid step {step}.")
-            sys.exit(1)
+    # Wall time, cpu time, peak RSS and io of every step and step 6 job, written however the run ends,
+    # and with --trace, a timeline of steps, downloads, jobs and their worker tasks
+    report = RunReport()
+    try:
+        with etl_trace.tracing(getattr(args, "trace", None)):
+            for step in steps:
+                if step in steps_map:
+                    fingerprint = step_fingerprints.get(step)
+                    if fingerprint and checkpoints.is_current(step, fingerprint()):
+                        print(f"\nSkipping Step {step}, inputs and outputs unchanged since it last completed.\n")
+                        report.add_skipped(f"step_{step}", "step")
+                        continue
+                    if step == "4" and pipeline:
+                        print("\nStarting Step 4 in the background, Step 6 merges start as each file type completes...")
+                        checkpoints.invalidate(step)
+                        background = BackgroundDownload(args, report)
+                        continue
+                    print(f"\nRunning Step {step}...")
+                    try:
+                        if fingerprint:
+                            checkpoints.invalidate(step)
+                        with (
+                            StageTimer(report, f"step_{step}"),
+                            etl_trace.span(f"step_{step}", "step"),
+                            profiled(step_profiles[step] if step in profile_steps else None),
+                        ):
+                            steps_map[step]()
+                        if fingerprint:
+                            checkpoints.record(step, fingerprint())
+                        print(f"Step {step} completed successfully.\n")
+                    except Exception as e:
+                        print(f"Error in Step {step}: {e}", file=sys.stderr)
+                        sys.exit(1)
+                else:
+                    print(f"Error: Invalid step {step}.")
+                    sys.exit(1)
+    finally:
+        report.write()
@@ -22,6 +22,12 @@ setup(
         "truststore==0.10.4",
         "pybedtools==0.12.0",
     ],
+    extras_require={
+        # --download-engine async
+        "async": ["aiohttp==3.11.13"],
+        # python -m pytest tests
+        "test": ["pytest==8.3.5", "moto[s3]==5.1.1", "aiohttp==3.11.13"],
+    },
     entry_points={
         "console_scripts": [
             "cbio-etl=cbioportal_etl.cli:main",
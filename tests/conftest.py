@@ -0,0 +1,74 @@
+"""Shared fixtures of the tests."""
+
+import http.server
+import re
+import threading
+from pathlib import Path
+from typing import NamedTuple
+
+import pytest
+
+
+class RangeServer(NamedTuple):
+    """A local HTTP server of the files in root, the Range header of each GET it served by path, and its clients."""
+
+    root: Path
+    url: str
+    requests: list[tuple[str, str | None]]
+    clients: set[tuple[str, int]]
+
+    def add(self, name: str, data: bytes) -> str:
+        """Serve data under name, returning its URL."""
+        (self.root / name).write_bytes(data)
+        return f"{self.url}/{name}"
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serve files whole or in byte ranges. URLs signed with sig=expired are refused, like an expired signed URL."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        range_header = self.headers.get("Range")
+        self.server.served.append((path, range_header))
+        # one address per connection, kept alive across requests
+        self.server.clients.add(self.client_address)
+        file = self.server.root / path.lstrip("/")
+        if "sig=expired" in query or not file.is_file():
+            self.send_response(403 if file.is_file() else 404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = file.read_bytes()
+        if range_header:
+            start, end = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header).groups()
+            start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def range_server(tmp_path):
+    """Serve the files of a dir over HTTP with range support for the length of a test."""
+    root = tmp_path / "served"
+    root.mkdir()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.daemon_threads = True
+    server.root = root
+    server.served = []
+    server.clients = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield RangeServer(root, f"http://127.0.0.1:{server.server_port}", server.served, server.clients)
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,22 @@
+"""Entry points run by the in-process tests of the job scheduler, importable by pool workers."""
+
+import os
+import subprocess
+import sys
+import time
+
+from cbioportal_etl.scripts.resource_budget import WORKERS_ENV
+
+
+def run_py(args, marker: str | None = None) -> None:
+    """Print the job's workers and cwd, then do what args.action says."""
+    print(args.name, os.environ.get(WORKERS_ENV), os.getcwd())
+    if args.action == "chdir":
+        os.chdir("/")
+    elif args.action == "fail":
+        time.sleep(0.5)
+        sys.exit(3)
+    elif args.action == "hang":
+        subprocess.run("sleep 30", shell=True, check=False)
+        with open(marker, "w") as f:
+            f.write("finished")
@@ -0,0 +1,89 @@
+"""Tests of the asyncio download engine against a local range server."""
+
+import hashlib
+import json
+import os
+import threading
+
+import pytest
+
+from cbioportal_etl.scripts import etl_trace
+from cbioportal_etl.scripts.download_state import DownloadState, multipart_etag
+from cbioportal_etl.scripts.get_files_from_manifest import DownloadTracker
+from cbioportal_etl.scripts.url_download_helper import PART_SUFFIX, read_journal
+
+pytest.importorskip("aiohttp")
+from cbioportal_etl.scripts import async_download  # noqa: E402
+from cbioportal_etl.scripts.async_download import AsyncDownloadScheduler  # noqa: E402
+
+PART_SIZE = 1024
+
+
+def download(range_server, tmp_path, files: dict[str, bytes], **kwargs) -> DownloadTracker:
+    """Download files by name with the async engine into tmp_path/maf."""
+    (tmp_path / "maf").mkdir(exist_ok=True)
+    tracker = DownloadTracker()
+    downloads = AsyncDownloadScheduler(tracker, max_workers=8, chunk_size=4 * PART_SIZE, part_size=PART_SIZE, **kwargs)
+    for name, data in files.items():
+        url = range_server.add(name, data)
+        downloads.submit(name, "maf", str(tmp_path / "maf" / name), len(data), lambda url=url: url)
+    downloads.finish_type("maf")
+    downloads.wait()
+    return tracker
+
+
+def test_downloads_whole_and_ranged_files(range_server, tmp_path):
+    files = {"small.maf": os.urandom(100), "large.maf": os.urandom(20 * PART_SIZE + 7)}
+    state = DownloadState(str(tmp_path / "state.db"))
+    tracker = download(range_server, tmp_path, files, state=state)
+    assert not tracker.failed
+    for name, data in files.items():
+        assert (tmp_path / "maf" / name).read_bytes() == data
+    large = files["large.maf"]
+    part_md5s = [hashlib.md5(large[start:start + PART_SIZE]).hexdigest() for start in range(0, len(large), PART_SIZE)]
+    assert state.get(str(tmp_path / "maf" / "large.maf"))["etag"] == multipart_etag(part_md5s)
+    assert state.get(str(tmp_path / "maf" / "small.maf"))["md5"] == hashlib.md5(files["small.maf"]).hexdigest()
+
+
+def test_disk_writes_stay_off_the_event_loop(range_server, tmp_path, monkeypatch):
+    writers = set()
+    pwrite_all = async_download.pwrite_all
+
+    def record_writer(*args):
+        writers.add(threading.current_thread().name)
+        pwrite_all(*args)
+
+    monkeypatch.setattr(async_download, "pwrite_all", record_writer)
+    tracker = download(range_server, tmp_path, {"small.maf": os.urandom(100), "large.maf": os.urandom(20 * PART_SIZE)})
+    assert len(tracker.success) == 2
+    assert writers
+    assert "download-loop" not in writers
+
+
+def test_small_download_resumes(range_server, tmp_path):
+    data = os.urandom(3000)
+    (tmp_path / "maf").mkdir()
+    part = tmp_path / "maf" / f"a.maf{PART_SUFFIX}"
+    # cut short by a failed run
+    read_journal(str(part), len(data))
+    part.write_bytes(data[:1000])
+    state = DownloadState(str(tmp_path / "state.db"))
+    tracker = download(range_server, tmp_path, {"a.maf": data}, state=state)
+    assert tracker.success == [("a.maf", str(tmp_path / "maf" / "a.maf"))]
+    assert (tmp_path / "maf" / "a.maf").read_bytes() == data
+    assert range_server.requests == [("/a.maf", "bytes=1000-")]
+    assert state.get(str(tmp_path / "maf" / "a.maf"))["md5"] == hashlib.md5(data).hexdigest()
+
+
+def test_transfers_are_traced_as_async_events(range_server, tmp_path, monkeypatch):
+    events_dir = tmp_path / "events"
+    events_dir.mkdir()
+    monkeypatch.setenv(etl_trace.TRACE_ENV, str(events_dir))
+    download(range_server, tmp_path, {f"{i}.maf": os.urandom(3000) for i in range(10)})
+    events = [json.loads(line) for events_file in events_dir.iterdir() for line in events_file.read_text().splitlines()]
+    transfers = [event for event in events if event["cat"] == "download" and event["ph"] in "be"]
+    assert len(transfers) == 20
+    # every transfer begins and ends once, on a track of its own
+    begun = {event["id"] for event in transfers if event["ph"] == "b"}
+    assert len(begun) == 10
+    assert begun == {event["id"] for event in transfers if event["ph"] == "e"}
@@ -0,0 +1,47 @@
+"""Tests of linking shared batch downloads into each study."""
+
+import hashlib
+import os
+
+from cbioportal_etl.batch import SHARED_DOWNLOAD_DIR, link_downloads
+from cbioportal_etl.scripts.check_downloads import verify_digest
+from cbioportal_etl.scripts.download_state import STATE_FILE, DownloadState
+
+DATA = b"variant rows\n" * 100
+
+
+def shared_download(tmp_path, monkeypatch) -> DownloadState:
+    """Download a file to the shared dir, recorded like step 4 does, with a study manifest listing it."""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(os.path.join(SHARED_DOWNLOAD_DIR, "maf"))
+    with open(os.path.join(SHARED_DOWNLOAD_DIR, "maf", "a.maf"), "wb") as f:
+        f.write(DATA)
+    md5 = hashlib.md5(DATA).hexdigest()
+    monkeypatch.chdir(SHARED_DOWNLOAD_DIR)
+    DownloadState().record("maf/a.maf", "file-a", len(DATA), md5, expected_md5=md5, version="v1")
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("study")
+    with open(os.path.join("study", "manifest_subset.tsv"), "w") as f:
+        f.write("file_type\tfile_name\nmaf\ta.maf\nmaf\tfailed.maf\n")
+    return DownloadState(os.path.join(SHARED_DOWNLOAD_DIR, STATE_FILE))
+
+
+def test_links_downloads_with_their_records(tmp_path, monkeypatch):
+    shared_state = shared_download(tmp_path, monkeypatch)
+    assert link_downloads("study", shared_state) == 1
+    assert os.path.samefile(os.path.join(SHARED_DOWNLOAD_DIR, "maf", "a.maf"), os.path.join("study", "maf", "a.maf"))
+    # linking again finds the files in place
+    assert link_downloads("study", shared_state) == 0
+    monkeypatch.chdir("study")
+    record = DownloadState().get("maf/a.maf")
+    assert record["version"] == "v1"
+    assert verify_digest("maf/a.maf", os.stat("maf/a.maf"), record, record["expected_md5"]) is None
+
+
+def test_linked_records_catch_corruption(tmp_path, monkeypatch):
+    link_downloads("study", shared_download(tmp_path, monkeypatch))
+    monkeypatch.chdir("study")
+    record = DownloadState().get("maf/a.maf")
+    with open("maf/a.maf", "r+b") as f:
+        f.write(b"X")
+    assert verify_digest("maf/a.maf", os.stat("maf/a.maf"), record, record["expected_md5"]).startswith("md5")
@@ -0,0 +1,95 @@
+"""Tests of checking downloads against the manifest and their download records."""
+
+import argparse
+import hashlib
+import os
+
+import pytest
+
+from cbioportal_etl.scripts import check_downloads
+from cbioportal_etl.scripts.check_downloads import verify_digest
+from cbioportal_etl.scripts.download_state import STATE_FILE, DownloadState
+
+DATA = b"maf rows\n" * 1000
+MD5 = hashlib.md5(DATA).hexdigest()
+
+
+@pytest.fixture
+def downloaded(tmp_path, monkeypatch):
+    """A file downloaded by step 4, recorded with its md5, in the working dir."""
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("maf")
+    with open("maf/a.maf", "wb") as f:
+        f.write(DATA)
+    DownloadState().record("maf/a.maf", "a", len(DATA), MD5, expected_md5=MD5)
+    return DownloadState(read_only=True).get("maf/a.maf")
+
+
+def test_recorded_digest_verifies_without_reading(downloaded, monkeypatch):
+    monkeypatch.setattr(check_downloads, "file_md5", pytest.fail)
+    assert verify_digest("maf/a.maf", os.stat("maf/a.maf"), downloaded, None) is None
+
+
+def test_manifest_md5_overrides_recorded(downloaded):
+    assert verify_digest("maf/a.maf", os.stat("maf/a.maf"), downloaded, "0" * 32) == f"md5 {MD5}, expected {'0' * 32}"
+
+
+def test_file_changed_since_its_record_fails(downloaded):
+    with open("maf/a.maf", "r+b") as f:
+        f.write(b"X")
+    assert verify_digest("maf/a.maf", os.stat("maf/a.maf"), downloaded, None).startswith("md5")
+    downloaded["expected_md5"] = None
+    assert verify_digest("maf/a.maf", os.stat("maf/a.maf"), downloaded, None).startswith("changed since")
+
+
+def test_file_without_record_or_md5_passes(tmp_path):
+    (tmp_path / "a.maf").write_bytes(DATA)
+    assert verify_digest(str(tmp_path / "a.maf"), os.stat(tmp_path / "a.maf"), None, None) is None
+
+
+def test_check_leaves_no_state_behind(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("maf")
+    with open("maf/a.maf", "wb") as f:
+        f.write(DATA)
+    with open("manifest_subset.tsv", "w") as f:
+        f.write(f"file_type\tfile_name\tmd5\nmaf\ta.maf\t{MD5}\n")
+    check_downloads.run_py(argparse.Namespace(manifest_subset="manifest_subset.tsv"))
+    assert not os.path.exists(STATE_FILE)
+    with open("missing_files.txt") as f:
+        assert f.read() == ""
+
+
+def test_scan_counts_every_problem(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for file_type in ("maf", "cnv"):
+        os.mkdir(file_type)
+    files = {"maf/ok.maf": DATA, "maf/short.maf": DATA[:10], "maf/bad.maf": DATA.upper(), "cnv/empty.cnv": b""}
+    for path, data in files.items():
+        with open(path, "wb") as f:
+            f.write(data)
+    # listed twice, checked once
+    rows = [
+        f"maf\tok.maf\t{len(DATA)}\t{MD5}",
+        f"maf\tok.maf\t{len(DATA)}\t{MD5}",
+        f"maf\tshort.maf\t{len(DATA)}\tNA",
+        f"maf\tbad.maf\t{len(DATA)}\t{MD5}",
+        "maf\tgone.maf\tNA\tNA",
+        "cnv\tempty.cnv\tNA\tNA",
+    ]
+    with open("manifest_subset.tsv", "w") as f:
+        f.write("\n".join(["file_type\tfile_name\tfile_size\tmd5sum", *rows]) + "\n")
+    with pytest.raises(SystemExit):
+        check_downloads.run_py(argparse.Namespace(manifest_subset="manifest_subset.tsv"))
+    with open("missing_files.txt") as f:
+        assert f.read().splitlines() == [
+            "cnv/empty.cnv\tempty file",
+            f"maf/bad.maf\tmd5 {hashlib.md5(DATA.upper()).hexdigest()}, expected {MD5}",
+            "maf/gone.maf",
+            f"maf/short.maf\tsize 10, expected {len(DATA)}",
+        ]
+    failed, counts = check_downloads.check_files(
+        check_downloads.read_manifest("manifest_subset.tsv"), DownloadState(read_only=True), size_only=True
+    )
+    assert counts["maf"] == {"expected": 4, "missing": 1, "size": 1, "digest": 0}
+    assert "maf/bad.maf" not in failed
@@ -0,0 +1,119 @@
+"""Tests of stage checkpoints and the scheduler skipping complete jobs."""
+
+import os
+
+import pytest
+
+from cbioportal_etl.scripts.checkpoint import CheckpointStore, StageFingerprint, hash_obj, parse_force
+from cbioportal_etl.scripts.genomics_file_cbio_package_build import appended_fingerprint
+from cbioportal_etl.scripts.job_scheduler import JobScheduler
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return CheckpointStore()
+
+
+def write(path, text: str = "data") -> str:
+    with open(path, "w") as f:
+        f.write(text)
+    return str(path)
+
+
+def test_unchanged_stage_is_current(store, tmp_path):
+    out = write(tmp_path / "out.tsv")
+    fingerprint = StageFingerprint(hash_obj(["inputs"]), (out,))
+    store.record("stage", fingerprint)
+    assert store.is_current("stage", fingerprint)
+
+
+def test_changed_inputs_invalidate(store, tmp_path):
+    out = write(tmp_path / "out.tsv")
+    store.record("stage", StageFingerprint(hash_obj(["inputs"]), (out,)))
+    assert not store.is_current("stage", StageFingerprint(hash_obj(["other inputs"]), (out,)))
+
+
+def test_touched_or_missing_outputs_invalidate(store, tmp_path):
+    out = write(tmp_path / "out.tsv")
+    fingerprint = StageFingerprint(hash_obj(["inputs"]), (out,))
+    store.record("stage", fingerprint)
+    write(out, "edited since")
+    assert not store.is_current("stage", fingerprint)
+    store.record("stage", fingerprint)
+    os.remove(out)
+    assert not store.is_current("stage", fingerprint)
+
+
+def test_output_dirs_are_walked(store, tmp_path):
+    out_dir = tmp_path / "merged"
+    out_dir.mkdir()
+    write(out_dir / "a.maf")
+    fingerprint = StageFingerprint(hash_obj(["inputs"]), (str(out_dir),))
+    store.record("stage", fingerprint)
+    write(out_dir / "b.maf")
+    assert not store.is_current("stage", fingerprint)
+
+
+def test_invalidate_drops_the_record(store, tmp_path):
+    fingerprint = StageFingerprint(hash_obj(["inputs"]), (write(tmp_path / "out.tsv"),))
+    store.record("stage", fingerprint)
+    store.invalidate("stage")
+    assert not store.is_current("stage", fingerprint)
+
+
+@pytest.mark.parametrize("force", ["stage", "6", "all"])
+def test_forced_stages_rerun(tmp_path, monkeypatch, force):
+    monkeypatch.chdir(tmp_path)
+    fingerprint = StageFingerprint(hash_obj(["inputs"]), (write(tmp_path / "out.tsv"),))
+    CheckpointStore().record("stage", fingerprint)
+    assert not CheckpointStore(parse_force(force)).is_current("stage", fingerprint, group="6")
+    assert CheckpointStore(parse_force("other")).is_current("stage", fingerprint, group="6")
+
+
+def test_append_keeps_base_stage_current(store, tmp_path):
+    merged = write(tmp_path / "merged.maf")
+    base = StageFingerprint(hash_obj(["base"]), (merged,))
+    append = StageFingerprint(hash_obj(["dgd"]), (merged,))
+    store.record("mafs", base)
+    write(merged, "with dgd rows appended")
+    store.record("dgd_maf", append)
+    assert store.is_current("mafs", base)
+    assert store.is_current("dgd_maf", append)
+
+
+def test_appended_fingerprint_changes_with_the_append():
+    base = StageFingerprint(hash_obj(["base"]), ("merged.maf",))
+    first = appended_fingerprint(lambda: base, lambda: StageFingerprint(hash_obj(["dgd v1"]), ("merged.maf",)))
+    second = appended_fingerprint(lambda: base, lambda: StageFingerprint(hash_obj(["dgd v2"]), ("merged.maf",)))
+    assert first.outputs == base.outputs
+    assert first.inputs != base.inputs
+    assert first.inputs != second.inputs
+
+
+def test_scheduler_skips_complete_jobs_unless_a_dep_reran(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runs = tmp_path / "runs.txt"
+    upstream_out = str(tmp_path / "upstream.txt")
+    downstream_out = str(tmp_path / "downstream.txt")
+
+    def run(upstream_inputs: str) -> None:
+        scheduler = JobScheduler(checkpoints=CheckpointStore())
+        scheduler.add_job(
+            "upstream",
+            f"echo upstream >> {runs}; echo {upstream_inputs} > {upstream_out}",
+            checkpoint=StageFingerprint(hash_obj([upstream_inputs]), (upstream_out,)),
+        )
+        scheduler.add_job(
+            "downstream",
+            f"echo downstream >> {runs}; touch {downstream_out}",
+            deps=("upstream",),
+            checkpoint=StageFingerprint(hash_obj(["downstream"]), (downstream_out,)),
+        )
+        scheduler.run()
+
+    run("v1")
+    run("v1")
+    assert runs.read_text().split() == ["upstream", "downstream"]
+    run("v2")
+    assert runs.read_text().split() == ["upstream", "downstream", "upstream", "downstream"]
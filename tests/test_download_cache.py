@@ -0,0 +1,79 @@
+"""Tests of the download cache shared across studies and runs."""
+
+import hashlib
+import os
+from pathlib import Path
+
+from cbioportal_etl.scripts.download_cache import DownloadCache
+from cbioportal_etl.scripts.download_scheduler import DownloadScheduler
+from cbioportal_etl.scripts.get_files_from_manifest import DownloadTracker
+
+DATA = b"maf rows\n" * 1000
+MD5 = hashlib.md5(DATA).hexdigest()
+
+
+def cached(tmp_path, file_id: str = "a", data: bytes = DATA, version: str | None = "v1", **kwargs) -> DownloadCache:
+    """A cache with a downloaded file of file_id added."""
+    download = tmp_path / f"{file_id}.maf"
+    download.write_bytes(data)
+    cache = DownloadCache(str(tmp_path / "cache"), **kwargs)
+    cache.store(file_id, str(download), hashlib.md5(data).hexdigest(), None, None, version=version)
+    return cache
+
+
+def test_fetched_file_is_a_copy_of_the_entry(tmp_path):
+    cache = cached(tmp_path)
+    dest = tmp_path / "study.maf"
+    entry = cache.fetch("a", len(DATA), str(dest), MD5, "v1")
+    assert entry.md5 == MD5
+    assert dest.read_bytes() == DATA
+    # written in place, the study's file leaves the cache and the download it came from as they were
+    with open(dest, "r+b") as f:
+        f.write(b"X")
+    assert not os.path.samefile(entry.path, dest)
+    assert Path(entry.path).read_bytes() == DATA
+    assert (tmp_path / "a.maf").read_bytes() == DATA
+    assert os.stat(entry.path).st_nlink == 1
+
+
+def test_fetch_misses_files_changed_at_the_source(tmp_path):
+    cache = cached(tmp_path)
+    dest = str(tmp_path / "study.maf")
+    assert cache.fetch("a", len(DATA), dest, MD5, "v2") is None
+    assert cache.fetch("a", len(DATA), dest, "0" * 32, "v1") is None
+    assert cache.fetch("a", len(DATA) + 1, dest, MD5, "v1") is None
+    assert cache.fetch("b", len(DATA), dest) is None
+    assert not os.path.exists(dest)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = cached(tmp_path, "a", max_bytes=len(DATA))
+    cached(tmp_path, "b")
+    os.utime(os.path.join(cache.root, "a"), ns=(0, 0))
+    assert cache.evict() == 1
+    assert sorted(os.listdir(cache.root)) == ["b"]
+
+
+def test_hardlinked_entries_are_not_counted(tmp_path):
+    cache = cached(tmp_path, "a", max_bytes=len(DATA))
+    # an entry an earlier version hardlinked into a study, which removing it does not free
+    entry = next(os.scandir(os.path.join(cache.root, "a"))).path
+    os.link(entry, tmp_path / "study.maf")
+    cached(tmp_path, "b")
+    assert cache.evict() == 0
+
+
+def test_scheduler_links_cached_files_instead_of_downloading(range_server, tmp_path):
+    cache = cached(tmp_path)
+    url = range_server.add("a.maf", DATA)
+    (tmp_path / "maf").mkdir()
+    tracker = DownloadTracker()
+    downloads = DownloadScheduler(tracker, max_workers=2, cache=cache)
+    downloads.submit("a", "maf", str(tmp_path / "maf" / "a.maf"), len(DATA), lambda: url, MD5, "v1")
+    downloads.submit("b", "maf", str(tmp_path / "maf" / "b.maf"), len(DATA), lambda: url, MD5, "v1")
+    downloads.finish_type("maf")
+    downloads.wait()
+    assert len(tracker.success) == 2
+    assert len(range_server.requests) == 1
+    # downloaded, b is cached for the next run
+    assert cache.fetch("b", len(DATA), str(tmp_path / "b-again.maf"), MD5, "v1") is not None
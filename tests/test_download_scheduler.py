@@ -0,0 +1,188 @@
+"""Tests of the run-wide download scheduler against a local range server."""
+
+import hashlib
+import os
+import threading
+import time
+from functools import partial
+
+from cbioportal_etl.scripts.download_scheduler import DownloadScheduler, RateLimiter
+from cbioportal_etl.scripts.download_state import DownloadState, multipart_etag
+from cbioportal_etl.scripts.get_files_from_manifest import DownloadTracker
+from cbioportal_etl.scripts.url_download_helper import JOURNAL_SUFFIX, PART_SUFFIX, journal_range, read_journal
+
+PART_SIZE = 1024
+
+
+def scheduler(tracker: DownloadTracker, **kwargs) -> DownloadScheduler:
+    """Scheduler with ranges of four small parts, so files of a few KB are fetched in ranges."""
+    return DownloadScheduler(tracker, max_workers=4, chunk_size=4 * PART_SIZE, part_size=PART_SIZE, **kwargs)
+
+
+def test_downloads_every_file_type(range_server, tmp_path):
+    files = {
+        "maf/small.maf": os.urandom(100),
+        "maf/large.maf": os.urandom(20 * PART_SIZE + 7),
+        "cnv/a.cnv": os.urandom(3 * PART_SIZE),
+    }
+    tracker = DownloadTracker()
+    tracker.publish_types(["maf", "cnv"])
+    downloads = scheduler(tracker)
+    for file_type in ("maf", "cnv"):
+        (tmp_path / file_type).mkdir()
+    for path, data in files.items():
+        url = range_server.add(os.path.basename(path), data)
+        downloads.submit(path, os.path.dirname(path), str(tmp_path / path), len(data), lambda url=url: url)
+    for file_type in ("maf", "cnv"):
+        downloads.finish_type(file_type)
+    downloads.wait()
+    assert not tracker.failed
+    assert sorted(file_id for file_id, _path in tracker.success) == sorted(files)
+    for path, data in files.items():
+        assert (tmp_path / path).read_bytes() == data
+        assert not os.path.exists(f"{tmp_path / path}.part")
+    assert all(event.is_set() for event in tracker.type_events.values())
+    # the large file was spread over several ranged requests
+    large = [byte_range for served, byte_range in range_server.requests if served == "/large.maf"]
+    assert len(large) > 1
+    assert all(byte_range is not None for byte_range in large)
+
+
+def test_failed_file_fails_its_type_only(range_server, tmp_path, monkeypatch):
+    # retried without backing off
+    monkeypatch.setattr("cbioportal_etl.scripts.url_download_helper.sleep", lambda _seconds: None)
+    (tmp_path / "maf").mkdir()
+    (tmp_path / "cnv").mkdir()
+    tracker = DownloadTracker()
+    tracker.publish_types(["maf", "cnv"])
+    downloads = scheduler(tracker)
+    url = range_server.add("a.cnv", b"cnv rows\n")
+    downloads.submit("cnv", "cnv", str(tmp_path / "cnv" / "a.cnv"), 9, lambda: url)
+    downloads.submit("missing", "maf", str(tmp_path / "maf" / "b.maf"), 9, lambda: f"{range_server.url}/b.maf")
+    downloads.finish_type("maf")
+    downloads.finish_type("cnv")
+    downloads.wait()
+    assert [file_id for file_id, _path, _error in tracker.failed] == ["missing"]
+    assert tracker.failed_types == {str(tmp_path / "maf")}
+    assert tracker.success == [("cnv", str(tmp_path / "cnv" / "a.cnv"))]
+    # a failed type still completes, so its consumers stop waiting
+    assert tracker.type_events["maf"].is_set()
+
+
+def test_type_completes_only_once_finished(range_server, tmp_path):
+    (tmp_path / "maf").mkdir()
+    tracker = DownloadTracker()
+    tracker.publish_types(["maf"])
+    downloads = scheduler(tracker)
+    url = range_server.add("a.maf", b"maf rows\n")
+    downloads.submit("a", "maf", str(tmp_path / "maf" / "a.maf"), 9, lambda: url)
+    downloads.wait()
+    # more files of the type may still come
+    assert not tracker.type_events["maf"].is_set()
+    downloads.finish_type("maf")
+    assert tracker.type_events["maf"].is_set()
+
+
+def test_resumes_from_journal(range_server, tmp_path):
+    data = os.urandom(12 * PART_SIZE)
+    url = range_server.add("a.maf", data)
+    (tmp_path / "maf").mkdir()
+    path = str(tmp_path / "maf" / "a.maf")
+    part = path + PART_SUFFIX
+    # the first half was done by a run that failed
+    read_journal(part, len(data), "v1")
+    with open(part, "wb") as f:
+        f.write(data[:6 * PART_SIZE])
+        f.truncate(len(data))
+    part_md5s = [hashlib.md5(data[start:start + PART_SIZE]).hexdigest() for start in range(0, len(data), PART_SIZE)]
+    journal_range(part, 0, 6 * PART_SIZE - 1, part_md5s[:6])
+    tracker = DownloadTracker()
+    state = DownloadState(str(tmp_path / "state.db"))
+    downloads = scheduler(tracker, state=state)
+    downloads.submit("a", "maf", path, len(data), lambda: url, version="v1")
+    downloads.finish_type("maf")
+    downloads.wait()
+    assert tracker.success == [("a", path)]
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert all(int(byte_range[6:].split("-")[0]) >= 6 * PART_SIZE for _path, byte_range in range_server.requests)
+    # parts of both runs make up the ETag
+    assert state.get(path)["etag"] == multipart_etag(part_md5s)
+
+
+def test_partial_of_changed_version_starts_over(range_server, tmp_path):
+    data = os.urandom(12 * PART_SIZE)
+    url = range_server.add("a.maf", data)
+    (tmp_path / "maf").mkdir()
+    path = str(tmp_path / "maf" / "a.maf")
+    part = path + PART_SUFFIX
+    read_journal(part, len(data), "v1")
+    with open(part, "wb") as f:
+        f.write(os.urandom(len(data)))
+    journal_range(part, 0, len(data) - 1, ["0" * 32] * 12)
+    tracker = DownloadTracker()
+    downloads = scheduler(tracker)
+    downloads.submit("a", "maf", path, len(data), lambda: url, version="v2")
+    downloads.finish_type("maf")
+    downloads.wait()
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(part + JOURNAL_SUFFIX)
+
+
+def test_urls_are_resolved_ahead_of_the_workers(range_server, tmp_path):
+    (tmp_path / "maf").mkdir()
+    resolved_by = []
+
+    def get_url(url):
+        resolved_by.append(threading.current_thread().name)
+        return url
+
+    tracker = DownloadTracker()
+    downloads = scheduler(tracker)
+    for i in range(8):
+        url = range_server.add(f"{i}.maf", b"maf rows\n" * (i + 1))
+        downloads.submit(str(i), "maf", str(tmp_path / "maf" / f"{i}.maf"), 9 * (i + 1), partial(get_url, url))
+    downloads.finish_type("maf")
+    downloads.wait()
+    assert len(tracker.success) == 8
+    # each file is signed once, most by the resolvers
+    assert len(resolved_by) == 8
+    assert any(name.startswith("resolve-") for name in resolved_by)
+
+
+def test_expired_url_is_signed_anew(range_server, tmp_path):
+    (tmp_path / "maf").mkdir()
+    data = os.urandom(12 * PART_SIZE)
+    url = range_server.add("a.maf", data)
+    urls = iter([f"{url}?sig=expired", f"{url}?sig=fresh"])
+    tracker = DownloadTracker()
+    downloads = scheduler(tracker)
+    downloads.submit("a", "maf", str(tmp_path / "maf" / "a.maf"), len(data), lambda: next(urls))
+    downloads.finish_type("maf")
+    downloads.wait()
+    assert tracker.success == [("a", str(tmp_path / "maf" / "a.maf"))]
+    assert (tmp_path / "maf" / "a.maf").read_bytes() == data
+
+
+def test_rate_limiter_spaces_calls():
+    limiter = RateLimiter(rate=50, burst=2)
+    start = time.monotonic()
+    for _call in range(7):
+        limiter.acquire()
+    # two calls of burst, then one every 20 ms
+    assert 0.09 <= time.monotonic() - start < 0.5
+
+
+def test_workers_share_kept_alive_connections(range_server, tmp_path):
+    (tmp_path / "maf").mkdir()
+    tracker = DownloadTracker()
+    downloads = scheduler(tracker)
+    for i in range(40):
+        url = range_server.add(f"{i}.maf", b"maf rows\n")
+        downloads.submit(str(i), "maf", str(tmp_path / "maf" / f"{i}.maf"), 9, lambda url=url: url)
+    downloads.finish_type("maf")
+    downloads.wait()
+    assert len(tracker.success) == 40
+    # no more connections than workers, however many files
+    assert len(range_server.clients) <= 4
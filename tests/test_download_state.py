@@ -0,0 +1,121 @@
+"""Tests of download records and the digests they hold."""
+
+import hashlib
+import json
+import os
+
+import pytest
+
+from cbioportal_etl.scripts.download_state import (
+    CHANGED,
+    LEGACY_STATE_FILE,
+    NEW,
+    REMOVED,
+    UNCHANGED,
+    DownloadState,
+    file_md5,
+    multipart_etag,
+)
+
+DATA = os.urandom(5000)
+
+
+def md5(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def test_multipart_etag_combines_part_md5s():
+    parts = [DATA[:2048], DATA[2048:4096], DATA[4096:]]
+    combined = hashlib.md5(b"".join(hashlib.md5(part).digest() for part in parts)).hexdigest()
+    assert multipart_etag([md5(part) for part in parts]) == f"{combined}-3"
+
+
+@pytest.mark.parametrize("part_size", [1000, 2048, 4999, 5000, 8192])
+def test_file_md5_in_parts_matches_multipart_etag(tmp_path, part_size):
+    path = tmp_path / "a.bin"
+    path.write_bytes(DATA)
+    part_md5s = [md5(DATA[start:start + part_size]) for start in range(0, len(DATA), part_size)]
+    assert file_md5(str(path), part_size) == multipart_etag(part_md5s)
+    assert file_md5(str(path)) == md5(DATA)
+
+
+def test_read_only_state_is_not_created(tmp_path):
+    path = tmp_path / "download_state.db"
+    state = DownloadState(str(path), read_only=True)
+    assert state.all_records() == {}
+    assert not path.exists()
+
+
+def test_read_only_state_reads_legacy_records_without_writing(tmp_path):
+    (tmp_path / LEGACY_STATE_FILE).write_text(json.dumps({"maf/a.maf": {"file_id": "a", "md5": md5(DATA)}}))
+    path = tmp_path / "download_state.db"
+    assert DownloadState(str(path), read_only=True).get("maf/a.maf")["md5"] == md5(DATA)
+    assert not path.exists()
+
+
+def test_read_only_state_reads_records(tmp_path):
+    path = str(tmp_path / "download_state.db")
+    (tmp_path / "a.maf").write_bytes(DATA)
+    DownloadState(path).record(str(tmp_path / "a.maf"), "a", len(DATA), md5(DATA))
+    state = DownloadState(path, read_only=True)
+    assert state.get(str(tmp_path / "a.maf"))["md5"] == md5(DATA)
+    with pytest.raises(Exception, match="readonly"):
+        state.record(str(tmp_path / "a.maf"), "a", len(DATA), md5(DATA))
+
+
+@pytest.fixture
+def recorded(tmp_path, monkeypatch) -> DownloadState:
+    """State with maf/a.maf downloaded as version v1 of file a."""
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("maf")
+    with open("maf/a.maf", "wb") as f:
+        f.write(DATA)
+    state = DownloadState()
+    state.record("maf/a.maf", "a", len(DATA), md5(DATA), version="v1")
+    return state
+
+
+def test_unchanged_file(recorded):
+    assert recorded.classify("maf/a.maf", "a", len(DATA), "v1") == UNCHANGED
+    # sources reporting no size or version leave those unchecked
+    assert recorded.classify("maf/a.maf", "a", None) == UNCHANGED
+
+
+@pytest.mark.parametrize(
+    ("file_id", "size", "version"), [("b", len(DATA), "v1"), ("a", len(DATA) + 1, "v1"), ("a", len(DATA), "v2")]
+)
+def test_file_changed_at_the_source(recorded, file_id, size, version):
+    assert recorded.classify("maf/a.maf", file_id, size, version) == CHANGED
+
+
+def test_file_changed_locally(recorded):
+    with open("maf/a.maf", "ab") as f:
+        f.write(b"X")
+    assert recorded.classify("maf/a.maf", "a", len(DATA), "v1") == CHANGED
+
+
+def test_new_and_unrecorded_files(recorded):
+    assert recorded.classify("maf/b.maf", "b", len(DATA)) == NEW
+    os.remove("maf/a.maf")
+    assert recorded.classify("maf/a.maf", "a", len(DATA), "v1") == NEW
+    # downloaded before records were kept, judged by size
+    with open("maf/c.maf", "wb") as f:
+        f.write(DATA)
+    assert recorded.classify("maf/c.maf", "c", len(DATA)) == UNCHANGED
+    assert recorded.classify("maf/c.maf", "c", len(DATA) + 1) == CHANGED
+    assert recorded.counts == {NEW: 2, UNCHANGED: 1, CHANGED: 1}
+
+
+def test_expected_file_keeps_its_record(recorded):
+    recorded.expect("maf/a.maf", "a", len(DATA), md5(DATA), "v1")
+    assert recorded.classify("maf/a.maf", "a", len(DATA), "v1") == UNCHANGED
+    assert recorded.get("maf/a.maf")["expected_md5"] == md5(DATA)
+
+
+def test_removed_files(recorded):
+    recorded.expect("cnv/a.cnv", "c", 10)
+    assert recorded.removed({"maf/b.maf"}, ["maf"]) == ["maf/a.maf"]
+    assert recorded.removed({"maf/a.maf"}, ["maf", "cnv"]) == ["cnv/a.cnv"]
+    recorded.forget(["maf/a.maf"])
+    assert recorded.get("maf/a.maf") is None
+    assert recorded.counts[REMOVED] == 2
@@ -0,0 +1,85 @@
+"""Tests of the adaptive range size and concurrency of downloads."""
+
+import threading
+import time
+
+import pytest
+
+from cbioportal_etl.scripts.download_tuner import INTERVAL, SETTLE_INTERVALS, TransferTuner
+
+MIB = 1024 * 1024
+
+
+def end_interval(tuner: TransferTuner, nbytes: int, saturated: bool = True) -> None:
+    """Record a transfer of nbytes closing an interval of INTERVAL seconds."""
+    tuner.interval_start = time.monotonic() - INTERVAL
+    tuner.saturated = saturated
+    tuner.record(nbytes, 5.0, ranged=False)
+
+
+def test_starts_at_half_concurrency():
+    tuner = TransferTuner(16, MIB, initial_parts=4)
+    assert tuner.concurrency == 8
+    assert tuner.range_size == 4 * MIB
+
+
+def test_range_size_follows_range_times():
+    tuner = TransferTuner(16, MIB, initial_parts=4, max_parts=8)
+    tuner.record(4 * MIB, 0.1, ranged=True)
+    assert tuner.range_size == 8 * MIB
+    # capped at max_parts
+    tuner.record(8 * MIB, 0.1, ranged=True)
+    assert tuner.range_size == 8 * MIB
+    tuner.record(8 * MIB, 30, ranged=True)
+    assert tuner.range_size == 4 * MIB
+    # whole file downloads leave it be
+    tuner.record(MIB, 0.1, ranged=False)
+    assert tuner.range_size == 4 * MIB
+
+
+def test_throttling_halves_concurrency_once_per_interval():
+    tuner = TransferTuner(16, MIB)
+    tuner.throttled()
+    tuner.throttled()
+    assert tuner.concurrency == 4
+    assert tuner.throttles == 2
+    end_interval(tuner, MIB)
+    tuner.throttled()
+    assert tuner.concurrency == 2
+
+
+@pytest.mark.parametrize(("gain", "kept"), [(2.0, True), (1.01, False)])
+def test_probe_is_kept_only_if_it_pays_off(gain, kept):
+    tuner = TransferTuner(16, MIB)
+    # a saturated interval probes one transfer more
+    end_interval(tuner, 80 * MIB)
+    assert tuner.concurrency == 9
+    end_interval(tuner, int(80 * MIB * gain))
+    if kept:
+        # and probes on from there
+        assert tuner.concurrency == 10
+    else:
+        assert tuner.concurrency == 8
+        assert tuner.settle == SETTLE_INTERVALS
+
+
+def test_unsaturated_window_is_not_probed():
+    tuner = TransferTuner(16, MIB)
+    end_interval(tuner, 80 * MIB, saturated=False)
+    assert tuner.concurrency == 8
+
+
+def test_slots_wait_for_the_window():
+    tuner = TransferTuner(2, MIB)
+    taken = threading.Event()
+
+    def take():
+        with tuner.slot():
+            taken.set()
+
+    with tuner.slot():
+        thread = threading.Thread(target=take)
+        thread.start()
+        assert not taken.wait(0.2)
+    assert taken.wait(2)
+    thread.join()
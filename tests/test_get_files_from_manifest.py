@@ -0,0 +1,70 @@
+"""Tests of queueing manifest files for download from their source."""
+
+from types import SimpleNamespace
+
+import pandas as pd
+
+from cbioportal_etl.scripts.download_state import DownloadState
+from cbioportal_etl.scripts.get_files_from_manifest import DownloadTracker, download_sbg, in_delta
+from cbioportal_etl.scripts.url_download_helper import JOURNAL_SUFFIX, PART_SUFFIX, read_journal
+
+MD5 = "0123456789abcdef0123456789abcdef"
+
+
+class RecordingScheduler:
+    """Scheduler recording the files submitted to it, without earlier downloads."""
+
+    state = None
+
+    def __init__(self) -> None:
+        self.submitted = []
+
+    def submit(self, file_id, file_type, path, size, get_url, expected_md5=None, version=None):
+        self.submitted.append((file_id, path, size, expected_md5, version))
+
+
+def sbg_api(files: dict[str, dict]) -> SimpleNamespace:
+    """SBG API stand-in looking up files with the metadata given, by ID."""
+    def bulk_get(file_ids):
+        return [
+            SimpleNamespace(valid=True, resource=SimpleNamespace(size=10, modified_on="2025-01-01", metadata=files[i]))
+            for i in file_ids
+        ]
+    return SimpleNamespace(files=SimpleNamespace(bulk_get=bulk_get))
+
+
+def test_sbg_files_are_queued_with_their_metadata_md5(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    selected = pd.DataFrame(
+        {"file_type": ["maf", "maf"], "file_id": ["a", "b"], "file_name": ["a.maf", "b.maf"], "s3_path": [None, None]}
+    )
+    scheduler = RecordingScheduler()
+    download_sbg("maf", selected, sbg_api({"a": {"md5": MD5.upper()}, "b": {}}), False, DownloadTracker(), scheduler)
+    assert scheduler.submitted == [
+        ("a", "maf/a.maf", 10, MD5, "2025-01-01"),
+        ("b", "maf/b.maf", 10, None, "2025-01-01"),
+    ]
+
+
+def test_sbg_manifest_without_s3_paths(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    selected = pd.DataFrame({"file_type": ["maf"], "file_id": ["a"], "file_name": ["a.maf"]})
+    scheduler = RecordingScheduler()
+    download_sbg("maf", selected, sbg_api({"a": {}}), False, DownloadTracker(), scheduler)
+    assert [file_id for file_id, *_rest in scheduler.submitted] == ["a"]
+
+
+def test_changed_file_discards_its_partial_download(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "maf").mkdir()
+    (tmp_path / "maf" / "a.maf").write_bytes(b"maf rows\n")
+    scheduler = RecordingScheduler()
+    scheduler.state = DownloadState()
+    scheduler.state.record("maf/a.maf", "a", 9, version="v1")
+    assert not in_delta(scheduler, "maf/a.maf", "a", 9, False, version="v1")
+    assert in_delta(scheduler, "maf/a.maf", "a", 9, True, version="v1")
+    read_journal(f"maf/a.maf{PART_SUFFIX}", 12, "v2")
+    (tmp_path / "maf" / f"a.maf{PART_SUFFIX}").write_bytes(b"maf rows v2\n")
+    assert in_delta(scheduler, "maf/a.maf", "a", 12, False, version="v2")
+    assert not (tmp_path / "maf" / f"a.maf{PART_SUFFIX}").exists()
+    assert not (tmp_path / "maf" / f"a.maf{PART_SUFFIX}{JOURNAL_SUFFIX}").exists()
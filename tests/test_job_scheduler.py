@@ -0,0 +1,98 @@
+"""Tests of the dependency-aware job scheduler."""
+
+import argparse
+import time
+
+import pytest
+
+from cbioportal_etl.scripts.job_scheduler import JobScheduler, PyEntry
+from cbioportal_etl.scripts.resource_budget import JobResources, ResourceBudget
+
+
+def test_runs_jobs_after_their_deps(tmp_path):
+    out = tmp_path / "order.txt"
+    scheduler = JobScheduler()
+    scheduler.add_job("second", f"echo second >> {out}", deps=("first",))
+    scheduler.add_job("first", f"sleep 0.2; echo first >> {out}")
+    scheduler.run()
+    assert out.read_text().split() == ["first", "second"]
+
+
+def test_failed_job_kills_running_siblings(tmp_path):
+    marker = tmp_path / "finished"
+    scheduler = JobScheduler()
+    scheduler.add_job("slow", f"sleep 5; touch {marker}")
+    scheduler.add_job("fails", "sleep 0.2; exit 3")
+    start = time.monotonic()
+    with pytest.raises(SystemExit):
+        scheduler.run()
+    assert time.monotonic() - start < 5
+    assert not marker.exists()
+    # the killed job is dropped once it exits, before it is reaped, so its pid is never signalled again
+    deadline = time.monotonic() + 2
+    while scheduler._live and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert scheduler._live == {}
+
+
+def test_keep_going_drops_only_dependents(tmp_path):
+    scheduler = JobScheduler(keep_going=True)
+    scheduler.add_job("fails", "exit 1")
+    scheduler.add_job("dependent", "true", deps=("fails",))
+    scheduler.add_job("independent", "true")
+    with pytest.raises(SystemExit):
+        scheduler.run()
+    assert scheduler.failed == {"fails", "dependent"}
+    assert "independent" in scheduler.finished
+
+
+def test_circular_dependencies_are_reported():
+    scheduler = JobScheduler()
+    scheduler.add_job("a", "true", deps=("b",))
+    scheduler.add_job("b", "true", deps=("a",))
+    with pytest.raises(RuntimeError, match="circular dependencies: a, b"):
+        scheduler.run()
+
+
+def test_budget_starvation_is_not_reported_as_a_cycle():
+    budget = ResourceBudget(max_workers=2)
+    # held by something outside the scheduler, never released
+    budget.granted["outside"] = (2, 0)
+    scheduler = JobScheduler(budget=budget)
+    scheduler.add_job("starved", "true", resources=JobResources(max_workers=2))
+    with pytest.raises(RuntimeError, match="granted workers from the budget: starved"):
+        scheduler.run()
+
+
+def pooled_entry(tmp_path, name: str, action: str = "", **kwargs) -> PyEntry:
+    return PyEntry(
+        "pooled_jobs",
+        argparse.Namespace(name=name, action=action),
+        str(tmp_path / f"{name}.log"),
+        stdout=str(tmp_path / "out.txt"),
+        kwargs=kwargs or None,
+    )
+
+
+def test_in_process_jobs_run_in_pool_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    scheduler = JobScheduler(in_process=True, budget=ResourceBudget(max_workers=2))
+    scheduler.add_job("moves", "", entry=pooled_entry(tmp_path, "moves", "chdir"), resources=JobResources(2))
+    scheduler.add_job("after", "", deps=("moves",), entry=pooled_entry(tmp_path, "after"), resources=JobResources(2))
+    scheduler.run()
+    lines = dict(line.split(" ", 1) for line in (tmp_path / "out.txt").read_text().splitlines())
+    # workers are granted from the budget, and a worker's cwd is restored between jobs
+    assert lines == {"moves": f"2 {tmp_path}", "after": f"2 {tmp_path}"}
+
+
+def test_in_process_failure_kills_pooled_siblings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    marker = tmp_path / "finished"
+    scheduler = JobScheduler(in_process=True)
+    scheduler.add_job("hangs", "", entry=pooled_entry(tmp_path, "hangs", "hang", marker=str(marker)))
+    scheduler.add_job("fails", "", entry=pooled_entry(tmp_path, "fails", "fail"))
+    start = time.monotonic()
+    with pytest.raises(SystemExit):
+        scheduler.run()
+    assert time.monotonic() - start < 10
+    assert not marker.exists()
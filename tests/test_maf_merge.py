@@ -0,0 +1,95 @@
+"""Tests of MAF filtering and merging, on the MAFs of tests/data/maf."""
+
+import io
+from pathlib import Path
+
+import pytest
+
+from cbioportal_etl.scripts import maf_merge
+from cbioportal_etl.scripts.maf_merge import EntryIndices, filter_entry, process_maf_pandas
+
+MAF_DIR = Path(__file__).parent / "data" / "maf"
+MAF_EXC = {"Silent": 0, "Intron": 0, "IGR": 0, "3'UTR": 0, "5'UTR": 0, "3'Flank": 0, "5'Flank": 0, "RNA": 0}
+PRINT_HEADER = (MAF_DIR / "header.maf").read_text().splitlines()[1].split("\t")
+PRINT_HEADER.remove("Entrez_Gene_Id")
+
+
+def reference(maf_fn: Path, tum_id: str, norm_id: str) -> bytes:
+    """Filter a MAF line by line with filter_entry, projecting kept rows into the output columns."""
+    lines = maf_fn.read_text().splitlines()
+    header = lines[1].split("\t")
+    columns = ["Tumor_Sample_Barcode", "Matched_Norm_Sample_Barcode", "Variant_Classification", "Hugo_Symbol"]
+    indices = EntryIndices(*map(header.index, columns))
+    out = []
+    for line in lines[2:]:
+        data = filter_entry(line, tum_id, norm_id, indices, MAF_EXC)
+        if data is not None:
+            data += [""] * (len(header) - len(data))
+            out.append("\t".join(data[header.index(col)] if col in header else "" for col in PRINT_HEADER) + "\n")
+    return "".join(out).encode()
+
+
+def filtered(engine, maf_fn: Path, tum_id: str = "C1-T", norm_id: str = "C1-N") -> bytes:
+    """Filter a MAF with an engine of ENGINES."""
+    out = io.BytesIO()
+    engine(str(maf_fn), out, MAF_EXC, tum_id, norm_id, PRINT_HEADER)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("maf", ["a.maf", "b.maf"])
+@pytest.mark.parametrize("chunk_rows", [1, 3, 100_000])
+def test_pandas_engine_matches_the_line_rule(monkeypatch, maf, chunk_rows):
+    monkeypatch.setattr(maf_merge, "CHUNK_ROWS", chunk_rows)
+    assert filtered(process_maf_pandas, MAF_DIR / maf) == reference(MAF_DIR / maf, "C1-T", "C1-N")
+
+
+def test_filter_keeps_tert_promoter_hits_only():
+    kept = [line.split("\t") for line in filtered(process_maf_pandas, MAF_DIR / "a.maf").decode().splitlines()]
+    assert [(row[0], row[1]) for row in kept] == [
+        ("TP53", "Missense_Mutation"),
+        ("TERT", "5'Flank"),
+        ("KRAS", "Nonsense_Mutation"),
+        ("NRAS", "Frame_Shift_Del"),
+        ("PTEN", "Splice_Site"),
+    ]
+    # barcodes replaced, the column no MAF has left empty, and values kept as written
+    assert kept[0] == ["TP53", "Missense_Mutation", "C1-T", "C1-N", "p.R175H", "30", ""]
+    assert kept[2] == ["KRAS", "Nonsense_Mutation", "C1-T", "C1-N", "", "", ""]
+    assert kept[3][4] == "NA"
+    assert kept[4][5] == "1.0"
+
+
+def test_merged_maf_is_in_manifest_order(tmp_path):
+    maf_list = [["b.maf", "C2-T", "C2-N"], ["a.maf", "C1-T", "C1-N"], ["b.maf", "C3-T", "C3-N"]]
+    print_head = "#version 2.4\n" + "\t".join(PRINT_HEADER) + "\n"
+    out_dir = f"{tmp_path}/"
+    maf_merge.process_tbl("study", maf_list, print_head, PRINT_HEADER, f"{MAF_DIR}/", out_dir, MAF_EXC)
+    merged = (tmp_path / "study.maf").read_bytes()
+    assert merged == print_head.encode() + b"".join(reference(MAF_DIR / maf, *ids) for maf, *ids in maf_list)
+    # shards are removed once concatenated
+    assert list(tmp_path.iterdir()) == [tmp_path / "study.maf"]
+
+
+def test_failed_maf_fails_the_merge(tmp_path):
+    maf_list = [["a.maf", "C1-T", "C1-N"], ["missing.maf", "C2-T", "C2-N"]]
+    with pytest.raises(SystemExit):
+        maf_merge.process_tbl("study", maf_list, "#version 2.4\n", PRINT_HEADER, f"{MAF_DIR}/", f"{tmp_path}/", MAF_EXC)
+    assert not (tmp_path / "study_shards").exists()
+
+
+@pytest.mark.parametrize("maf", ["a.maf", "b.maf"])
+def test_bytes_engine_is_byte_identical_to_pandas(maf):
+    assert filtered(maf_merge.process_maf, MAF_DIR / maf) == filtered(process_maf_pandas, MAF_DIR / maf)
+
+
+@pytest.mark.parametrize("write_rows", [1, 2, 10_000])
+def test_bytes_engine_batches_writes(monkeypatch, write_rows):
+    monkeypatch.setattr(maf_merge, "WRITE_ROWS", write_rows)
+    assert filtered(maf_merge.process_maf, MAF_DIR / "a.maf") == reference(MAF_DIR / "a.maf", "C1-T", "C1-N")
+
+
+def test_bytes_engine_counts_rows():
+    with open(MAF_DIR / "a.maf", "rb") as maf:
+        next(maf)
+        counts = maf_merge.filter_maf_bytes(maf, io.BytesIO(), MAF_EXC, "C1-T", "C1-N", PRINT_HEADER)
+    assert counts == (5, 4)
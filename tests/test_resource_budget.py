@@ -0,0 +1,71 @@
+"""Tests of the cpu and memory budget shared by step 6 jobs."""
+
+import pytest
+
+from cbioportal_etl.scripts.resource_budget import (
+    WORKERS_ENV,
+    JobResources,
+    ResourceBudget,
+    parse_memory,
+    worker_count,
+)
+
+GIB = 1024**3
+
+
+@pytest.mark.parametrize(
+    ("memory", "expected"),
+    [
+        ("48G", 48 * GIB),
+        ("512M", 512 * 1024**2),
+        ("1.5g", int(1.5 * GIB)),
+        ("2GiB", 2 * GIB),
+        ("100", 100),
+        (None, None),
+    ],
+)
+def test_parse_memory(memory, expected):
+    assert parse_memory(memory) == expected
+
+
+def test_parse_memory_rejects_garbage():
+    with pytest.raises(ValueError, match="Invalid memory size"):
+        parse_memory("lots")
+
+
+def test_worker_count_reads_the_grant(monkeypatch):
+    monkeypatch.setenv(WORKERS_ENV, "3")
+    assert worker_count(8) == 3
+    monkeypatch.delenv(WORKERS_ENV)
+    assert worker_count(8) == 8
+
+
+def test_grants_are_capped_by_free_workers():
+    budget = ResourceBudget(max_workers=8)
+    assert budget.acquire("a", JobResources(max_workers=6)) == 6
+    assert budget.acquire("b", JobResources(max_workers=6)) == 2
+    assert budget.acquire("c", JobResources(max_workers=1)) == 0
+    budget.release("a")
+    assert budget.acquire("c", JobResources(max_workers=1)) == 1
+    assert budget.free() == (5, None)
+
+
+def test_grants_fit_memory():
+    budget = ResourceBudget(max_workers=8, max_memory=10 * GIB)
+    # 2G base leaves room for 4 workers of 2G
+    assert budget.acquire("a", JobResources(8, 2 * GIB, 2 * GIB)) == 4
+    assert budget.free() == (4, 0)
+    assert budget.acquire("b", JobResources(1, GIB)) == 0
+
+
+def test_one_job_runs_even_over_budget():
+    budget = ResourceBudget(max_workers=2, max_memory=GIB)
+    assert budget.acquire("huge", JobResources(4, 8 * GIB, GIB)) == 1
+
+
+def test_shares_split_free_workers():
+    budget = ResourceBudget(max_workers=10)
+    # jobs wanting less than an even split get what they want, the rest split the remainder
+    assert budget.shares({"small": 2, "big": 10, "bigger": 20}) == {"small": 2, "big": 4, "bigger": 4}
+    budget.acquire("running", JobResources(max_workers=9))
+    assert budget.shares({"a": 4, "b": 4}) == {"a": 1, "b": 1}
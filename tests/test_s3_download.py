@@ -0,0 +1,149 @@
+"""Tests of native S3 downloads, against S3 mocked by moto."""
+
+import hashlib
+import os
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from cbioportal_etl.scripts.check_downloads import etag_part_sizes, file_etags, verify_digest
+from cbioportal_etl.scripts.download_scheduler import DownloadScheduler
+from cbioportal_etl.scripts.download_state import DownloadState
+from cbioportal_etl.scripts.get_files_from_manifest import DownloadTracker, download_s3
+from cbioportal_etl.scripts.s3_download import S3Source
+
+moto = pytest.importorskip("moto")
+
+MIB = 1024 * 1024
+BUCKET = "kf-study-bucket"
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    """Mocked S3 with an empty bucket, and a source reading it with the test profile of the AWS table."""
+    credentials = tmp_path / "credentials"
+    credentials.write_text("[test]\naws_access_key_id = testing\naws_secret_access_key = testing\n")
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(credentials))
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(tmp_path / "config"))
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    aws_tbl = tmp_path / "aws_tbl.txt"
+    aws_tbl.write_text(f"s3://{BUCKET}\ttest\n")
+    with moto.mock_aws():
+        source = S3Source(str(aws_tbl))
+        source.client("test").create_bucket(Bucket=BUCKET)
+        yield source
+
+
+def upload(s3: S3Source, key: str, data: bytes, part_size: int | None = None) -> str:
+    """Upload data, in parts of part_size if given, returning its ETag."""
+    client = s3.client("test")
+    if part_size is None:
+        return client.put_object(Bucket=BUCKET, Key=key, Body=data)["ETag"].strip('"')
+    upload_id = client.create_multipart_upload(Bucket=BUCKET, Key=key)["UploadId"]
+    parts = [
+        {"PartNumber": number, "ETag": client.upload_part(
+            Bucket=BUCKET, Key=key, UploadId=upload_id, PartNumber=number, Body=data[start:start + part_size]
+        )["ETag"]}
+        for number, start in enumerate(range(0, len(data), part_size), 1)
+    ]
+    response = client.complete_multipart_upload(
+        Bucket=BUCKET, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+    )
+    return response["ETag"].strip('"')
+
+
+def manifest(*rows: tuple[str | None, str, str]) -> pd.DataFrame:
+    """Manifest of maf files from (file_id, file_name, s3_path) rows."""
+    return pd.DataFrame(
+        {
+            "file_type": ["maf"] * len(rows),
+            "file_id": [row[0] for row in rows],
+            "file_name": [row[1] for row in rows],
+            "s3_path": [row[2] for row in rows],
+        }
+    )
+
+
+def test_head_reports_size_etag_and_version(s3):
+    etag = upload(s3, "a.maf", b"maf rows\n")
+    assert s3.head(f"s3://{BUCKET}/a.maf") == (9, etag, etag)
+    s3.client("test").put_bucket_versioning(Bucket=BUCKET, VersioningConfiguration={"Status": "Enabled"})
+    version_id = s3.client("test").put_object(Bucket=BUCKET, Key="a.maf", Body=b"maf rows\n")["VersionId"]
+    assert s3.head(f"s3://{BUCKET}/a.maf").version == version_id
+
+
+def test_downloads_through_the_scheduler(s3, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("maf")
+    small, large = b"maf rows\n" * 100, os.urandom(20 * MIB)
+    upload(s3, "small.maf", small)
+    etag = upload(s3, "study/large.maf", large, 8 * MIB)
+    tracker = DownloadTracker()
+    state = DownloadState()
+    scheduler = DownloadScheduler(tracker, max_workers=4, chunk_size=8 * MIB, state=state)
+    selected = manifest(
+        (None, "small.maf", f"s3://{BUCKET}/small.maf"), ("large", "large.maf", f"s3://{BUCKET}/study/large.maf")
+    )
+    assert download_s3("maf", selected, s3, False, tracker, scheduler).empty
+    scheduler.finish_type("maf")
+    scheduler.wait()
+    assert sorted(tracker.success) == [("large", "maf/large.maf"), (f"s3://{BUCKET}/small.maf", "maf/small.maf")]
+    assert Path("maf/small.maf").read_bytes() == small
+    assert Path("maf/large.maf").read_bytes() == large
+    record = state.get("maf/large.maf")
+    # fetched in ranges of the upload's part size, its digest is the S3 ETag
+    assert record["etag"] == record["expected_md5"] == etag
+    assert state.get("maf/small.maf")["md5"] == hashlib.md5(small).hexdigest()
+    assert verify_digest("maf/large.maf", os.stat("maf/large.maf"), record, None) is None
+
+
+def test_unreadable_objects_fall_back_to_sbg(s3, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("maf")
+    tracker = DownloadTracker()
+    scheduler = DownloadScheduler(tracker, max_workers=1)
+    selected = manifest(
+        ("on-sbg", "a.maf", f"s3://{BUCKET}/missing/a.maf"),
+        (None, "b.maf", f"s3://{BUCKET}/missing/b.maf"),
+        ("other-bucket", "c.maf", "s3://other-bucket/c.maf"),
+    )
+    fallback = download_s3("maf", selected, s3, False, tracker, scheduler)
+    scheduler.finish_type("maf")
+    scheduler.wait()
+    assert sorted(fallback["file_id"].dropna()) == ["on-sbg", "other-bucket"]
+    # without an SBG ID there is nothing to fall back to
+    assert [path for _file_id, path, _error in tracker.failed] == ["maf/b.maf"]
+
+
+def test_manifest_without_s3_paths_is_left_to_sbg(s3):
+    selected = manifest(("a", "a.maf", None)).drop(columns="s3_path")
+    tracker = DownloadTracker()
+    scheduler = DownloadScheduler(tracker, max_workers=1)
+    fallback = download_s3("maf", selected, s3, False, tracker, scheduler)
+    scheduler.wait()
+    assert fallback["file_id"].tolist() == ["a"]
+
+
+@pytest.mark.parametrize(
+    ("size", "part_size"),
+    [(10 * MIB, 5 * MIB), (17 * MIB, 8 * MIB), (20 * MIB, 16 * MIB), (11 * MIB + 3, 6 * MIB)],
+)
+def test_multipart_etags_verify_across_part_sizes(s3, tmp_path, size, part_size):
+    data = os.urandom(size)
+    etag = upload(s3, "a.maf", data, part_size)
+    path = tmp_path / "a.maf"
+    path.write_bytes(data)
+    parts = int(etag.partition("-")[2])
+    assert part_size in etag_part_sizes(size, parts)
+    assert file_etags(str(path), etag_part_sizes(size, parts))[part_size] == etag
+    assert verify_digest(str(path), os.stat(path), None, etag) is None
+
+
+def test_multipart_etag_of_an_unknown_part_size_is_skipped(s3, tmp_path, capsys):
+    data = os.urandom(15 * MIB)
+    etag = upload(s3, "a.maf", data, 7 * MIB)
+    path = tmp_path / "a.maf"
+    path.write_bytes(data)
+    assert verify_digest(str(path), os.stat(path), None, etag) is None
+    assert "matches no multipart ETag" in capsys.readouterr().err
@@ -0,0 +1,129 @@
+"""Tests of ranged and whole downloads straight to disk."""
+
+import hashlib
+import os
+
+import pytest
+
+from cbioportal_etl.scripts.url_download_helper import (
+    JOURNAL_SUFFIX,
+    PartHasher,
+    check_range_response,
+    discard_partial,
+    download_range,
+    journal_header,
+    journal_range,
+    pooled_session,
+    read_journal,
+    small_download,
+)
+
+DATA = os.urandom(10_000)
+
+
+def md5(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def test_ranges_land_at_their_offset(range_server, tmp_path):
+    url = range_server.add("a.bin", DATA)
+    out = tmp_path / "a.bin.part"
+    fd = os.open(out, os.O_WRONLY | os.O_CREAT, 0o644)
+    os.ftruncate(fd, len(DATA))
+    with pooled_session(2) as session:
+        # out of order, like workers finishing ranges in any order
+        second = download_range(session, url, 4096, len(DATA) - 1, fd, part_size=1024)
+        first = download_range(session, url, 0, 4095, fd, part_size=1024)
+    os.close(fd)
+    assert out.read_bytes() == DATA
+    assert first + second == [md5(DATA[start:start + 1024]) for start in range(0, len(DATA), 1024)]
+
+
+def test_range_without_part_size_is_one_part(range_server, tmp_path):
+    url = range_server.add("a.bin", DATA)
+    fd = os.open(tmp_path / "a.bin.part", os.O_WRONLY | os.O_CREAT, 0o644)
+    os.ftruncate(fd, len(DATA))
+    with pooled_session(1) as session:
+        assert download_range(session, url, 100, 199, fd) == [md5(DATA[100:200])]
+    os.close(fd)
+
+
+@pytest.mark.parametrize(
+    ("status", "content_range"),
+    [(200, None), (206, "bytes 0-99/10000"), (206, None)],
+)
+def test_rejects_responses_of_another_range(status, content_range):
+    with pytest.raises(ValueError):
+        check_range_response(status, content_range, 100, 199)
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [[DATA], [DATA[:1], DATA[1:1500], DATA[1500:]], [DATA[start:start + 7] for start in range(0, len(DATA), 7)]],
+)
+def test_part_hasher_splits_at_part_boundaries(chunks):
+    hasher = PartHasher(1024)
+    for chunk in chunks:
+        hasher.update(chunk)
+    assert hasher.written == len(DATA)
+    assert hasher.hexdigests() == [md5(DATA[start:start + 1024]) for start in range(0, len(DATA), 1024)]
+
+
+def test_small_download_resumes_and_hashes_whole_file(range_server, tmp_path):
+    url = range_server.add("a.bin", DATA)
+    out = tmp_path / "a.bin.part"
+    out.write_bytes(DATA[:3000])
+    assert small_download(url, str(out), offset=3000) == md5(DATA)
+    assert out.read_bytes() == DATA
+    assert range_server.requests[-1] == ("/a.bin", "bytes=3000-")
+
+
+def journaled_part(tmp_path, size: int = len(DATA), version: str | None = "v1") -> str:
+    """A partial download of DATA with its first 2048 bytes journaled as done, returning its path."""
+    part = str(tmp_path / "a.bin.part")
+    read_journal(part, size, version)
+    with open(part, "wb") as f:
+        f.write(DATA[:2048])
+        f.truncate(size)
+    journal_range(part, 0, 2047, [md5(DATA[:1024]), md5(DATA[1024:2048])])
+    return part
+
+
+def test_journal_lists_ranges_done(tmp_path):
+    part = journaled_part(tmp_path)
+    assert read_journal(part, len(DATA), "v1") == {(0, 2047): [md5(DATA[:1024]), md5(DATA[1024:2048])]}
+
+
+def test_journal_skips_line_cut_short(tmp_path):
+    part = journaled_part(tmp_path)
+    with open(part + JOURNAL_SUFFIX, "a") as f:
+        f.write("2048-3071 0123")
+    assert list(read_journal(part, len(DATA), "v1")) == [(0, 2047)]
+
+
+@pytest.mark.parametrize(("size", "version"), [(len(DATA) + 1, "v1"), (len(DATA), "v2"), (len(DATA), None)])
+def test_journal_of_another_source_is_discarded(tmp_path, size, version):
+    part = journaled_part(tmp_path)
+    assert read_journal(part, size, version) == {}
+    assert not os.path.exists(part)
+    # a new journal is started for the new source
+    with open(part + JOURNAL_SUFFIX) as f:
+        assert f.read() == journal_header(size, version) + "\n"
+
+
+def test_discard_partial_removes_journal(tmp_path):
+    part = journaled_part(tmp_path)
+    discard_partial(part)
+    assert not os.path.exists(part)
+    assert not os.path.exists(part + JOURNAL_SUFFIX)
+    # nothing left to remove is fine
+    discard_partial(part)
+
+
+def test_pooled_session_keeps_connections_alive(range_server, tmp_path):
+    url = range_server.add("a.bin", DATA)
+    with pooled_session(1) as session:
+        for i in range(5):
+            small_download(url, str(tmp_path / f"{i}.bin"), session=session)
+    assert len(range_server.requests) == 5
+    assert len(range_server.clients) == 1
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Benchmark the threaded and async download engines of step 4 against a local HTTP range server.
+
+Serves generated files, many small and a few large, from a temp dir on a local server that
+answers Range requests like S3 and can add latency per request, standing in for the round trip
+to a remote host. Each engine downloads every file through the download scheduler with the same
+worker count, and its wall time and throughput are printed once every file was checked against
+its source. The async engine needs aiohttp.
+Usage:
+  python3 utilities/download_engine_benchmark.py [--workers 64] [--small 500] [--large 4] [--latency-ms 50]
+"""
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cbioportal_etl.scripts.download_scheduler import DownloadScheduler
+from cbioportal_etl.scripts.get_files_from_manifest import DownloadTracker
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves files of the server's root dir whole or by a bytes=start-end Range, keeping connections alive."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args) -> None:  # noqa: A002
+        """Log nothing, the benchmark output is all that matters."""
+
+    def do_GET(self) -> None:  # noqa: N802
+        """Send a file, or the range of it asked for."""
+        time.sleep(self.server.latency)
+        path: str = os.path.join(self.server.root, self.path.split("?")[0].lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        size: int = os.path.getsize(path)
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        start: int = int(match[1]) if match else 0
+        end: int = min(int(match[2]), size - 1) if match and match[2] else size - 1
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining: int = end - start + 1
+            while remaining and (chunk := f.read(min(remaining, 1024 * 1024))):
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+def make_files(root: str, small: int, large: int, large_mb: int) -> dict[str, int]:
+    """Write small files of 10 to 200 KB and large files of large_mb MB of random bytes, returning sizes by name."""
+    sizes: dict[str, int] = {}
+    for i in range(small):
+        sizes[f"small_{i}.maf"] = 10_000 + (i * 7919) % 190_000
+    for i in range(large):
+        sizes[f"large_{i}.bam"] = large_mb * 1024 * 1024 + i
+    for name, size in sizes.items():
+        with open(os.path.join(root, name), "wb") as f:
+            f.write(os.urandom(size))
+    return sizes
+
+
+def run_engine(engine: str, base_url: str, src: str, sizes: dict[str, int], workers: int) -> float:
+    """Download every file with an engine into a new dir, check them, and return the seconds it took."""
+    if engine == "async":
+        from cbioportal_etl.scripts.async_download import AsyncDownloadScheduler
+
+        scheduler_class: type[DownloadScheduler] = AsyncDownloadScheduler
+    else:
+        scheduler_class = DownloadScheduler
+    out_dir: str = tempfile.mkdtemp(prefix=f"download_{engine}_")
+    try:
+        tracker = DownloadTracker()
+        tracker.publish_types(["bench"])
+        start: float = time.perf_counter()
+        scheduler = scheduler_class(tracker, workers)
+        for name, size in sizes.items():
+            scheduler.submit(name, "bench", os.path.join(out_dir, name), size, lambda name=name: f"{base_url}/{name}")
+        scheduler.finish_type("bench")
+        scheduler.wait()
+        seconds: float = time.perf_counter() - start
+        if tracker.failed:
+            msg = f"{engine}: {len(tracker.failed)} downloads failed, first {tracker.failed[0]}"
+            raise RuntimeError(msg)
+        for name in sizes:
+            with open(os.path.join(src, name), "rb") as f_src, open(os.path.join(out_dir, name), "rb") as f_out:
+                if f_src.read() != f_out.read():
+                    msg = f"{engine}: {name} differs from its source"
+                    raise RuntimeError(msg)
+        return seconds
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def main() -> None:
+    """Parse args and run the benchmark."""
+    parser = argparse.ArgumentParser(description="Compare the threaded and async download engines")
+    parser.add_argument("-w", "--workers", type=int, default=64, help="Downloads in flight at most, per engine")
+    parser.add_argument("-s", "--small", type=int, default=500, help="Number of small files")
+    parser.add_argument("-l", "--large", type=int, default=4, help="Number of large files")
+    parser.add_argument("--large-mb", type=int, default=64, help="Size of each large file in MB")
+    parser.add_argument(
+        "--latency-ms", type=float, default=50, help="Delay the server adds to every request, like a remote host"
+    )
+    parser.add_argument("-r", "--runs", type=int, default=1, help="Runs per engine, the fastest is reported")
+    parser.add_argument(
+        "-e", "--engines", default="threads,async", help="Comma separated engines to run. Default is both"
+    )
+    args = parser.parse_args()
+
+    src: str = tempfile.mkdtemp(prefix="download_src_")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.daemon_threads = True
+    server.root = src
+    server.latency = args.latency_ms / 1000
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        sizes: dict[str, int] = make_files(src, args.small, args.large, args.large_mb)
+        total_mb: float = sum(sizes.values()) / 1024**2
+        print(f"{len(sizes)} files, {total_mb:.0f} MB, {args.workers} workers, {args.latency_ms:g} ms latency")
+        base_url: str = f"http://127.0.0.1:{server.server_address[1]}"
+        for engine in args.engines.split(","):
+            seconds: float = min(
+                run_engine(engine, base_url, src, sizes, args.workers) for _run in range(args.runs)
+            )
+            print(f"{engine}: {seconds:.2f}s, {total_mb / seconds:.1f} MB/s")
+    except (ImportError, RuntimeError) as e:
+        print(f"FAIL: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        server.shutdown()
+        shutil.rmtree(src, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Guard cbio-etl startup time against heavy imports creeping back in.
+
+Times `cbio-etl --help` in fresh interpreters and checks that importing the CLI loads none of the
+heavy libraries only some steps need. Exits with status 1 if startup is over budget or any of them
+is loaded.
+Usage:
+  python3 utilities/import_time_benchmark.py [--runs 5] [--max-seconds 1.0]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+# Only imported once the steps needing them run
+HEAVY_MODULES: list[str] = [
+    "pandas",
+    "numpy",
+    "scipy",
+    "psycopg2",
+    "sevenbridges",
+    "requests",
+    "truststore",
+    "pybedtools",
+    "boto3",
+    "aiohttp",
+]
+HELP_CMD: str = """
+import sys
+sys.argv = ["cbio-etl", "--help"]
+from cbioportal_etl.cli import main
+try:
+    main()
+except SystemExit:
+    pass
+"""
+LOADED_CMD: str = f"""
+import sys
+import cbioportal_etl.cli
+print(",".join(module for module in {HEAVY_MODULES!r} if module in sys.modules))
+"""
+
+
+def time_startup(runs: int) -> list[float]:
+    """Time cbio-etl --help in a new interpreter runs times, in seconds."""
+    timings: list[float] = []
+    for _ in range(runs):
+        start: float = time.perf_counter()
+        subprocess.run([sys.executable, "-c", HELP_CMD], check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def loaded_heavy_modules() -> list[str]:
+    """List heavy modules loaded by importing the CLI."""
+    result = subprocess.run([sys.executable, "-c", LOADED_CMD], check=True, capture_output=True, text=True)
+    return [module for module in result.stdout.strip().split(",") if module]
+
+
+def main() -> None:
+    """Parse args and run the benchmark."""
+    parser = argparse.ArgumentParser(description="Check cbio-etl startup time and the modules it imports")
+    parser.add_argument("-r", "--runs", type=int, default=5, help="Number of timed runs, the median is checked")
+    parser.add_argument(
+        "-s", "--max-seconds", type=float, default=1.0, help="Most seconds cbio-etl --help may take"
+    )
+    args = parser.parse_args()
+
+    timings: list[float] = time_startup(args.runs)
+    median: float = statistics.median(timings)
+    print(f"cbio-etl --help: median {median:.3f}s, min {min(timings):.3f}s over {args.runs} runs")
+    failed: bool = False
+    if median > args.max_seconds:
+        print(f"FAIL: startup is over the {args.max_seconds}s budget", file=sys.stderr)
+        failed = True
+    loaded: list[str] = loaded_heavy_modules()
+    if loaded:
+        print(f"FAIL: importing the CLI loads {', '.join(loaded)}", file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Benchmark the bytes MAF filter of maf_merge against filtering decoded lines with filter_entry.
+
+Writes a MAF of generated rows, as wide as a typical annotated MAF, with a share of rows in the
+excluded Variant_Classification terms, like the intronic and intergenic calls of WGS. Each path
+filters it and projects the kept rows to the output header into a file, like add_dgd_maf_to_pbta.py
+and the merge of step 6 do, and its wall time and throughput are printed once both outputs were
+checked to be the same.
+Usage:
+  python3 utilities/maf_filter_benchmark.py [--rows 1000000] [--columns 130] [--excluded 0.8]
+"""
+
+import argparse
+import filecmp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from cbioportal_etl.scripts.maf_merge import COPY_BUFFER, EntryIndices, filter_entry, filter_maf_bytes
+
+MAF_EXC: dict[str, int] = {
+    "Silent": 0,
+    "Intron": 0,
+    "IGR": 0,
+    "3'UTR": 0,
+    "5'UTR": 0,
+    "3'Flank": 0,
+    "5'Flank": 0,
+    "RNA": 0,
+}
+KEPT_TERMS: list[str] = ["Missense_Mutation", "Nonsense_Mutation", "Frame_Shift_Del", "Splice_Site"]
+GENES: list[str] = ["TERT", "TP53", "BRAF", "EGFR", "H3-3A", "NF1"]
+LEADING: list[str] = [
+    "Hugo_Symbol",
+    "Entrez_Gene_Id",
+    "Center",
+    "NCBI_Build",
+    "Chromosome",
+    "Start_Position",
+    "End_Position",
+    "Strand",
+    "Variant_Classification",
+    "Variant_Type",
+    "Reference_Allele",
+    "Tumor_Seq_Allele1",
+    "Tumor_Seq_Allele2",
+    "dbSNP_RS",
+    "dbSNP_Val_Status",
+    "Tumor_Sample_Barcode",
+    "Matched_Norm_Sample_Barcode",
+]
+
+
+def make_maf(path: str, rows: int, columns: int, excluded: float) -> list[str]:
+    """Write a MAF of generated rows, returning its header fields."""
+    rng = random.Random(0)
+    header: list[str] = LEADING + [f"annotation_{i}" for i in range(max(0, columns - len(LEADING)))]
+    extra: int = len(header) - len(LEADING)
+    with open(path, "w") as f:
+        f.write("#version 2.4\n" + "\t".join(header) + "\n")
+        for i in range(rows):
+            term: str = rng.choice(list(MAF_EXC)) if rng.random() < excluded else rng.choice(KEPT_TERMS)
+            row: list[str] = [rng.choice(GENES), "7015", "BI", "GRCh38", "chr5", str(i), str(i + 1), "+", term]
+            row += ["SNP", "C", "C", "T", "novel", "", "BS_TUMOR", "BS_NORMAL"]
+            row += [f"value_{j}_{i % 1009}" for j in range(extra)]
+            f.write("\t".join(row) + "\n")
+    return header
+
+
+def filter_str(maf_path: str, out_path: str, print_header: list[str]) -> None:
+    """Filter decoded lines with filter_entry, projecting each kept one like add_dgd_maf_to_pbta.py did."""
+    with open(maf_path) as cur, open(out_path, "w") as out:
+        next(cur)
+        m_header: list[str] = next(cur).rstrip("\n").split("\t")
+        entry_indices = EntryIndices(
+            m_header.index("Tumor_Sample_Barcode"),
+            m_header.index("Matched_Norm_Sample_Barcode"),
+            m_header.index("Variant_Classification"),
+            m_header.index("Hugo_Symbol"),
+        )
+        h_dict: dict[str, int | None] = {
+            item: m_header.index(item) if item in m_header else None for item in print_header
+        }
+        for data in cur:
+            datum = filter_entry(data, "CBIO_TUMOR", "CBIO_NORMAL", entry_indices, MAF_EXC)
+            if datum:
+                to_print = [datum[h_dict[item]] if h_dict[item] is not None else "" for item in print_header]
+                out.write("\t".join(to_print) + "\n")
+
+
+def filter_bytes(maf_path: str, out_path: str, print_header: list[str]) -> None:
+    """Filter with filter_maf_bytes."""
+    with open(maf_path, "rb", buffering=COPY_BUFFER) as cur, open(out_path, "wb", buffering=COPY_BUFFER) as out:
+        next(cur)
+        filter_maf_bytes(cur, out, MAF_EXC, "CBIO_TUMOR", "CBIO_NORMAL", print_header)
+
+
+def time_path(func, maf_path: str, out_path: str, print_header: list[str]) -> float:
+    """Run one path and return the seconds it took."""
+    start: float = time.perf_counter()
+    func(maf_path, out_path, print_header)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Parse args and run the benchmark."""
+    parser = argparse.ArgumentParser(description="Compare the bytes and str MAF filters")
+    parser.add_argument("-n", "--rows", type=int, default=1_000_000, help="Rows of the generated MAF")
+    parser.add_argument("-c", "--columns", type=int, default=130, help="Columns of the generated MAF")
+    parser.add_argument(
+        "-x", "--excluded", type=float, default=0.8, help="Share of rows with an excluded Variant_Classification"
+    )
+    parser.add_argument("-r", "--runs", type=int, default=1, help="Runs per path, the fastest is reported")
+    args = parser.parse_args()
+
+    work_dir: str = tempfile.mkdtemp(prefix="maf_filter_")
+    try:
+        maf_path: str = os.path.join(work_dir, "input.maf")
+        header: list[str] = make_maf(maf_path, args.rows, args.columns, args.excluded)
+        # output header of the merge, every input field but Entrez_Gene_Id
+        print_header: list[str] = [item for item in header if item != "Entrez_Gene_Id"]
+        size_mb: float = os.path.getsize(maf_path) / 1024**2
+        print(f"{args.rows} rows, {len(header)} columns, {size_mb:.0f} MB, {args.excluded:.0%} excluded")
+        seconds: dict[str, float] = {}
+        for name, func in (("str", filter_str), ("bytes", filter_bytes)):
+            out_path: str = os.path.join(work_dir, f"{name}.maf")
+            seconds[name] = min(time_path(func, maf_path, out_path, print_header) for _run in range(args.runs))
+            print(f"{name}: {seconds[name]:.2f}s, {size_mb / seconds[name]:.1f} MB/s")
+        if not filecmp.cmp(os.path.join(work_dir, "str.maf"), os.path.join(work_dir, "bytes.maf"), shallow=False):
+            print("FAIL: bytes output differs from str output", file=sys.stderr)
+            sys.exit(1)
+        print(f"bytes speedup: {seconds['str'] / seconds['bytes']:.1f}x")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()